@@ -0,0 +1,296 @@
+import schemas_and_tables as S
+from export_data import table_for
+from locations import StationIndex
+import itertools
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+""" Analysis of the archived readings with NumPy. A station's readings
+    of a measure are loaded straight into arrays of times and values,
+    a chunk at a time, without lists of rows. Then resampling to fixed
+    intervals, finding gaps, daily aggregates and heating degree days
+    are array operations, rather than Python loops over rows.
+    Readings for a location are loaded from whichever stations were
+    there at the time, using the stations table's history.
+    Needs numpy, which isn't in requirements.txt. For partitioned DBs
+    pass a connection from partitions.open_range().
+"""
+
+logger = logging.getLogger(__name__)
+
+DAY_S = 86400
+
+# Base temperature for heating degree days, as used in the UK
+HDD_BASE_C = 15.5
+
+# Rows converted into an array at a time
+CHUNK_SIZE = 65536
+
+
+def _require_numpy():
+
+    if np is None:
+        raise RuntimeError("analytics.py needs numpy, `pip install numpy`")
+
+    return None
+
+
+def load_series(conn, measure, station_id, start_utc, end_utc, chunk_size=CHUNK_SIZE):
+    """ Return (times, values) arrays of a station's readings of a
+    measure, e.g. `temp` or `gas`, from start_utc to end_utc, in
+    time order. Gas meter readings are left out.
+    """
+
+    _require_numpy()
+
+    table, column = table_for(measure)
+    condition = f"{column} IS NOT NULL"
+    if table is S.gas_table:
+        condition += " AND NOT COALESCE(is_meter_reading, FALSE)"
+
+    cur = conn.execute(f"SELECT timestamp_utc, {column} FROM {table.tablename} "
+                       "WHERE station_id == ? AND timestamp_utc >= ? AND timestamp_utc <= ? "
+                       f"AND {condition} ORDER BY timestamp_utc",
+                       (station_id, start_utc, end_utc))
+
+    # fromiter() fills the array straight from the cursor
+    dtype = np.dtype([("t", "f8"), ("v", "f8")])
+    chunks = []
+    while True:
+        chunk = np.fromiter(itertools.islice(cur, chunk_size), dtype=dtype)
+        if not len(chunk):
+            break
+        chunks.append(chunk)
+
+    data = np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+
+    return np.ascontiguousarray(data["t"]), np.ascontiguousarray(data["v"])
+
+
+def load_location(conn, measure, start_utc, end_utc, location, sublocation=None,
+                  station_index=None):
+    """ Return (times, values) arrays of the readings of a measure
+    taken at a location, from each station for the time it was there.
+    Readings of several stations there at once are interleaved.
+    Pass a StationIndex to reuse it between calls.
+    """
+
+    _require_numpy()
+
+    if station_index is None:
+        station_index = StationIndex()
+    station_index.refresh(conn)
+
+    parts = []
+    for entry in station_index.intervals(start_utc, end_utc, location, sublocation):
+        to_utc = end_utc
+        if entry["to_timestamp_utc"] is not None:
+            to_utc = min(end_utc, entry["to_timestamp_utc"])
+        parts.append(load_series(conn, measure, entry["station_id"],
+                                 max(start_utc, entry["from_timestamp_utc"]), to_utc))
+
+    if not parts:
+        return np.empty(0), np.empty(0)
+
+    times = np.concatenate([_[0] for _ in parts])
+    values = np.concatenate([_[1] for _ in parts])
+    order = np.argsort(times, kind="stable")
+
+    return times[order], values[order]
+
+
+def _buckets(times, interval_s, start_utc=None, end_utc=None):
+    """ Return the start of the first bucket, the number of buckets,
+    and the bucket index of each time, or -1 if outside them.
+    Buckets are aligned to multiples of interval_s since the epoch,
+    so daily ones are UTC days, like the rollups.
+    """
+
+    if start_utc is None:
+        start_utc = times[0] if len(times) else 0
+    if end_utc is None:
+        end_utc = times[-1] if len(times) else start_utc
+
+    first = np.floor(start_utc / interval_s) * interval_s
+    count = int((end_utc - first) // interval_s) + 1
+
+    index = ((times - first) // interval_s).astype(np.int64)
+    index[(index < 0) | (index >= count)] = -1
+
+    return first, count, index
+
+
+def aggregate(times, values, interval_s, start_utc=None, end_utc=None):
+    """ Return a dict of arrays with a value per interval_s bucket
+    from start_utc to end_utc (default the first and last reading):
+    `start`, `count`, `sum`, `mean`, `min` and `max`, which are NaN
+    for buckets with no readings. times must be in order.
+    """
+
+    _require_numpy()
+
+    first, count, index = _buckets(times, interval_s, start_utc, end_utc)
+    inside = index >= 0
+    index = index[inside]
+    values = values[inside]
+
+    counts = np.bincount(index, minlength=count)
+    sums = np.asarray(np.bincount(index, weights=values, minlength=count), dtype=float)
+
+    result = {"start": first + np.arange(count) * interval_s,
+              "count": counts,
+              "sum": sums,
+              "mean": np.full(count, np.nan),
+              "min": np.full(count, np.nan),
+              "max": np.full(count, np.nan)}
+
+    has_readings = counts > 0
+    result["mean"][has_readings] = sums[has_readings] / counts[has_readings]
+
+    if len(index):
+        # Times are in order, so each bucket's readings are together
+        buckets, bucket_starts = np.unique(index, return_index=True)
+        result["min"][buckets] = np.minimum.reduceat(values, bucket_starts)
+        result["max"][buckets] = np.maximum.reduceat(values, bucket_starts)
+
+    return result
+
+
+def resample(times, values, interval_s, how="mean", start_utc=None, end_utc=None):
+    """ Return (bucket start times, values) at a fixed interval, by
+    how: `mean`, `min`, `max`, `sum` or `count` of the readings in
+    each bucket, or the `last` one. Empty buckets are NaN, except
+    for sum and count, where they're 0.
+    """
+
+    _require_numpy()
+
+    if how != "last":
+        result = aggregate(times, values, interval_s, start_utc, end_utc)
+        return result["start"], result[how]
+
+    first, count, index = _buckets(times, interval_s, start_utc, end_utc)
+    out = np.full(count, np.nan)
+    inside = index >= 0
+    # Later readings overwrite earlier ones in the same bucket
+    out[index[inside]] = values[inside]
+
+    return first + np.arange(count) * interval_s, out
+
+
+def find_gaps(times, max_gap_s, start_utc=None, end_utc=None):
+    """ Return (gap starts, gap ends) arrays of the periods longer
+    than max_gap_s with no readings, including from start_utc to
+    the first reading, and the last reading to end_utc, if given.
+    """
+
+    _require_numpy()
+
+    edges = times
+    if start_utc is not None:
+        edges = np.concatenate(([start_utc], edges))
+    if end_utc is not None:
+        edges = np.concatenate((edges, [end_utc]))
+
+    gaps = np.nonzero(np.diff(edges) > max_gap_s)[0]
+
+    return edges[gaps], edges[gaps + 1]
+
+
+def daily(times, values, start_utc=None, end_utc=None):
+    """ aggregate() by UTC day """
+
+    return aggregate(times, values, DAY_S, start_utc, end_utc)
+
+
+def degree_days(times, temps, base_c=HDD_BASE_C, start_utc=None, end_utc=None,
+                method="mean", max_gap_s=3600):
+    """ Return (day starts, heating degree days) arrays.
+    method `mean` uses the day's mean temperature, `max(0, base_c - mean)`,
+    NaN for days without readings. `integral` adds up how far below
+    base_c each reading was, for as long as until the next one, up to
+    max_gap_s, which is more accurate for irregular readings.
+    """
+
+    _require_numpy()
+
+    if method == "mean":
+        days = daily(times, temps, start_utc, end_utc)
+        return days["start"], np.maximum(base_c - days["mean"], 0)
+
+    if method != "integral":
+        raise ValueError(f"method must be mean or integral, not {method}")
+
+    first, count, index = _buckets(times, DAY_S, start_utc, end_utc)
+    durations = np.minimum(np.diff(times, append=times[-1] if len(times) else 0), max_gap_s)
+    deficit = np.maximum(base_c - temps, 0) * durations / DAY_S
+    inside = index >= 0
+
+    return (first + np.arange(count) * DAY_S,
+            np.bincount(index[inside], weights=deficit[inside], minlength=count))
+
+
+def gas_per_degree_day(gas_times, volumes, temp_times, temps, start_utc, end_utc,
+                       base_c=HDD_BASE_C, method="mean", min_readings=1):
+    """ Compare daily gas use with heating degree days. Returns a dict
+    of arrays per day, `start`, `litres`, `degree_days` (NaN on days
+    with fewer than min_readings temperatures) and
+    `litres_per_degree_day` (NaN on days without heating), and
+    the fit of `litres = base_load_l + litres_per_degree_day * hdd`
+    over the days with both, as `fit_base_load_l` and
+    `fit_litres_per_degree_day`, which are NaN with under two days.
+    """
+
+    _require_numpy()
+
+    days, litres = resample(gas_times, volumes, DAY_S, "sum", start_utc, end_utc)
+    _, hdd = degree_days(temp_times, temps, base_c, start_utc, end_utc, method)
+    # The integral is 0, rather than NaN, for days without readings,
+    # which would pull the fit towards gas use with no heating.
+    _, temp_counts = resample(temp_times, temps, DAY_S, "count", start_utc, end_utc)
+    hdd[temp_counts < min_readings] = np.nan
+
+    per_dd = np.full(len(days), np.nan)
+    heating = hdd > 0
+    per_dd[heating] = litres[heating] / hdd[heating]
+
+    usable = ~np.isnan(hdd)
+    slope, intercept = np.nan, np.nan
+    if np.count_nonzero(usable) >= 2 and np.ptp(hdd[usable]) > 0:
+        slope, intercept = np.polyfit(hdd[usable], litres[usable], 1)
+
+    return {"start": days,
+            "litres": litres,
+            "degree_days": hdd,
+            "litres_per_degree_day": per_dd,
+            "fit_base_load_l": intercept,
+            "fit_litres_per_degree_day": slope}
+
+
+def daily_by_location(conn, measure, start_utc, end_utc, station_index=None):
+    """ Return {(location, sublocation): daily() dict} for every
+    location with readings of measure in the range, all over the
+    same days.
+    """
+
+    _require_numpy()
+
+    if station_index is None:
+        station_index = StationIndex()
+    station_index.refresh(conn)
+
+    places = sorted({(_["location"], _["sublocation"])
+                     for _ in station_index.intervals(start_utc, end_utc)},
+                    key=lambda _: (_[0] or "", _[1] or ""))
+
+    result = {}
+    for location, sublocation in places:
+        times, values = load_location(conn, measure, start_utc, end_utc, location,
+                                      sublocation, station_index)
+        result[(location, sublocation)] = daily(times, values, start_utc, end_utc)
+
+    return result
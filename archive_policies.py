@@ -0,0 +1,246 @@
+import inspect
+import logging
+
+""" Policies deciding which environment readings are written to the
+    archive tables. Each policy looks at one reading at a time for a
+    (station_id, measure_type), using that station's lastUpdates row
+    and a small state dict kept with it in the LastUpdatesCache, so a
+    decision is O(1) and needs no DB access.
+    Policies are configured per measure in the `[archive-policy]`
+    section of the config file, e.g.
+    `temp = deadband abs=0.2 max_gap_s=3600`
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class IntervalChangePolicy:
+    """ Archive a reading if more than interval_s seconds have passed
+    since the last archived reading, and its value is different
+    to the last archived value. The original, default, policy.
+    """
+
+    name = "interval"
+
+    def __init__(self, interval_s=600):
+
+        self.interval_s = interval_s
+
+    def decide(self, state, last_update, timestamp_utc, value):
+        """ Return a list of (timestamp_utc, value) readings to
+        archive, given the station's lastUpdates row, which
+        is None if it hasn't reported before.
+        """
+
+        if last_update is None or last_update["last_archive_time_utc"] is None:
+            last_archive = 0
+            last_archive_val = None
+        else:
+            last_archive = last_update["last_archive_time_utc"]
+            last_archive_val = last_update["last_archive_value"]
+
+        if ((timestamp_utc - last_archive) > self.interval_s and
+            value != last_archive_val):
+            return [(timestamp_utc, value)]
+
+        return []
+
+    def __repr__(self):
+
+        return f"{self.name} interval_s={self.interval_s}"
+
+
+class DeadbandPolicy:
+    """ Archive a reading when it differs from the last archived value
+    by more than an absolute amount (abs), or a percentage of the
+    last archived value (pct). If max_gap_s is set, a reading is also
+    archived if nothing has been for that long, as a heartbeat.
+    """
+
+    name = "deadband"
+
+    def __init__(self, abs=None, pct=None, max_gap_s=None):
+
+        if abs is None and pct is None:
+            raise ValueError("deadband policy needs abs= or pct=")
+
+        self.abs = abs
+        self.pct = pct
+        self.max_gap_s = max_gap_s
+
+    def decide(self, state, last_update, timestamp_utc, value):
+
+        if last_update is None or last_update["last_archive_time_utc"] is None:
+            return [(timestamp_utc, value)]
+
+        last_archive = last_update["last_archive_time_utc"]
+        last_archive_val = last_update["last_archive_value"]
+
+        if self.max_gap_s is not None and (timestamp_utc - last_archive) >= self.max_gap_s:
+            return [(timestamp_utc, value)]
+
+        change = abs(value - last_archive_val)
+
+        if self.abs is not None and change > self.abs:
+            return [(timestamp_utc, value)]
+
+        if self.pct is not None and change > abs(last_archive_val) * self.pct / 100:
+            return [(timestamp_utc, value)]
+
+        return []
+
+    def __repr__(self):
+
+        return f"{self.name} abs={self.abs} pct={self.pct} max_gap_s={self.max_gap_s}"
+
+
+class SwingingDoorPolicy:
+    """ Swinging door trending compression. Readings are only archived
+    where a straight line from the last archived reading would no
+    longer pass within deviation of every reading since. When that
+    happens, the previous reading is archived, with its own timestamp.
+    Linear interpolation between the archived readings is then never
+    more than twice deviation from any reading received.
+    If max_gap_s is set the held reading is also archived when it's
+    that long since the last archive, so gaps stay bounded.
+    """
+
+    name = "swinging_door"
+
+    def __init__(self, deviation, max_gap_s=None):
+
+        self.deviation = deviation
+        self.max_gap_s = max_gap_s
+
+    def _open_door(self, state, anchor_t, anchor_v, timestamp_utc, value):
+        """ Start a new door from the anchor, through a reading """
+
+        state["anchor"] = (anchor_t, anchor_v)
+        state["held"] = (timestamp_utc, value)
+
+        if timestamp_utc > anchor_t:
+            dt = timestamp_utc - anchor_t
+            state["slope_max"] = (value + self.deviation - anchor_v) / dt
+            state["slope_min"] = (value - self.deviation - anchor_v) / dt
+        else:
+            state["slope_max"] = float("inf")
+            state["slope_min"] = float("-inf")
+
+        return None
+
+    def decide(self, state, last_update, timestamp_utc, value):
+
+        if "anchor" not in state:
+            if last_update is None or last_update["last_archive_time_utc"] is None:
+                # First ever reading, always archived.
+                self._open_door(state, timestamp_utc, value, timestamp_utc, value)
+                return [(timestamp_utc, value)]
+
+            # Rebuild the door after a restart from lastUpdates, which
+            # has the last archived and the last received reading.
+            anchor = (last_update["last_archive_time_utc"], last_update["last_archive_value"])
+            held = (last_update["timestamp_utc"], last_update["measure_value"])
+            if held[0] is None or held[0] <= anchor[0]:
+                held = anchor
+            self._open_door(state, *anchor, *held)
+
+        anchor_t, anchor_v = state["anchor"]
+        held_t, held_v = state["held"]
+
+        if timestamp_utc <= held_t:
+            # Out of order or repeated, nothing sensible to do.
+            return []
+
+        if self.max_gap_s is not None and (timestamp_utc - anchor_t) >= self.max_gap_s:
+            # Heartbeat: archive this reading and start again from it.
+            # The held reading goes too, as the line from the anchor
+            # to this one might not pass close to the ones in between.
+            self._open_door(state, timestamp_utc, value, timestamp_utc, value)
+            if held_t == anchor_t:
+                return [(timestamp_utc, value)]
+            return [(held_t, held_v), (timestamp_utc, value)]
+
+        dt = timestamp_utc - anchor_t
+        slope_max = min(state["slope_max"], (value + self.deviation - anchor_v) / dt)
+        slope_min = max(state["slope_min"], (value - self.deviation - anchor_v) / dt)
+
+        if slope_min > slope_max:
+            # Door closed, the held reading becomes the new anchor.
+            self._open_door(state, held_t, held_v, timestamp_utc, value)
+            if held_t == anchor_t:
+                return []
+            return [(held_t, held_v)]
+
+        state["slope_max"] = slope_max
+        state["slope_min"] = slope_min
+        state["held"] = (timestamp_utc, value)
+
+        return []
+
+    def __repr__(self):
+
+        return f"{self.name} deviation={self.deviation} max_gap_s={self.max_gap_s}"
+
+
+POLICIES = {_.name: _ for _ in [IntervalChangePolicy, DeadbandPolicy, SwingingDoorPolicy]}
+
+
+def parse_policy(spec, archive_interval_s=600):
+    """ Create a policy from a config string of its name followed by
+    key=value settings, e.g. `swinging_door deviation=0.5 max_gap_s=3600`.
+    The interval policy defaults to archive_interval_s.
+    """
+
+    name, *settings = spec.split()
+
+    if name not in POLICIES:
+        raise ValueError(f"Unknown archive policy {name}, choose from {list(POLICIES)}")
+
+    parameters = inspect.signature(POLICIES[name]).parameters
+
+    kwargs = {}
+    for setting in settings:
+        key, equals, value = setting.partition("=")
+        key = key.strip()
+        if key not in parameters:
+            raise ValueError(f"Unknown setting {key} in archive policy {spec!r}, "
+                             f"{name} takes {', '.join(parameters)}")
+        try:
+            kwargs[key] = float(value)
+        except ValueError:
+            raise ValueError(f"Setting {key} in archive policy {spec!r} needs a "
+                             f"number, e.g. {key}=1") from None
+
+    if name == IntervalChangePolicy.name:
+        kwargs.setdefault("interval_s", archive_interval_s)
+
+    missing = [_ for _, parameter in parameters.items()
+               if parameter.default is parameter.empty and _ not in kwargs]
+    if missing:
+        raise ValueError(f"Archive policy {spec!r} needs {', '.join(_ + '=' for _ in missing)}")
+
+    try:
+        return POLICIES[name](**kwargs)
+    except ValueError as e:
+        raise ValueError(f"Archive policy {spec!r}: {e}") from None
+
+
+def policies_from_config(config, env_tables, archive_interval_s=600):
+    """ Return a dict of the archive policy for each measure in
+    env_tables (e.g. `temp`), from the `[archive-policy]` section.
+    Measures not listed use the `default` entry, or the
+    interval policy if that's not set either.
+    """
+
+    section = "archive-policy"
+
+    default_spec = config.get(section, "default", fallback=IntervalChangePolicy.name)
+    default = parse_policy(default_spec, archive_interval_s)
+
+    policies = {}
+    for measure in env_tables.keys():
+        spec = config.get(section, measure, fallback=None)
+        policies[measure] = parse_policy(spec, archive_interval_s) if spec else default
+        logger.info(f"Archive policy for {measure}: {policies[measure]!r}")
+
+    return policies
@@ -0,0 +1,354 @@
+import asyncio
+import logging
+import random
+import signal
+import paho.mqtt.client as mqtt
+from duplicates import DuplicateFilter
+from metrics import metrics
+
+""" Ingest from several MQTT brokers in one process, each set up in its
+    own `[broker:<name>]` config section. Each broker has its own paho
+    client, driven by an asyncio event loop rather than its own network
+    thread, with the socket's reads and writes handled as the loop sees
+    them ready. Messages are decoded by a coroutine per broker, in the
+    order they arrived, and all the brokers' readings go to the one
+    write behind queue, and DB connection. Connecting, and reconnecting
+    with backoff, are per broker, so a broker that's down or flapping
+    doesn't hold up the others.
+"""
+
+logger = logging.getLogger(__name__)
+
+BROKER_PREFIX = "broker:"
+
+
+class BrokerConnection:
+    """ One broker's client. handle is called as
+    `handle(client, msg)` for each message, from the decoding
+    coroutine. Reading from the socket is paused while more than
+    high_water messages are waiting to be decoded.
+    Retransmitted QoS 1 messages are dropped as they arrive,
+    by the connection's own DuplicateFilter, as packet ids
+    are only unique per connection.
+    """
+
+    def __init__(self, name, settings, subscriptions, handle):
+
+        self.name = name
+        self.settings = settings
+        self.subscriptions = subscriptions
+        self.handle = handle
+        self.high_water = max(1, settings["high_water"])
+        self.duplicates = (DuplicateFilter(settings["duplicate_slots"])
+                           if settings["duplicate_slots"] else None)
+
+        self.client = mqtt.Client(client_id=settings["client_id"],
+                                  clean_session=settings["clean_session"])
+        self.client.username_pw_set(settings["username"], password=settings["password"])
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+        self.loop = None
+        self.queue = None
+        self.connected = False
+        self._sock = None
+        self._paused = False
+        self._closed = None
+        self._backoff_s = settings["min_backoff_s"]
+
+    # Socket callbacks. Those made while connecting come from the
+    # executor thread running connect(), so are passed to the loop's
+    # thread. The others are made on it, and handled at once, as
+    # the socket's gone straight after on_socket_close.
+
+    def _in_loop(self, func, *args):
+
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is self.loop:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+        return None
+
+    def _on_socket_open(self, client, userdata, sock):
+
+        self._in_loop(self._add_reader, sock)
+
+        return None
+
+    def _add_reader(self, sock):
+
+        self._sock = sock
+        self._paused = False
+        self.loop.add_reader(sock, self.client.loop_read)
+
+        return None
+
+    def _on_socket_close(self, client, userdata, sock):
+
+        self._in_loop(self._remove_socket, sock)
+
+        return None
+
+    def _remove_socket(self, sock):
+
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+        self._sock = None
+        self._closed.set()
+
+        return None
+
+    def _on_socket_register_write(self, client, userdata, sock):
+
+        self._in_loop(self.loop.add_writer, sock, self.client.loop_write)
+
+        return None
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+
+        self._in_loop(self.loop.remove_writer, sock)
+
+        return None
+
+    # MQTT callbacks, made from loop_read() on the loop's thread
+
+    def _on_connect(self, client, userdata, flags, rc):
+
+        if rc != 0:
+            logger.warning(f"Broker {self.name} refused the connection: "
+                           f"{mqtt.connack_string(rc)}")
+            return None
+
+        self.connected = True
+        # Back off afresh next time it drops
+        self._backoff_s = self.settings["min_backoff_s"]
+        logger.warning(f"Connected to broker {self.name} at {self.settings['host']}:"
+                       f"{self.settings['port']}"
+                       + (", resuming its session." if flags.get("session present") else ""))
+        client.subscribe(self.subscriptions)
+
+        return None
+
+    def _on_disconnect(self, client, userdata, rc):
+
+        if self.connected:
+            logger.warning(f"Disconnected from broker {self.name}: {mqtt.error_string(rc)}")
+        self.connected = False
+
+        return None
+
+    def _on_message(self, client, userdata, msg):
+
+        if self.duplicates and self.duplicates.is_duplicate(msg):
+            return None
+
+        self.queue.put_nowait(msg)
+
+        # Stop reading until the decoder catches up, the broker
+        # holds on to anything sent meanwhile.
+        if not self._paused and self._sock and self.queue.qsize() >= self.high_water:
+            self.loop.remove_reader(self._sock)
+            self._paused = True
+            logger.debug(f"Paused reading from broker {self.name}, "
+                         f"{self.queue.qsize()} messages waiting.")
+
+        return None
+
+    async def decode(self):
+        """ Pass each message to handle, in the order received """
+
+        handled = 0
+
+        while True:
+            msg = await self.queue.get()
+            try:
+                self.handle(self.client, msg)
+            except Exception:
+                logger.exception(f"Failed to handle a message from broker {self.name}")
+            self.queue.task_done()
+
+            if self._paused and self._sock and self.queue.qsize() <= self.high_water // 2:
+                self.loop.add_reader(self._sock, self.client.loop_read)
+                self._paused = False
+
+            # get() doesn't give way to other tasks while
+            # there are messages waiting, so do it here.
+            handled += 1
+            if handled % 100 == 0:
+                await asyncio.sleep(0)
+
+        return None
+
+    async def _connect(self):
+        """ Connect, without blocking the loop, returns True if the
+        TCP connection was made. The CONNACK arrives later.
+        """
+
+        self._closed = asyncio.Event()
+
+        try:
+            await self.loop.run_in_executor(None,
+                                            self.client.connect,
+                                            self.settings["host"],
+                                            self.settings["port"],
+                                            self.settings["keepalive"])
+        except OSError as e:
+            logger.warning(f"Couldn't connect to broker {self.name} at "
+                           f"{self.settings['host']}:{self.settings['port']}: {e}")
+            return False
+
+        return True
+
+    async def run(self, stop):
+        """ Stay connected, with backoff between attempts, until
+        the stop event is set.
+        """
+
+        self._backoff_s = self.settings["min_backoff_s"]
+
+        while not stop.is_set():
+            if await self._connect():
+                # Keepalive pings, and spotting a silent broker
+                while not self._closed.is_set() and not stop.is_set():
+                    if self.client.loop_misc() != mqtt.MQTT_ERR_SUCCESS:
+                        break
+                    try:
+                        await asyncio.wait_for(self._closed.wait(), 1)
+                    except asyncio.TimeoutError:
+                        pass
+
+                if stop.is_set():
+                    break
+
+            # Jittered, so brokers restarting together
+            # aren't all reconnected to at once.
+            delay_s = self._backoff_s * random.uniform(0.5, 1.0)
+            logger.info(f"Reconnecting to broker {self.name} in {delay_s:.1f}s")
+            try:
+                await asyncio.wait_for(stop.wait(), delay_s)
+            except asyncio.TimeoutError:
+                pass
+            self._backoff_s = min(self._backoff_s * 2, self.settings["max_backoff_s"])
+
+        return None
+
+    async def close(self, timeout_s=2.0):
+        """ Disconnect, then handle the messages still waiting """
+
+        if self._sock:
+            self.client.disconnect()
+            try:
+                await asyncio.wait_for(self._closed.wait(), timeout_s)
+            except asyncio.TimeoutError:
+                logger.warning(f"Broker {self.name} didn't close the connection.")
+
+        await self.queue.join()
+
+        return None
+
+
+async def run_brokers(connections, stop=None):
+    """ Run the connections until stop is set, or SIGTERM or
+    SIGINT are received, then disconnect them and handle the
+    messages already received.
+    """
+
+    loop = asyncio.get_running_loop()
+    stop = stop or asyncio.Event()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    tasks = []
+    for connection in connections:
+        connection.loop = loop
+        connection.queue = asyncio.Queue()
+        metrics.gauge_function("broker_connected", lambda _=connection: int(_.connected),
+                               (("broker", connection.name),))
+        metrics.gauge_function("broker_queue_depth", connection.queue.qsize,
+                               (("broker", connection.name),))
+        tasks.append(asyncio.create_task(connection.decode(), name=f"decode-{connection.name}"))
+
+    runners = [asyncio.create_task(_.run(stop), name=f"broker-{_.name}")
+               for _ in connections]
+
+    try:
+        await stop.wait()
+    finally:
+        logger.warning("Stopping, disconnecting from the brokers.")
+        await asyncio.gather(*runners, return_exceptions=True)
+        await asyncio.gather(*[_.close() for _ in connections], return_exceptions=True)
+        for task in tasks:
+            task.cancel()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
+
+    return None
+
+
+def brokers_from_config(config, router, handle):
+    """ Create a BrokerConnection for each `[broker:<name>]` section of
+    a ConfigParser, or return [] if there are none. Settings not in a
+    broker's section come from `[client]`. Each subscribes to the
+    routes listed in its `routes` option, or all of them.
+    """
+
+    routes = {_.pattern: _ for _ in router.routes}
+    connections = []
+
+    for section in [_ for _ in config.sections() if _.startswith(BROKER_PREFIX)]:
+        name = section[len(BROKER_PREFIX):]
+
+        def get(option, fallback=None, getter=config.get):
+            return getter(section, option, fallback=getter("client", option, fallback=fallback))
+
+        client_id = config.get(section, "client_id", fallback=None)
+        if client_id is None and config.get("client", "client_id", fallback=None):
+            client_id = f"{config.get('client', 'client_id')}-{name}"
+
+        settings = {"host": config.get(section, "host", fallback="127.0.0.1"),
+                    "port": config.getint(section, "port", fallback=1883),
+                    "keepalive": config.getint(section, "timeout", fallback=60),
+                    "client_id": client_id or "",
+                    "username": get("username"),
+                    "password": get("password"),
+                    "clean_session": get("clean_session", True, config.getboolean),
+                    "min_backoff_s": config.getfloat(section, "min_backoff_s", fallback=1),
+                    "max_backoff_s": config.getfloat(section, "max_backoff_s", fallback=60),
+                    "high_water": config.getint(section, "high_water", fallback=10000),
+                    "duplicate_slots": (config.getint("duplicates", "slots", fallback=4096)
+                                        if config.getboolean("duplicates", "enabled",
+                                                             fallback=True)
+                                        else 0)}
+
+        if not settings["clean_session"] and not settings["client_id"]:
+            raise ValueError(f"[{section}] clean_session=false needs a client_id")
+
+        patterns = config.get(section, "routes", fallback=None)
+        if patterns:
+            patterns = [_.strip() for _ in patterns.split(",") if _.strip()]
+            unknown = [_ for _ in patterns if _ not in routes]
+            if unknown:
+                raise ValueError(f"[{section}] has routes without a [route:...] section: "
+                                 f"{', '.join(unknown)}")
+        else:
+            patterns = list(routes)
+
+        subscriptions = [(_, routes[_].qos) for _ in patterns]
+        connections.append(BrokerConnection(name, settings, subscriptions, handle))
+
+        logger.info(f"Broker {name} at {settings['host']}:{settings['port']}, "
+                    f"subscribing to {', '.join(patterns)}")
+
+    return connections
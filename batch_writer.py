@@ -0,0 +1,212 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from diagnostics import thread_profiler
+from metrics import metrics, BATCH_SIZE_BUCKETS
+
+""" Contains the BatchWriter, a thread that owns the Storage
+    connection and applies queued database jobs in group commits,
+    so the MQTT network thread never has to wait on the disk.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Placed on the queue to tell the writer to finish up.
+_STOP = object()
+
+
+class WriterError(RuntimeError):
+    """ Raised when submitting to a writer that stopped because
+    its connection couldn't be rolled back after an error.
+    """
+
+
+class BatchWriter(threading.Thread):
+    """ Drain a queue of database jobs, committing many of them
+    in a single transaction.
+    A job is a function and its arguments, and is called as
+    `func(storage, *args)` with the writer's Storage, which
+    shouldn't be used by any other thread until stop() returns.
+    A transaction is committed once `flush_size` jobs have been
+    collected, or `max_flush_latency_s` seconds after the first
+    job of the batch arrived, whichever comes first.
+    If a failed batch can't be rolled back the writer stops, and
+    calls `on_failure(error)`.
+    """
+
+    def __init__(self, storage, flush_size=500, max_flush_latency_s=1.0, on_failure=None):
+
+        super().__init__(name="sqlite-writer", daemon=True)
+
+        self.storage = storage
+        self.flush_size = max(1, flush_size)
+        self.max_flush_latency_s = max_flush_latency_s
+        self.queue = queue.Queue()
+        self.on_failure = on_failure
+        # The error that stopped the writer, if it failed
+        self.failure = None
+
+    def _check(self):
+
+        if self.failure is not None:
+            raise WriterError(f"Writer stopped after an error: {self.failure!r}")
+
+        return None
+
+    def submit(self, func, *args, on_commit=None):
+        """ Queue a job to be run with the writer's Storage.
+        `on_commit()` is called once the job has been committed,
+        outside of any transaction, and not if the job or the
+        commit fails.
+        """
+
+        self._check()
+        self.queue.put((func, args, on_commit))
+
+        return None
+
+    def stop(self, timeout=None):
+        """ Ask the writer to commit everything already queued,
+        then wait for the thread to finish.
+        """
+
+        self.queue.put(_STOP)
+        self.join(timeout)
+
+        if self.is_alive():
+            logger.error(f"Writer did not finish within {timeout}s, "
+                         f"{self.queue.qsize()} jobs still queued.")
+
+        return None
+
+    def _next_batch(self):
+        """ Block until at least one job is available, then collect
+        more until the batch is full or the latency limit is hit.
+        Returns the batch and whether a stop was requested.
+        """
+
+        first = self.queue.get()
+        if first is _STOP:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_flush_latency_s
+
+        while len(batch) < self.flush_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    job = self.queue.get(timeout=remaining)
+                else:
+                    job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if job is _STOP:
+                return batch, True
+
+            batch.append(job)
+
+        return batch, False
+
+    def _apply(self, batch):
+        """ Run a batch of jobs inside one transaction. Each job gets
+        its own savepoint, so one bad message only loses itself.
+        """
+
+        failed = 0
+        conn = self.storage.conn
+        after_commit = []
+
+        try:
+            self.storage.begin()
+        except sqlite3.Error:
+            logger.exception(f"Couldn't start a transaction, {len(batch)} jobs lost.")
+            metrics.inc("db_jobs_failed_total", (("job", "begin"),), len(batch))
+            return None
+
+        for func, args, on_commit in batch:
+            conn.execute("SAVEPOINT job")
+            mark = self.storage.rollback_mark()
+            try:
+                func(self.storage, *args)
+            except Exception:
+                logger.exception(f"Writer job {func.__name__} failed, args: {args}")
+                conn.execute("ROLLBACK TO job")
+                self.storage.rolled_back(mark)
+                metrics.inc("db_jobs_failed_total", (("job", func.__name__),))
+                failed += 1
+                # e.g. its spooled message isn't acknowledged,
+                # so it's replayed at the next start.
+                on_commit = None
+            conn.execute("RELEASE job")
+            if on_commit:
+                after_commit.append(on_commit)
+
+        start = time.perf_counter()
+        try:
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            logger.exception(f"Commit failed, {len(batch)} jobs lost.")
+            metrics.inc("db_jobs_failed_total", (("job", "commit"),), len(batch))
+            conn.execute("ROLLBACK")
+            self.storage.rolled_back()
+            return None
+        metrics.observe("commit_seconds", time.perf_counter() - start)
+        self.storage.committed()
+        metrics.observe("batch_size", len(batch), buckets=BATCH_SIZE_BUCKETS)
+
+        logger.debug(f"Committed {len(batch) - failed} jobs, {failed} failed.")
+
+        for on_commit in after_commit:
+            try:
+                on_commit()
+            except Exception:
+                logger.exception(f"After commit callback {on_commit!r} failed")
+
+        return None
+
+    def _recover(self, batch):
+        """ Roll back after _apply() raised, e.g. from a savepoint or
+        rollback, losing the batch. Returns False if the connection
+        is still in a transaction, so can't be used any more.
+        """
+
+        metrics.inc("db_jobs_failed_total", (("job", "batch"),), len(batch))
+
+        conn = self.storage.conn
+        if conn.in_transaction:
+            try:
+                conn.execute("ROLLBACK")
+                self.storage.rolled_back()
+            except sqlite3.Error:
+                logger.exception("Couldn't roll back the failed batch")
+
+        return not conn.in_transaction
+
+    def run(self):
+
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if not batch:
+                continue
+            try:
+                # Only profiled while SIGUSR1 profiling is on
+                thread_profiler.call(self._apply, batch)
+            except Exception as e:
+                logger.exception(f"Writer batch failed, {len(batch)} jobs lost.")
+                if not self._recover(batch):
+                    # submit() raises from now on, so the
+                    # callers stop, rather than queue forever.
+                    self.failure = e
+                    logger.critical(f"Writer stopped, {self.queue.qsize()} jobs not written.")
+                    if self.on_failure:
+                        self.on_failure(e)
+                    return None
+
+        logger.info("Writer thread finished, queue drained.")
+
+        return None
@@ -0,0 +1,153 @@
+import collections
+import logging
+import threading
+from diagnostics import thread_profiler
+from metrics import metrics
+
+""" Coalesces floods of environment readings. Readings are held for
+    a short window, then handed on together, so a sensor publishing
+    several times a second costs one lastUpdates write per window,
+    rather than one per reading. Every held reading is still passed
+    on, so the archive policies see all of them. The number held is
+    bounded, with a choice of what happens when it's reached.
+"""
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ["block", "drop-oldest", "drop-newest"]
+
+
+class Coalescer:
+    """ Holds decoded env readings, and every window_s calls
+    `sink(readings, seqs)` with the readings held since the last
+    call, and the spool sequence numbers of their messages, to be
+    acknowledged once the readings are stored. The sink is called
+    from the coalescer's own thread.
+    At most max_pending readings are held. When full, add() waits
+    for the next flush (block), or the oldest held reading is
+    dropped (drop-oldest), or the new one is (drop-newest). Either
+    way the flush is started early.
+    """
+
+    def __init__(self, sink, window_s=1.0, max_pending=10000, overflow="block"):
+
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {OVERFLOW_POLICIES}, not {overflow}")
+
+        self.sink = sink
+        self.window_s = window_s
+        self.max_pending = max(1, max_pending)
+        self.overflow = overflow
+        self._pending = collections.deque()
+        self._seqs = []
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+
+    def start(self):
+
+        self._thread.start()
+
+        return None
+
+    def pending(self):
+
+        return len(self._pending)
+
+    def add(self, decoded, seq=None):
+        """ Hold a decoded env reading until the next flush """
+
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                self._cond.notify_all()
+                metrics.inc("readings_overflowed_total", (("overflow", self.overflow),))
+
+                if self.overflow == "drop-newest":
+                    # Dropped readings' messages are acknowledged
+                    # too, they've been dealt with.
+                    if seq is not None:
+                        self._seqs.append(seq)
+                    return None
+
+                if self.overflow == "drop-oldest":
+                    self._pending.popleft()
+                else:
+                    # Not acknowledged by the flush it's waiting for
+                    while len(self._pending) >= self.max_pending and not self._stopping:
+                        self._cond.wait()
+
+            if seq is not None:
+                self._seqs.append(seq)
+            self._pending.append(decoded)
+
+        return None
+
+    def flush(self):
+        """ Pass everything held on to the sink now """
+
+        with self._cond:
+            readings = list(self._pending)
+            seqs = self._seqs
+            self._pending.clear()
+            self._seqs = []
+            # Wake anything blocked in add()
+            self._cond.notify_all()
+
+        if not readings and not seqs:
+            return None
+
+        # All but the newest reading of each station's
+        # measure won't be written to lastUpdates.
+        keys = {(_["station_id"], _["measure_type"]) for _ in readings}
+        metrics.inc("readings_coalesced_total", amount=len(readings) - len(keys))
+
+        try:
+            thread_profiler.call(self.sink, readings, seqs)
+        except Exception:
+            logger.exception(f"Storing {len(readings)} coalesced readings failed")
+
+        return None
+
+    def _run(self):
+
+        stopping = False
+        while not stopping:
+            with self._cond:
+                if not self._stopping and len(self._pending) < self.max_pending:
+                    self._cond.wait(self.window_s)
+                stopping = self._stopping
+            self.flush()
+
+        return None
+
+    def stop(self):
+        """ Flush anything still held, and stop the thread """
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        self._thread.join()
+
+        return None
+
+
+def coalescer_from_config(config, sink):
+    """ Create and start a Coalescer from the `[coalesce]` section
+    of a ConfigParser, or return None if it's not enabled.
+    """
+
+    if not config.getboolean("coalesce", "enabled", fallback=False):
+        return None
+
+    coalescer = Coalescer(sink,
+                          window_s=config.getfloat("coalesce", "window_s", fallback=1.0),
+                          max_pending=config.getint("coalesce", "max_pending", fallback=10000),
+                          overflow=config.get("coalesce", "overflow", fallback="block"))
+    coalescer.start()
+    metrics.gauge_function("coalescer_pending", coalescer.pending)
+
+    logger.info(f"Coalescing env readings every {coalescer.window_s}s, holding at most "
+                f"{coalescer.max_pending}, overflow {coalescer.overflow}")
+
+    return coalescer
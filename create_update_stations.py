@@ -111,27 +111,185 @@ def add_or_update_station(abs_db_path,
             
     return None
 
-def stations_from_csv(csv_file_path, restore=False):
-    """ TODO: Add rows from a CSV file into the stations table.
+def _csv_timestamp(value):
+    """ Convert a timestamp from a CSV file, either a UTC epoch
+        number as stored in the DB, or an ISO format string,
+        to a float. Empty strings become None.
+    """
+
+    if value is None or value.strip() == "":
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        return iso_datetime_with_timezone(value.strip()).timestamp()
+
+
+def _csv_bool(value):
+    """ Convert a CSV boolean, as 1/0 or true/false, to a bool,
+        empty strings become None.
+    """
+
+    if value is None or value.strip() == "":
+        return None
+
+    return value.strip().lower() in ("1", "true", "t", "yes", "y")
+
+
+def _overlaps(entries):
+    """ Return a list of descriptions of any overlapping entries
+        in a list of one station's entries, sorted by
+        from_timestamp_utc. Only the last entry may be open ended.
+    """
+
+    problems = []
+
+    for previous, following in zip(entries, entries[1:]):
+        if (previous["to_timestamp_utc"] is None or
+            previous["to_timestamp_utc"] >= following["from_timestamp_utc"]):
+            problems.append(f"{previous['station_id']}: entry from "
+                            f"{previous['from_timestamp_utc']} to "
+                            f"{previous['to_timestamp_utc']} overlaps entry from "
+                            f"{following['from_timestamp_utc']}")
+
+    return problems
+
+
+def stations_from_csv(abs_db_path, csv_file_path, restore=False):
+    """ Add rows from a CSV file into the stations table.
+        The CSV needs a header row with the stations table's column
+        names. Timestamps can be UTC epoch numbers or ISO format
+        strings, empty values are NULL.
+        Adding works like add_or_update_station(): if a station
+        has a current entry in the table, and the file has a later
+        entry for it, the current entry is closed 1 second before
+        the later one starts.
         Setting restore to true will delete any existing
         stations table and replace it with the content of the
-        csv file, including the rowId primary key.
+        csv file, including the rowid primary key, which must be
+        a `rowid` column in the file.
+        No station's entries may overlap in time, otherwise a
+        ValueError is raised and nothing is changed.
+        Everything is written in one transaction.
+        Returns the number of rows added.
     """
    
     abs_csv_file = os.path.abspath(csv_file_path)
 
+    cols = S.stations_table.colnames()
+    timestamp_cols = ["from_timestamp_utc", "to_timestamp_utc"]
+
+    # Stream the file, converting each row as it's read,
+    # and grouping them by station for checking.
+    new_entries = {}
+    row_count = 0
+
     with open(abs_csv_file, "r", newline="") as csvfile:
         reader = csv.DictReader(csvfile)
-        stations = [row for row in reader]
 
-    # This is all text, change the timestamps into floats
-    # and the empty strings to None.
+        # Be forgiving of the case of the header, e.g. rowId
+        fieldnames = {_.strip().lower(): _ for _ in (reader.fieldnames or [])}
+        missing = [_ for _ in cols if _.lower() not in fieldnames]
+        if restore and "rowid" not in fieldnames:
+            missing.append("rowid")
+        if missing:
+            raise ValueError(f"{abs_csv_file} is missing columns: {', '.join(missing)}")
+
+        for line_no, row in enumerate(reader, start=2):
+            entry = {_: row[fieldnames[_.lower()]] for _ in cols}
+
+            for col in cols:
+                if entry[col] is not None and entry[col].strip() == "":
+                    entry[col] = None
+
+            for col in timestamp_cols:
+                entry[col] = _csv_timestamp(entry[col])
 
-    # Is it better to read all the csv data, and then load it
-    # via python and executemany(), or just prepare the file
-    # and instruct SQLite to read directly from the CSV instead?
+            if entry["from_timestamp_utc"] is None:
+                raise ValueError(f"{abs_csv_file} line {line_no}: "
+                                 "from_timestamp_utc is required")
+
+            entry["is_current"] = _csv_bool(entry["is_current"])
+            if entry["is_current"] is None:
+                entry["is_current"] = entry["to_timestamp_utc"] is None
+
+            if restore:
+                entry["rowid"] = int(row[fieldnames["rowid"]])
+
+            new_entries.setdefault(entry["station_id"], []).append(entry)
+            row_count += 1
+
+    conn = sqlite3.connect(abs_db_path, isolation_level=None)
+
+    try:
+        cur = conn.cursor()
+        # Take the write lock before reading the current entries,
+        # so they can't change before we've written.
+        cur.execute("BEGIN IMMEDIATE")
+
+        existing = {}
+        closures = []
+
+        if not restore:
+            res = cur.execute(f"SELECT rowid, {S.stations_table.cols_as_string()} "
+                              f"FROM {S.stations_table.tablename}")
+            for row in res:
+                entry = dict(zip(cols, row[1:]))
+                entry["rowid"] = row[0]
+                existing.setdefault(entry["station_id"], []).append(entry)
+
+        problems = []
+
+        for station_id, entries in new_entries.items():
+            entries.sort(key=lambda _: _["from_timestamp_utc"])
+
+            for current in existing.get(station_id, []):
+                if current["to_timestamp_utc"] is not None:
+                    continue
+                # Close a current entry at the first new entry after it
+                later = [_ for _ in entries
+                         if _["from_timestamp_utc"] > current["from_timestamp_utc"]]
+                if later:
+                    current["to_timestamp_utc"] = later[0]["from_timestamp_utc"] - 1
+                    current["is_current"] = False
+                    closures.append((current["to_timestamp_utc"], False, current["rowid"]))
+
+            combined = sorted(existing.get(station_id, []) + entries,
+                              key=lambda _: _["from_timestamp_utc"])
+            problems += _overlaps(combined)
+
+        if problems:
+            raise ValueError(f"Overlapping station entries in {abs_csv_file}:\n"
+                             + "\n".join(problems))
+
+        rows = [_ for entries in new_entries.values() for _ in entries]
+
+        if restore:
+            cur.execute(f"DELETE FROM {S.stations_table.tablename}")
+            cur.executemany(f"INSERT INTO {S.stations_table.tablename}"
+                            f"(rowid, {S.stations_table.cols_as_string()}) "
+                            f"VALUES(:rowid, {S.stations_table.named_placeholders()})",
+                            rows)
+        else:
+            cur.executemany(f"UPDATE {S.stations_table.tablename} SET "
+                            "to_timestamp_utc = ?, is_current = ? "
+                            "WHERE rowid == ?",
+                            closures)
+            cur.executemany(f"INSERT INTO {S.stations_table.tablename}"
+                            f"({S.stations_table.cols_as_string()}) "
+                            f"VALUES({S.stations_table.named_placeholders()})",
+                            rows)
+
+        cur.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
         
-    return stations
+    return row_count
 
 def main():
     """ Allow command line adding of stations, or adding
@@ -143,9 +301,11 @@ def main():
                                                   "station statuses and "
                                                   "location information."))
     parser.add_argument("station_id",
+                        nargs="?",
                         help=("Unique station ID of a station"
                               " for which to add entry"))
     parser.add_argument("location",
+                        nargs="?",
                         help="Station's location")
     parser.add_argument("-f", "--from_timestamp_utc",
                         help=("UTC time from which the station"
@@ -170,11 +330,28 @@ def main():
                               "not specified location defined "
                               "in `store-mqtt-data.conf` "
                               "is used."))
+    parser.add_argument("-c", "--csv",
+                        help=("Add all the entries in a CSV file, with "
+                              "a header of the stations table's column "
+                              "names, instead of a single station."))
+    parser.add_argument("-r", "--restore",
+                        action="store_true",
+                        help=("With --csv, replace the whole stations "
+                              "table with the file's content, keeping "
+                              "the rowid column from the file. E.g. from "
+                              "a dump made with `sqlite3 -csv -header "
+                              "<db> 'SELECT rowid, * FROM stations'`"))
 
     args = parser.parse_args()
 
+    if args.restore and not args.csv:
+        parser.error("--restore needs --csv")
+
+    if not args.csv and not (args.station_id and args.location):
+        parser.error("station_id and location are required, unless using --csv")
+
     if args.database:
-        db_abs_path = os.path.abspath(args.database)
+        abs_db_path = os.path.abspath(args.database)
     else:
         config = configparser.ConfigParser()
 
@@ -184,6 +361,16 @@ def main():
         db_path = config.get("storage-settings", "db_path", fallback=None)
         abs_db_path = os.path.abspath(db_path)
 
+    # Make sure the DB has the stations table, and
+    # everything else, before writing to it.
+    S.bootstrap_db(abs_db_path, S.all_tables(), S.all_statements())
+
+    if args.csv:
+        added = stations_from_csv(abs_db_path, args.csv, restore=args.restore)
+        print(f"{'Restored' if args.restore else 'Added'} {added} station entries "
+              f"from {args.csv}")
+        return None
+
     if args.to_timestamp_utc:
         current = False
     else:
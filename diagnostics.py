@@ -0,0 +1,248 @@
+import cProfile
+import datetime
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import traceback
+import tracemalloc
+
+""" Diagnostics of the running service, triggered by signals, so
+    a slow down can be looked into without restarting:
+    - SIGUSR1 starts profiling the main thread, where the MQTT
+      callbacks are dispatched, and the writer and coalescer threads,
+      and the next one stops it and writes the stats to the output
+      directory.
+    - SIGUSR2 starts tracing memory allocations, and the next one
+      writes the top allocations, and the growth since the first
+      signal, to the output directory, and stops tracing.
+    - SIGQUIT logs the stack of every thread, and the queue states.
+    Nothing is running between signals, so there's no overhead, and
+    the files are written from a separate thread.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def _file_time():
+
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+class ThreadProfiler:
+    """ A cProfile profiler per thread, as each only sees the thread
+    it's enabled in. The signal handler's thread is profiled from
+    start() to stop(), and other threads' work while it's passed
+    through call(), e.g. the writer's batches.
+    """
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        # Thread name to (profiler, lock), while profiling
+        self._profilers = None
+
+    def start(self):
+
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._profilers = {threading.current_thread().name: (profiler, threading.Lock())}
+        profiler.enable()
+
+        return None
+
+    def call(self, func, *args):
+        """ Return func(*args), profiled in this thread's profiler
+        if profiling has been started.
+        """
+
+        with self._lock:
+            if self._profilers is None:
+                entry = None
+            else:
+                entry = self._profilers.setdefault(threading.current_thread().name,
+                                                   (cProfile.Profile(), threading.Lock()))
+        if entry is None:
+            return func(*args)
+
+        profiler, lock = entry
+        with lock:
+            return profiler.runcall(func, *args)
+
+    def stop(self):
+        """ Stop profiling, from the thread that started it, returns
+        the profilers by thread name, with their locks, which are
+        held by any call() still running.
+        """
+
+        with self._lock:
+            profilers = self._profilers
+            self._profilers = None
+        profilers[threading.current_thread().name][0].disable()
+
+        return profilers
+
+
+# Shared with the threads being profiled
+thread_profiler = ThreadProfiler()
+
+
+class Diagnostics:
+    """ Handles the diagnostic signals, writing files to output_dir.
+    state_func returns a dict of queue lengths and the like, that's
+    logged with the thread stacks.
+    """
+
+    def __init__(self, output_dir, top_n=25, state_func=None):
+
+        self.output_dir = output_dir
+        self.top_n = top_n
+        self.state_func = state_func
+        self.profiling = False
+        self.baseline = None
+
+    def install(self):
+        """ Set the signal handlers, must be called from the main thread """
+
+        signal.signal(signal.SIGUSR1, self.toggle_profile)
+        signal.signal(signal.SIGUSR2, self.toggle_tracemalloc)
+        signal.signal(signal.SIGQUIT, self.log_threads)
+
+        logger.info(f"Diagnostics on SIGUSR1 (profile), SIGUSR2 (memory) and "
+                    f"SIGQUIT (threads), written to {self.output_dir}")
+
+        return None
+
+    def _in_background(self, func, *args):
+
+        threading.Thread(target=func, args=args, name="diagnostics", daemon=True).start()
+
+        return None
+
+    def _path(self, name):
+
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        return os.path.join(self.output_dir, f"{name}-{_file_time()}")
+
+    def toggle_profile(self, signum=None, frame=None):
+        """ Start profiling the threads, or stop and write the stats """
+
+        if not self.profiling:
+            self.profiling = True
+            thread_profiler.start()
+            logger.warning("Profiling started, send SIGUSR1 again to stop.")
+            return None
+
+        self.profiling = False
+        self._in_background(self._write_profile, thread_profiler.stop())
+
+        return None
+
+    def _write_profile(self, profilers):
+
+        path = self._path("profile")
+
+        stats = None
+        for name, (profiler, lock) in profilers.items():
+            # Once any call() still running has finished
+            with lock:
+                profiler.create_stats()
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+
+        try:
+            stats.dump_stats(path + ".prof")
+            with open(path + ".txt", "w") as f:
+                f.write(f"Threads: {', '.join(profilers)}\n")
+                stats.stream = f
+                stats.sort_stats("cumulative").print_stats(self.top_n)
+        except OSError:
+            logger.exception(f"Couldn't write profile to {path}")
+            return None
+
+        logger.warning(f"Profiling stopped, stats written to {path}.prof and .txt")
+
+        return None
+
+    def toggle_tracemalloc(self, signum=None, frame=None):
+        """ Start tracing allocations, or write a snapshot and stop """
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.baseline = tracemalloc.take_snapshot()
+            logger.warning("Tracing memory allocations, send SIGUSR2 again to "
+                           "write a snapshot.")
+            return None
+
+        snapshot = tracemalloc.take_snapshot()
+        baseline = self.baseline
+        self.baseline = None
+        tracemalloc.stop()
+        self._in_background(self._write_snapshot, snapshot, baseline)
+
+        return None
+
+    def _write_snapshot(self, snapshot, baseline):
+
+        path = self._path("memory") + ".txt"
+
+        try:
+            with open(path, "w") as f:
+                f.write(f"Top {self.top_n} allocations by line:\n")
+                for stat in snapshot.statistics("lineno")[:self.top_n]:
+                    f.write(f"{stat}\n")
+
+                f.write(f"\nTop {self.top_n} changes since tracing started:\n")
+                for stat in snapshot.compare_to(baseline, "lineno")[:self.top_n]:
+                    f.write(f"{stat}\n")
+        except OSError:
+            logger.exception(f"Couldn't write memory snapshot to {path}")
+            return None
+
+        logger.warning(f"Memory snapshot written to {path}, tracing stopped.")
+
+        return None
+
+    def log_threads(self, signum=None, frame=None):
+        """ Log every thread's stack, and the queue states """
+
+        names = {_.ident: _.name for _ in threading.enumerate()}
+        lines = []
+
+        for ident, thread_frame in sys._current_frames().items():
+            lines.append(f"Thread {names.get(ident, ident)}:")
+            lines.append("".join(traceback.format_stack(thread_frame)).rstrip())
+
+        if self.state_func:
+            try:
+                state = self.state_func()
+            except Exception:
+                logger.exception("Couldn't get the queue states")
+            else:
+                lines.append("Queues: " + ", ".join(f"{k}={v}" for k, v in state.items()))
+
+        logger.warning("Diagnostics dump\n" + "\n".join(lines))
+
+        return None
+
+
+def diagnostics_from_config(config, state_func=None):
+    """ Install the signal handlers if enabled in the `[diagnostics]`
+    section of a ConfigParser, returns the Diagnostics or None.
+    """
+
+    if not config.getboolean("diagnostics", "enabled", fallback=False):
+        return None
+
+    diagnostics = Diagnostics(os.path.abspath(config.get("diagnostics", "output_dir",
+                                                         fallback="diagnostics")),
+                              top_n=config.getint("diagnostics", "top_n", fallback=25),
+                              state_func=state_func)
+    diagnostics.install()
+
+    return diagnostics
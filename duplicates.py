@@ -0,0 +1,83 @@
+import array
+import logging
+from metrics import metrics
+
+""" Duplicate suppression for QoS 1 subscriptions. A broker resends a
+    QoS 1 message it hasn't had a PUBACK for when the client reconnects
+    to its persistent session, with the dup flag set and the same packet
+    id, even if the message was stored before the connection dropped.
+    A fixed size ring of recent (topic, packet id, payload) keys
+    catches these before the message is spooled or stored, so a
+    retransmit costs a hash and a lookup, and no I/O. Memory use is
+    set by the number of slots, not the number of stations.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class DuplicateFilter:
+    """ Remembers the keys of the last `slots` QoS 1 and 2 messages.
+    is_duplicate() is True for a message with the dup flag set whose
+    key is remembered, any other message is remembered, dropping the
+    oldest key once the ring is full. Packet ids are reused after
+    65535 messages, so slots should be well below that.
+    The ring is only in memory, so messages resent after a restart,
+    of the script or of a worker, aren't caught. Saving it wouldn't
+    be safe, as a message's key could be saved before the message
+    itself is spooled or stored, and its resend would then be lost.
+    """
+
+    def __init__(self, slots=4096):
+
+        self.slots = max(1, slots)
+        self._ring = array.array("q", bytes(8 * self.slots))
+        # key: times it's in the ring
+        self._counts = {}
+        self._next = 0
+        self._filled = 0
+
+    def _remember(self, key):
+
+        if self._filled == self.slots:
+            oldest = self._ring[self._next]
+            if self._counts[oldest] == 1:
+                del self._counts[oldest]
+            else:
+                self._counts[oldest] -= 1
+        else:
+            self._filled += 1
+
+        self._ring[self._next] = key
+        self._next = (self._next + 1) % self.slots
+        self._counts[key] = self._counts.get(key, 0) + 1
+
+        return None
+
+    def is_duplicate(self, msg):
+        """ Check a paho MQTTMessage, remembering it if it's new """
+
+        if not msg.qos:
+            # QoS 0 is never resent, and all have packet id 0
+            return False
+
+        key = hash((msg.topic, msg.mid, msg.payload))
+
+        if msg.dup and key in self._counts:
+            metrics.inc("duplicates_dropped_total")
+            logger.debug(f"Dropped duplicate of message {msg.mid} on {msg.topic}")
+            return True
+
+        self._remember(key)
+
+        return False
+
+
+def duplicate_filter_from_config(config):
+    """ Create a DuplicateFilter from the `[duplicates]` section of a
+    ConfigParser, or return None if it's not enabled.
+    """
+
+    if not config.getboolean("duplicates", "enabled", fallback=True):
+        return None
+
+    return DuplicateFilter(config.getint("duplicates", "slots", fallback=4096))
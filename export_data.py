@@ -0,0 +1,450 @@
+import schemas_and_tables as S
+from create_update_stations import iso_datetime_with_timezone
+from locations import StationIndex
+from partitions import PartitionSet
+from topic_router import router_from_config
+import argparse
+import configparser
+import contextlib
+import csv
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+""" Export archived readings to CSV, NDJSON or Parquet. Rows are read
+    with fetchmany() and written a chunk at a time, so memory use
+    doesn't depend on the length of the range. Each table is read
+    from the main DB and then from any partition files in the range.
+    With a state file, only the rows added since the last export
+    with the same file and filters are exported, for nightly syncs.
+"""
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ["csv", "ndjson", "parquet"]
+
+# Read and written at a time
+CHUNK_SIZE = 5000
+
+
+def table_for(measure):
+    """ Return the archive table and value column for a measure,
+    e.g. `temp` or `gas`, or the name of an archive table.
+    """
+
+    if measure == "gas" or measure == S.gas_table.tablename:
+        return S.gas_table, "volume_l"
+
+    for name, entry in S.env_tables.items():
+        if measure in (name, entry["table"].tablename):
+            return entry["table"], entry["measure"]
+
+    raise ValueError(f"No archive table for {measure}")
+
+
+def read_chunks(conn, schema, table, value_column, start_utc, end_utc,
+                station_ids=None, after_rowid=0, chunk_size=CHUNK_SIZE):
+    """ Yield lists of up to chunk_size `(rowid, timestamp_utc,
+    station_id, value)` rows from one schema's copy of a table.
+    For given station_ids they're in order of station and time, from
+    their index, otherwise in the order they were stored, so either
+    way no sort is needed.
+    """
+
+    condition = "timestamp_utc >= ? AND timestamp_utc <= ? AND rowid > ?"
+    params = [start_utc, end_utc, after_rowid]
+
+    if station_ids is not None:
+        condition += f" AND station_id IN ({', '.join('?' * len(station_ids))})"
+        params += station_ids
+        order = "station_id, timestamp_utc"
+    else:
+        order = "rowid"
+
+    cur = conn.execute(f"SELECT rowid, timestamp_utc, station_id, {value_column} "
+                       f"FROM {schema}.{table.tablename} WHERE {condition} ORDER BY {order}",
+                       params)
+
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+    return None
+
+
+def column_types(table, columns, iso_times=False):
+    """ Return the declared SQLite type of each column exported from
+    table, the location columns' from the stations table.
+    """
+
+    schema = {**S.stations_table.schema, **table.schema}
+    types = [schema[_]["type"] for _ in columns]
+    if iso_times:
+        types[0] = "STRING"
+
+    return types
+
+
+class CsvOutput:
+
+    def __init__(self, f, columns, types=None):
+
+        self.writer = csv.writer(f)
+        self.writer.writerow(columns)
+
+    def write(self, rows):
+
+        self.writer.writerows(rows)
+
+        return None
+
+    def close(self):
+
+        return None
+
+
+class NdjsonOutput:
+
+    def __init__(self, f, columns, types=None):
+
+        self.f = f
+        self.columns = columns
+
+    def write(self, rows):
+
+        self.f.write("".join(json.dumps(dict(zip(self.columns, _))) + "\n" for _ in rows))
+
+        return None
+
+    def close(self):
+
+        return None
+
+
+class ParquetOutput:
+    """ Each chunk is written as a row group, needs pyarrow. The
+    schema is from the columns' declared types, as one inferred from
+    the first chunk has a null type for a column that's all NULL in
+    it, which the later chunks wouldn't match.
+    """
+
+    def __init__(self, f, columns, types):
+
+        if pyarrow is None:
+            raise RuntimeError("Parquet export needs pyarrow, `pip install pyarrow`")
+
+        arrow_types = {"TIMESTAMP": pyarrow.float64(),
+                       "FLOAT": pyarrow.float64(),
+                       "INTEGER": pyarrow.int64(),
+                       "BOOLEAN": pyarrow.bool_(),
+                       "STRING": pyarrow.string()}
+
+        self.columns = columns
+        self.schema = pyarrow.schema([(name, arrow_types[_]) for name, _ in zip(columns, types)])
+        self.writer = None
+        self.f = f
+
+    def write(self, rows):
+
+        data = pyarrow.Table.from_pydict({name: [_[i] for _ in rows]
+                                          for i, name in enumerate(self.columns)},
+                                         schema=self.schema)
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.f, self.schema)
+        self.writer.write_table(data)
+
+        return None
+
+    def close(self):
+
+        if self.writer:
+            self.writer.close()
+
+        return None
+
+
+OUTPUTS = {"csv": CsvOutput,
+           "ndjson": NdjsonOutput,
+           "parquet": ParquetOutput}
+
+
+def load_state(state_path):
+
+    if state_path is None or not os.path.exists(state_path):
+        return {}
+
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def save_state(state_path, state):
+    """ Replace the state file, so it's never left half written """
+
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+    return None
+
+
+def resume_from(conn, schema, table, watermark):
+    """ Return the rowid to export the rows after, and the time to
+    export the rows from, or None, for a source's saved watermark.
+    Rowids aren't stable, VACUUM can renumber them, and restoring a
+    backup, or deleting every row, lets them be used again, so the
+    row at the watermark is checked first. If it's not the same row
+    the rows from its time on are exported instead.
+    """
+
+    if not watermark:
+        return 0, None
+
+    # Saved before the rows were checked
+    if isinstance(watermark, int):
+        return watermark, None
+
+    row = conn.execute(f"SELECT timestamp_utc, station_id FROM {schema}.{table.tablename} "
+                       "WHERE rowid = ?", (watermark["rowid"],)).fetchone()
+    if row == (watermark["timestamp_utc"], watermark["station_id"]):
+        return watermark["rowid"], None
+
+    logger.warning(f"The rowids of {schema}.{table.tablename} have changed since the last "
+                   "export, exporting the rows from its last reading's time instead.")
+
+    return 0, watermark["timestamp_utc"]
+
+
+def export(abs_db_path, measure, f, fmt="csv", start_utc=None, end_utc=None,
+           station_id=None, location=None, sublocation=None, with_location=False,
+           iso_times=False, state_path=None, partition_dir=None, period="month",
+           chunk_size=CHUNK_SIZE):
+    """ Write the archived readings of a measure to the file object
+    f, in fmt, with optional filters, returns the number of rows.
+    Filtering on, or adding, the location uses the stations table
+    to find where each station was at the time of each reading.
+    With a state_path, only rows added since the last export with
+    the same measure and filters are written, and the state saved.
+    """
+
+    table, value_column = table_for(measure)
+    start_utc = 0 if start_utc is None else start_utc
+    end_utc = time.time() if end_utc is None else end_utc
+
+    columns = ["timestamp_utc", "station_id", value_column]
+    if with_location:
+        columns += ["location", "sublocation"]
+
+    state = load_state(state_path)
+    state_key = "|".join([table.tablename, station_id or "", location or "", sublocation or ""])
+    watermarks = state.get(state_key, {})
+
+    conn = sqlite3.connect(f"file:{abs_db_path}?mode=ro", uri=True)
+    output = OUTPUTS[fmt](f, columns, column_types(table, columns, iso_times))
+    exported = 0
+
+    try:
+        station_index = None
+        station_ids = [station_id] if station_id else None
+        if with_location or location or sublocation:
+            station_index = StationIndex()
+            station_index.refresh(conn)
+        if location or sublocation:
+            entries = station_index.intervals(start_utc, end_utc, location, sublocation)
+            station_ids = sorted({_["station_id"] for _ in entries
+                                  if station_id is None or _["station_id"] == station_id})
+
+        partitions = PartitionSet(abs_db_path, partition_dir, period)
+        sources = [("main", abs_db_path)]
+        sources += [(partitions.alias(key), path)
+                    for key, path in partitions.existing(start_utc, end_utc)]
+
+        for schema, path in sources:
+            if schema != "main":
+                conn.execute("ATTACH DATABASE ? AS " + schema, (f"file:{path}?mode=ro",))
+
+            source = os.path.basename(path)
+            watermark = watermarks.get(source)
+            after_rowid, after_utc = resume_from(conn, schema, table, watermark)
+            last = None
+
+            chunks = read_chunks(conn, schema, table, value_column,
+                                 start_utc if after_utc is None else max(start_utc, after_utc),
+                                 end_utc, station_ids, after_rowid, chunk_size)
+            for chunk in chunks:
+                newest = max(chunk, key=lambda _: _[0])
+                if last is None or newest[0] > last[0]:
+                    last = newest
+                rows = []
+                for _, timestamp_utc, row_station, value in chunk:
+                    # The last row exported before
+                    if (after_utc is not None
+                            and (timestamp_utc, row_station) == (after_utc, watermark["station_id"])):
+                        continue
+                    row = [timestamp_utc, row_station, value]
+                    if station_index:
+                        entry = station_index.resolve(row_station, timestamp_utc)
+                        if location and (entry is None or entry["location"] != location):
+                            continue
+                        if sublocation and (entry is None or entry["sublocation"] != sublocation):
+                            continue
+                        if with_location:
+                            row += [entry["location"], entry["sublocation"]] if entry else [None, None]
+                    if iso_times:
+                        row[0] = datetime.datetime.fromtimestamp(timestamp_utc,
+                                                                 datetime.timezone.utc).isoformat()
+                    rows.append(row)
+                if rows:
+                    output.write(rows)
+                    exported += len(rows)
+
+            if last:
+                watermarks[source] = {"rowid": last[0],
+                                      "timestamp_utc": last[1],
+                                      "station_id": last[2]}
+
+            if schema != "main":
+                conn.execute(f"DETACH DATABASE {schema}")
+    finally:
+        output.close()
+        conn.close()
+
+    # Only once everything has been written
+    if state_path:
+        state[state_key] = watermarks
+        save_state(state_path, state)
+
+    logger.info(f"Exported {exported} rows from {table.tablename}")
+
+    return exported
+
+
+def main():
+    """ Export archived readings from the command line """
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s",
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="export_data",
+                                     description=("Export archived readings to "
+                                                  "CSV, NDJSON or Parquet."))
+    parser.add_argument("measure",
+                        help="Measure to export, e.g. temp, humidity or gas")
+    parser.add_argument("-o", "--output",
+                        help=("File to write, default stdout. The format "
+                              "is taken from its extension if not given"))
+    parser.add_argument("-F", "--format", choices=FORMATS,
+                        help="Output format, default csv")
+    parser.add_argument("-f", "--from_timestamp_utc",
+                        help=("Export readings from this time. "
+                              "ISO Format: `YYYY-MM-DDTHH:MM:SS+00:00`"))
+    parser.add_argument("-t", "--to_timestamp_utc",
+                        help="Export readings up to this time, default now")
+    parser.add_argument("-s", "--station_id",
+                        help="Only this station's readings")
+    parser.add_argument("-l", "--location",
+                        help="Only readings taken at this location")
+    parser.add_argument("--sublocation",
+                        help="Only readings taken at this sublocation")
+    parser.add_argument("-L", "--with-location", action="store_true",
+                        help="Add the location and sublocation of each reading")
+    parser.add_argument("--iso-times", action="store_true",
+                        help="Write times as ISO strings, rather than epoch seconds")
+    parser.add_argument("--since-last",
+                        help=("State file remembering what was exported. Only rows "
+                              "added since the last export with the same file, "
+                              "measure and filters are exported"))
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help=f"Rows read and written at a time, default {CHUNK_SIZE}")
+    parser.add_argument("-db", "--database",
+                        help=("Path to Sqlite3 DB to export from. If "
+                              "not specified location defined "
+                              "in `store-mqtt-data.conf` "
+                              "is used."))
+
+    args = parser.parse_args()
+
+    # Also needed for measures added by routes, and the partition settings
+    config = configparser.ConfigParser()
+    config.read(os.path.abspath("store-mqtt-data.conf"))
+    router_from_config(config)
+
+    if args.database:
+        abs_db_path = os.path.abspath(args.database)
+    else:
+        abs_db_path = os.path.abspath(config.get("storage-settings", "db_path", fallback=None))
+
+    fmt = args.format
+    if fmt is None and args.output:
+        extension = os.path.splitext(args.output)[1].lstrip(".").lower()
+        fmt = {"jsonl": "ndjson", "json": "ndjson", "parq": "parquet"}.get(extension, extension)
+    if fmt not in FORMATS:
+        fmt = "csv"
+
+    if fmt == "parquet" and not args.output:
+        parser.error("Parquet needs an --output file")
+
+    if fmt == "parquet" and pyarrow is None:
+        parser.error("Parquet needs pyarrow, `pip install pyarrow`")
+
+    try:
+        table_for(args.measure)
+    except ValueError as e:
+        parser.error(str(e))
+
+    partition_by = config.get("storage-settings", "partition_by", fallback="none")
+
+    options = {"fmt": fmt,
+               "start_utc": (iso_datetime_with_timezone(args.from_timestamp_utc).timestamp()
+                             if args.from_timestamp_utc else None),
+               "end_utc": (iso_datetime_with_timezone(args.to_timestamp_utc).timestamp()
+                           if args.to_timestamp_utc else None),
+               "station_id": args.station_id,
+               "location": args.location,
+               "sublocation": args.sublocation,
+               "with_location": args.with_location,
+               "iso_times": args.iso_times,
+               "state_path": args.since_last,
+               "partition_dir": config.get("storage-settings", "partition_dir", fallback=None),
+               "period": "month" if partition_by == "none" else partition_by,
+               "chunk_size": args.chunk_size}
+
+    if not args.output:
+        export(abs_db_path, args.measure, sys.stdout, **options)
+        return None
+
+    # Written next to the output, and only moved into place
+    # when finished, so a failed export leaves no partial file.
+    tmp_path = args.output + ".tmp"
+    try:
+        if fmt == "parquet":
+            with open(tmp_path, "wb") as f:
+                exported = export(abs_db_path, args.measure, f, **options)
+        else:
+            with open(tmp_path, "w", newline="") as f:
+                exported = export(abs_db_path, args.measure, f, **options)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, args.output)
+
+    print(f"Exported {exported} rows to {args.output}")
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
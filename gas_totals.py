@@ -0,0 +1,278 @@
+import schemas_and_tables as S
+from storage import Storage
+from partitions import has_table, partition_connections, partition_set_from_config
+import argparse
+import configparser
+import datetime
+import logging
+import os
+import sqlite3
+
+""" Maintain the gasTotals table, a running total of the gas used by
+    each station, kept alongside every row of gasUse. Usage rows add
+    their volume to the total, and meter reading rows reset it to the
+    meter's value, so the total follows the meter. The gas used between
+    any two times is then the difference of two indexed lookups, rather
+    than a SUM over gasUse.
+    Run directly to add a meter reading, rebuild the totals, or
+    show the usage over a period.
+"""
+
+logger = logging.getLogger(__name__)
+
+TOTALS = S.gas_totals_table.tablename
+
+_PREVIOUS_TOTAL = (f"SELECT total_l FROM {TOTALS} "
+                   "WHERE station_id == :station_id AND timestamp_utc <= :timestamp_utc "
+                   "ORDER BY timestamp_utc DESC LIMIT 1")
+
+_FIRST_TOTAL_AFTER = (f"SELECT total_l, is_meter_reading FROM {TOTALS} "
+                      "WHERE station_id == :station_id AND timestamp_utc > :timestamp_utc "
+                      "ORDER BY timestamp_utc LIMIT 1")
+
+_INSERT_TOTAL = (f"INSERT INTO {TOTALS}({S.gas_totals_table.cols_as_string()}) "
+                 f"VALUES({S.gas_totals_table.named_placeholders()})")
+
+# Only changes anything if a reading arrives out of order: totals
+# after it, up to the next meter reading, move by its change.
+_SHIFT_LATER_TOTALS = (f"UPDATE {TOTALS} SET total_l = total_l + :delta "
+                       "WHERE station_id == :station_id "
+                       "AND timestamp_utc > :timestamp_utc "
+                       "AND timestamp_utc < COALESCE("
+                       f"(SELECT MIN(timestamp_utc) FROM {TOTALS} "
+                       "WHERE station_id == :station_id AND is_meter_reading "
+                       "AND timestamp_utc > :timestamp_utc), 1e18)")
+
+
+def add_gas_reading(storage, decoded):
+    """ Add the running total for a gas reading just archived """
+
+    conn = storage.conn
+    previous = conn.execute(_PREVIOUS_TOTAL, decoded).fetchone()
+    previous = previous[0] if previous else 0
+
+    if decoded["is_meter_reading"]:
+        total = decoded["volume_l"]
+    else:
+        total = previous + decoded["volume_l"]
+
+    conn.execute(_INSERT_TOTAL, {"station_id": decoded["station_id"],
+                                 "timestamp_utc": decoded["timestamp_utc"],
+                                 "total_l": total,
+                                 "is_meter_reading": decoded["is_meter_reading"]})
+
+    conn.execute(_SHIFT_LATER_TOTALS, {"delta": total - previous,
+                                       "station_id": decoded["station_id"],
+                                       "timestamp_utc": decoded["timestamp_utc"]})
+
+    return None
+
+
+def total_at(conn, station_id, timestamp_utc):
+    """ Return a station's running total at a time, or None
+    if it has no readings from before then.
+    """
+
+    row = conn.execute(_PREVIOUS_TOTAL, {"station_id": station_id,
+                                         "timestamp_utc": timestamp_utc}).fetchone()
+
+    return row[0] if row else None
+
+
+def usage_between(conn, station_id, start_utc, end_utc):
+    """ Return the litres of gas a station used between two times.
+    If there's a meter reading in between, this includes any
+    correction it made to the total. For a range starting before
+    the station's first reading, usage is counted from its first
+    total in the range, so if that's a meter reading, the meter's
+    value isn't counted as gas used.
+    """
+
+    end_total = total_at(conn, station_id, end_utc)
+    if end_total is None:
+        return 0
+
+    start_total = total_at(conn, station_id, start_utc)
+    if start_total is None:
+        # A first usage reading's total is its own volume, so
+        # counts from 0, a meter reading's is the meter's value.
+        first = conn.execute(_FIRST_TOTAL_AFTER, {"station_id": station_id,
+                                                  "timestamp_utc": start_utc}).fetchone()
+        start_total = first[0] if first[1] else 0
+
+    return end_total - start_total
+
+
+def usage_since_meter_reading(conn, station_id):
+    """ Return (timestamp_utc, litres) of a station's last meter
+    reading, and the gas used since, or None if it has none.
+    """
+
+    meter = conn.execute(f"SELECT timestamp_utc, total_l FROM {TOTALS} "
+                         "WHERE station_id == ? AND is_meter_reading "
+                         "ORDER BY timestamp_utc DESC LIMIT 1",
+                         (station_id,)).fetchone()
+    if meter is None:
+        return None
+
+    latest = conn.execute(f"SELECT total_l FROM {TOTALS} WHERE station_id == ? "
+                          "ORDER BY timestamp_utc DESC LIMIT 1",
+                          (station_id,)).fetchone()
+
+    return meter[0], latest[0] - meter[1]
+
+
+def backfill(conn, gas_table=S.gas_table, partitions=None):
+    """ Rebuild the gasTotals table from gasUse, in one statement.
+    Each meter reading starts a new group, and the total is the
+    cumulative sum within the group, which starts from the
+    meter's value. Runs within the caller's transaction.
+    Given a PartitionSet, the gasUse rows in the main DB and every
+    partition file are first copied into a temporary table, as
+    the totals run across them.
+    """
+
+    source = gas_table.tablename
+    if partitions is not None:
+        source = "temp.gas_rebuild"
+        conn.execute(f"CREATE TEMP TABLE gas_rebuild AS SELECT station_id, timestamp_utc, "
+                     f"volume_l, is_meter_reading FROM main.{gas_table.tablename}")
+        for partition in partition_connections(partitions):
+            if has_table(partition, gas_table.tablename):
+                conn.executemany("INSERT INTO temp.gas_rebuild VALUES(?, ?, ?, ?)",
+                                 partition.execute("SELECT station_id, timestamp_utc, "
+                                                   "volume_l, is_meter_reading "
+                                                   f"FROM {gas_table.tablename}"))
+
+    conn.execute(f"DELETE FROM {TOTALS}")
+    conn.execute(f"INSERT INTO {TOTALS}({S.gas_totals_table.cols_as_string()}) "
+                 "SELECT station_id, timestamp_utc, "
+                 "SUM(volume_l) OVER (PARTITION BY station_id, meter_group "
+                 "ORDER BY timestamp_utc, rowid), is_meter_reading "
+                 "FROM (SELECT rowid, station_id, timestamp_utc, volume_l, "
+                 "COALESCE(is_meter_reading, FALSE) AS is_meter_reading, "
+                 "SUM(COALESCE(is_meter_reading, FALSE)) OVER "
+                 "(PARTITION BY station_id ORDER BY timestamp_utc, rowid) AS meter_group "
+                 f"FROM {source} WHERE timestamp_utc IS NOT NULL)")
+
+    if partitions is not None:
+        conn.execute("DROP TABLE temp.gas_rebuild")
+
+    logger.info(f"Rebuilt {TOTALS} from {gas_table.tablename}")
+
+    return None
+
+
+def _timestamp(iso_string):
+
+    if iso_string is None:
+        return datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+    dt = datetime.datetime.fromisoformat(iso_string)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+
+    return dt.timestamp()
+
+
+def main():
+    """ Add a meter reading, rebuild the totals, or show usage """
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s",
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="gas_totals",
+                                     description=("Add gas meter readings, and "
+                                                  "query or rebuild the running "
+                                                  "totals of gas used."))
+    parser.add_argument("station_id", nargs="?",
+                        help="Station whose meter was read, or to show usage for")
+    parser.add_argument("-m", "--meter-reading", type=int,
+                        help="Add a meter reading of this many litres")
+    parser.add_argument("-f", "--from_timestamp_utc",
+                        help=("Start of the period to show usage for, or the time "
+                              "of the meter reading. Defaults to the last meter "
+                              "reading, or now, respectively. "
+                              "ISO Format: `YYYY-MM-DDTHH:MM:SS+00:00`"))
+    parser.add_argument("-t", "--to_timestamp_utc",
+                        help="End of the period to show usage for, default now")
+    parser.add_argument("-r", "--rebuild", action="store_true",
+                        help="Rebuild all the totals from the gasUse table")
+    parser.add_argument("-db", "--database",
+                        help=("Path to Sqlite3 DB to update. If "
+                              "not specified location defined "
+                              "in `store-mqtt-data.conf` "
+                              "is used."))
+
+    args = parser.parse_args()
+
+    # Also needed for the partition settings
+    config = configparser.ConfigParser()
+
+    config_file_name = "store-mqtt-data.conf"
+    config_abs_path = os.path.abspath(config_file_name)
+    config.read(str(config_abs_path))
+
+    if args.database:
+        abs_db_path = os.path.abspath(args.database)
+    else:
+        db_path = config.get("storage-settings", "db_path", fallback=None)
+        abs_db_path = os.path.abspath(db_path)
+
+    S.bootstrap_db(abs_db_path, S.all_tables(), S.all_statements())
+
+    if args.rebuild:
+        conn = sqlite3.connect(abs_db_path, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            backfill(conn, partitions=partition_set_from_config(config, abs_db_path))
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return None
+
+    if not args.station_id:
+        parser.error("station_id is needed, unless using --rebuild")
+
+    if args.meter_reading is not None:
+        decoded = {"timestamp_utc": _timestamp(args.from_timestamp_utc),
+                   "station_id": args.station_id,
+                   "volume_l": args.meter_reading,
+                   "is_meter_reading": True}
+        storage = Storage(abs_db_path)
+        try:
+            with storage.transaction():
+                storage.insert(S.gas_table, decoded)
+                add_gas_reading(storage, decoded)
+        finally:
+            storage.close()
+        logger.info(f"Added meter reading of {args.meter_reading}l for {args.station_id}")
+        return None
+
+    conn = sqlite3.connect(f"file:{abs_db_path}?mode=ro", uri=True)
+    try:
+        if args.from_timestamp_utc:
+            start = _timestamp(args.from_timestamp_utc)
+            used = usage_between(conn, args.station_id, start,
+                                 _timestamp(args.to_timestamp_utc))
+            print(f"{args.station_id} used {used}l")
+        else:
+            since = usage_since_meter_reading(conn, args.station_id)
+            if since is None:
+                print(f"{args.station_id} has no meter readings")
+            else:
+                read_at = datetime.datetime.fromtimestamp(since[0], datetime.timezone.utc)
+                print(f"{args.station_id} used {since[1]}l since the meter "
+                      f"reading at {read_at.isoformat()}")
+    finally:
+        conn.close()
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
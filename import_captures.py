@@ -0,0 +1,417 @@
+from partitions import period_key
+from spool import read_records
+from state_cache import LastUpdatesCache
+import schemas_and_tables as S
+import argparse
+import base64
+import configparser
+import datetime
+import gzip
+import importlib.util
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+""" Offline import of recorded MQTT traffic, e.g. after migrating
+    devices or an outage, without a broker. Captures are read as a
+    stream, each message is routed and decoded as if it had just
+    arrived, but with the time it was recorded, and the readings are
+    stored by the same functions as store-mqtt-data.py, so the archive
+    policies, rollups, gas totals and lastUpdates all end up as they
+    would have. Messages are stored many thousands to a transaction.
+    Captures can be:
+    - `sub`: `mosquitto_sub -v` output, one `<topic> <payload>` per
+      line, with the time first, e.g. `mosquitto_sub -F "%U %t %p"`
+      (epoch seconds), or `-F "%I %t %p"` (ISO 8601).
+    - `ndjson`: one JSON object per line, with `topic`, `payload`,
+      (or `payload_base64` for binary) and `timestamp_utc`, `time`
+      or `timestamp`, in epoch seconds or ISO 8601.
+    - `spool`: a spool file left by store-mqtt-data.py.
+    Files ending .gz are decompressed as they're read.
+"""
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ["sub", "ndjson", "spool"]
+
+# Messages decoded and stored in each transaction
+BATCH_SIZE = 20000
+
+TIME_KEYS = ("timestamp_utc", "time", "timestamp")
+
+
+def load_store_mqtt_data():
+    """ Import store-mqtt-data.py, which can't be imported
+    normally because of the dashes in its name.
+    """
+
+    spec = importlib.util.spec_from_file_location("store_mqtt_data",
+                                                  Path(__file__).parent / "store-mqtt-data.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def parse_time(value):
+    """ Return epoch seconds from a number, or a string of one or of
+    an ISO 8601 time (UTC if it has no timezone), or None.
+    """
+
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        dt = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+
+    return dt.timestamp()
+
+
+def _open(path, mode):
+
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + ("t" if mode == "r" else ""))
+
+    return open(path, mode)
+
+
+def read_sub(f, undated_time=None):
+    """ Yield (timestamp_utc, topic, payload) from mosquitto_sub
+    output. Lines without a time of their own get undated_time,
+    or are skipped if it's None.
+    """
+
+    for line in f:
+        line = line.rstrip("\n")
+        if not line:
+            continue
+
+        first, _, rest = line.partition(" ")
+        timestamp_utc = parse_time(first)
+        if timestamp_utc is None:
+            timestamp_utc = undated_time
+            rest = line
+            if timestamp_utc is None:
+                yield None, None, None
+                continue
+
+        topic, _, payload = rest.partition(" ")
+        yield timestamp_utc, topic, payload.encode()
+
+    return None
+
+
+def read_ndjson(f, undated_time=None):
+    """ Yield (timestamp_utc, topic, payload) from JSON lines """
+
+    for line in f:
+        if not line.strip():
+            continue
+
+        try:
+            record = json.loads(line)
+            topic = record["topic"]
+        except (ValueError, KeyError, TypeError):
+            yield None, None, None
+            continue
+
+        timestamp_utc = next((parse_time(record[_]) for _ in TIME_KEYS if _ in record),
+                             undated_time)
+
+        if "payload_base64" in record:
+            payload = base64.b64decode(record["payload_base64"])
+        elif isinstance(record.get("payload"), str):
+            payload = record["payload"].encode()
+        else:
+            payload = json.dumps(record.get("payload")).encode()
+
+        yield timestamp_utc, topic, payload
+
+    return None
+
+
+def read_capture(path, fmt, undated_time=None):
+    """ Yield (timestamp_utc, topic, payload) from a capture file,
+    or (None, None, None) for anything that can't be read.
+    """
+
+    if fmt == "spool":
+        with _open(path, "rb") as f:
+            yield from read_records(f)
+        return None
+
+    with _open(path, "r") as f:
+        if fmt == "ndjson":
+            yield from read_ndjson(f, undated_time)
+        else:
+            yield from read_sub(f, undated_time)
+
+    return None
+
+
+def format_for(path):
+    """ Guess a capture's format from its file name """
+
+    name = path[:-3] if path.endswith(".gz") else path
+    extension = os.path.splitext(name)[1].lstrip(".").lower()
+
+    return {"ndjson": "ndjson", "jsonl": "ndjson", "json": "ndjson",
+            "spool": "spool"}.get(extension, "sub")
+
+
+class Importer:
+    """ Stores captured messages through the callbacks' userdata,
+    from store-mqtt-data.py's setup_storage(), a batch at a time.
+    With backfill, for captures older than what's stored, the
+    archive policies start afresh from the capture's first reading,
+    rather than carrying on from lastUpdates, and lastUpdates rows
+    are only replaced by newer readings.
+    """
+
+    def __init__(self, smd, userdata, backfill=False):
+
+        self.smd = smd
+        self.userdata = userdata
+        self.storage = userdata["storage"]
+        self.last_updates = userdata["last_updates"]
+        self.policy_updates = self.last_updates
+        if backfill:
+            # Never flushed, merged into last_updates by finish()
+            self.policy_updates = LastUpdatesCache(S.last_update_table,
+                                                   flush_interval_s=float("inf"))
+        self.counts = {"messages": 0, "unreadable": 0, "unrouted": 0,
+                       "undecodable": 0, "readings": 0}
+
+    def decode(self, messages):
+        """ Return the env and gas readings decoded from a list of
+        (timestamp_utc, topic, payload) messages.
+        """
+
+        router = self.userdata["router"]
+        env = []
+        gas = []
+
+        for timestamp_utc, topic, payload in messages:
+            self.counts["messages"] += 1
+            if timestamp_utc is None:
+                self.counts["unreadable"] += 1
+                continue
+
+            match = router.match(topic)
+            if match is None:
+                self.counts["unrouted"] += 1
+                continue
+
+            route, station_id = match
+            try:
+                decoded = route.decode(station_id, payload, timestamp_utc)
+            except ValueError:
+                self.counts["undecodable"] += 1
+                continue
+
+            if route.kind == "gas":
+                gas.append(decoded)
+            elif route.kind == "batch":
+                env.extend(decoded)
+            else:
+                env.append(decoded)
+
+        self.counts["readings"] += len(env) + len(gas)
+
+        return env, gas
+
+    def _groups(self, env, gas):
+        """ Yield (env, gas) readings per partition, in time order,
+        or all together if the archive isn't partitioned.
+        """
+
+        if not hasattr(self.storage, "attach_range"):
+            yield env, gas
+            return None
+
+        period = self.storage.partitions.period
+        groups = {}
+        for kind, readings in ((0, env), (1, gas)):
+            for decoded in readings:
+                key = period_key(decoded["timestamp_utc"], period)
+                groups.setdefault(key, ([], []))[kind].append(decoded)
+
+        for key in sorted(groups):
+            yield groups[key]
+
+        return None
+
+    def store(self, env, gas):
+        """ Store decoded readings, one transaction per partition """
+
+        for env_group, gas_group in self._groups(env, gas):
+            # Partitions stay unsealed until finish(), in case a later
+            # batch or file has more readings for them.
+            if hasattr(self.storage, "attach_range"):
+                times = [_["timestamp_utc"] for _ in env_group + gas_group]
+                self.storage.attach_range(min(times), max(times))
+
+            with self.storage.transaction():
+                if env_group:
+                    self.smd.update_env_batch(self.storage,
+                                              env_group,
+                                              self.userdata["archive_policies"],
+                                              self.userdata["env_tables"],
+                                              self.policy_updates)
+                # In time order, so each running total is added on the end
+                for decoded in sorted(gas_group, key=lambda _: _["timestamp_utc"]):
+                    self.smd.archive_gas_reading(self.storage, decoded,
+                                                 self.userdata["gas_table"])
+                self.last_updates.flush(self.storage, force=True)
+
+        return None
+
+    def finish(self):
+        """ Write back lastUpdates, keeping the newest of what was
+        stored and what was imported, and seal the partitions that
+        were imported into, if their grace period has passed.
+        """
+
+        if self.policy_updates is not self.last_updates:
+            for key, row in self.policy_updates.entries.items():
+                current = self.last_updates.get(*key)
+                if current is None or current["timestamp_utc"] is None or \
+                   row["timestamp_utc"] > current["timestamp_utc"]:
+                    self.last_updates.record(row)
+
+        if hasattr(self.storage, "release_range"):
+            self.storage.release_range()
+
+        with self.storage.transaction():
+            self.last_updates.flush(self.storage, force=True)
+
+        # Update the query planner's statistics after a large import
+        self.storage.conn.execute("PRAGMA optimize")
+
+        return None
+
+
+def import_captures(abs_db_path, paths, fmt=None, config=None, undated_time=None,
+                    backfill=False, batch_size=BATCH_SIZE):
+    """ Import capture files into the DB at abs_db_path, using the
+    routes, archive policies and storage settings of config, and
+    return the Importer's counts.
+    """
+
+    smd = load_store_mqtt_data()
+    config = config or configparser.ConfigParser()
+
+    # The import does its own batching, and nothing else is needed
+    settings = {"storage-settings": {"write_behind": "false",
+                                     "last_updates_flush_s": "inf"},
+                "spool": {"enabled": "false"},
+                "coalesce": {"enabled": "false"},
+                "query": {"enabled": "false"}}
+    for section, options in settings.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for option, value in options.items():
+            config.set(section, option, value)
+
+    userdata = smd.setup_storage(config, abs_db_path, [])
+    importer = Importer(smd, userdata, backfill)
+    start = time.perf_counter()
+
+    try:
+        for path in paths:
+            messages = read_capture(path, fmt or format_for(path), undated_time)
+            batch = []
+            for message in messages:
+                batch.append(message)
+                if len(batch) >= batch_size:
+                    importer.store(*importer.decode(batch))
+                    batch = []
+                    elapsed = time.perf_counter() - start
+                    logger.info(f"{importer.counts['messages']} messages imported, "
+                                f"{importer.counts['messages'] / elapsed:.0f}/s")
+            importer.store(*importer.decode(batch))
+        importer.finish()
+    finally:
+        smd.shutdown_storage(userdata)
+
+    counts = importer.counts
+    counts["elapsed_s"] = time.perf_counter() - start
+
+    return counts
+
+
+def main():
+    """ Import captures from the command line """
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s",
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="import_captures",
+                                     description=("Import recorded MQTT messages into "
+                                                  "the DB, as if they'd been received "
+                                                  "when they were recorded."))
+    parser.add_argument("captures", nargs="+",
+                        help="Capture files, in the order they were recorded")
+    parser.add_argument("-F", "--format", choices=FORMATS,
+                        help=("Capture format, taken from each file's extension if "
+                              "not given: .ndjson/.jsonl, .spool, otherwise sub"))
+    parser.add_argument("--undated-time",
+                        help=("Time for messages without one, e.g. from plain "
+                              "`mosquitto_sub -v`, otherwise they're skipped. "
+                              "ISO Format: `YYYY-MM-DDTHH:MM:SS+00:00`"))
+    parser.add_argument("--backfill", action="store_true",
+                        help=("The captures are older than readings already stored, "
+                              "e.g. from an outage. Archive policies start afresh, "
+                              "and lastUpdates keeps the newest readings"))
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help=f"Messages stored per transaction, default {BATCH_SIZE}")
+    parser.add_argument("-db", "--database",
+                        help=("Path to Sqlite3 DB to import into. If "
+                              "not specified location defined "
+                              "in `store-mqtt-data.conf` "
+                              "is used."))
+
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(os.path.abspath("store-mqtt-data.conf"))
+
+    if args.database:
+        abs_db_path = os.path.abspath(args.database)
+    else:
+        abs_db_path = os.path.abspath(config.get("storage-settings", "db_path", fallback=None))
+
+    undated_time = None
+    if args.undated_time:
+        undated_time = parse_time(args.undated_time)
+        if undated_time is None:
+            parser.error(f"Can't read --undated-time {args.undated_time}")
+
+    for path in args.captures:
+        if not os.path.exists(path):
+            parser.error(f"No such capture file {path}")
+
+    counts = import_captures(abs_db_path, args.captures, args.format, config,
+                             undated_time, args.backfill, max(1, args.batch_size))
+
+    print(f"Imported {counts['messages']} messages in {counts['elapsed_s']:.1f}s, "
+          f"{counts['readings']} readings. Skipped {counts['unreadable']} unreadable, "
+          f"{counts['unrouted']} unrouted and {counts['undecodable']} undecodable.")
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import schemas_and_tables as S
+import bisect
+import heapq
+import logging
+
+""" Resolve which location a station was at for a given time, using
+    the history in the stations table, and query archived readings
+    tagged with their location.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class StationIndex:
+    """ In-memory interval index over the stations table.
+    For each station the entries are kept sorted by
+    from_timestamp_utc, so finding the entry covering a time is a
+    binary search. The index reloads itself when the stationsVersion
+    counter, increased by triggers on every change to the stations
+    table, no longer matches the version it was loaded at.
+    """
+
+    def __init__(self):
+
+        self.version = None
+        # station_id: list of from_timestamp_utc, and matching
+        # list of station entry dicts.
+        self._starts = {}
+        self._entries = {}
+
+    def refresh(self, conn):
+        """ Reload the index from the stations table if it
+        has changed since it was last loaded. Costs a single
+        one-row read if nothing has changed.
+        """
+
+        res = conn.execute(f"SELECT version FROM {S.stations_version_table.tablename} "
+                           "WHERE id == 1")
+        row = res.fetchone()
+        version = row[0] if row else None
+
+        if version is not None and version == self.version:
+            return None
+
+        cols = S.stations_table.colnames()
+        res = conn.execute(f"SELECT rowid, {S.stations_table.cols_as_string()} "
+                           f"FROM {S.stations_table.tablename} "
+                           "WHERE from_timestamp_utc IS NOT NULL "
+                           "ORDER BY station_id, from_timestamp_utc")
+
+        starts = {}
+        entries = {}
+        for row in res:
+            entry = dict(zip(cols, row[1:]))
+            entry["rowid"] = row[0]
+            starts.setdefault(entry["station_id"], []).append(entry["from_timestamp_utc"])
+            entries.setdefault(entry["station_id"], []).append(entry)
+
+        self._starts = starts
+        self._entries = entries
+        self.version = version
+
+        logger.debug(f"Loaded {sum(len(_) for _ in entries.values())} station entries "
+                     f"at version {version}")
+
+        return None
+
+    def invalidate(self):
+        """ Force a reload on the next refresh() """
+
+        self.version = None
+
+        return None
+
+    def resolve(self, station_id, timestamp_utc):
+        """ Return the station entry covering timestamp_utc,
+        or None if there isn't one.
+        """
+
+        starts = self._starts.get(station_id)
+        if not starts:
+            return None
+
+        i = bisect.bisect_right(starts, timestamp_utc) - 1
+        if i < 0:
+            return None
+
+        entry = self._entries[station_id][i]
+        if entry["to_timestamp_utc"] is not None and timestamp_utc > entry["to_timestamp_utc"]:
+            return None
+
+        return entry
+
+    def intervals(self, start_utc, end_utc, location=None, sublocation=None):
+        """ Return the station entries whose time at their location
+        overlaps start_utc to end_utc, optionally only those at
+        a location and sublocation.
+        """
+
+        found = []
+
+        for station_id, entries in self._entries.items():
+            # Entries starting after the end can't overlap.
+            last = bisect.bisect_right(self._starts[station_id], end_utc)
+            for entry in entries[:last]:
+                if entry["to_timestamp_utc"] is not None and entry["to_timestamp_utc"] < start_utc:
+                    continue
+                if location is not None and entry["location"] != location:
+                    continue
+                if sublocation is not None and entry["sublocation"] != sublocation:
+                    continue
+                found.append(entry)
+
+        return found
+
+
+def readings_with_location(conn,
+                           archive_table,
+                           value_column,
+                           start_utc,
+                           end_utc,
+                           location=None,
+                           sublocation=None,
+                           station_index=None):
+    """ Yield readings between start_utc and end_utc (inclusive) from
+    an archive table, as tuples of
+    `(timestamp_utc, station_id, location, sublocation, value)`
+    in time order, optionally only for one location and sublocation.
+    Only readings from stations with an entry in the stations table
+    covering their time are returned.
+    Each station's time at a location is read with its own indexed
+    range query, and the results merged, so the cost depends on the
+    rows returned, not the size of the tables.
+    Pass a StationIndex to reuse it between calls.
+    """
+
+    if station_index is None:
+        station_index = StationIndex()
+    station_index.refresh(conn)
+
+    query = (f"SELECT timestamp_utc, {value_column} FROM {archive_table.tablename} "
+             "WHERE station_id == ? AND timestamp_utc >= ? AND timestamp_utc <= ? "
+             "ORDER BY timestamp_utc")
+
+    def tagged(entry):
+        """ Readings for one station entry, clipped to the requested range """
+
+        from_utc = max(start_utc, entry["from_timestamp_utc"])
+        to_utc = end_utc
+        if entry["to_timestamp_utc"] is not None:
+            to_utc = min(end_utc, entry["to_timestamp_utc"])
+
+        cur = conn.execute(query, (entry["station_id"], from_utc, to_utc))
+        for timestamp_utc, value in cur:
+            yield (timestamp_utc, entry["station_id"],
+                   entry["location"], entry["sublocation"], value)
+
+    entries = station_index.intervals(start_utc, end_utc, location, sublocation)
+
+    yield from heapq.merge(*[tagged(_) for _ in entries], key=lambda _: _[0])
+
+
+def env_readings_with_location(conn, measure, start_utc, end_utc, **kwargs):
+    """ readings_with_location() for an environment measure,
+    using the same keys as S.env_tables, e.g. `temp`.
+    """
+
+    return readings_with_location(conn,
+                                  S.env_tables[measure]["table"],
+                                  S.env_tables[measure]["measure"],
+                                  start_utc,
+                                  end_utc,
+                                  **kwargs)
+
+
+def gas_readings_with_location(conn, start_utc, end_utc, **kwargs):
+    """ readings_with_location() for gas use, returning volume_l """
+
+    return readings_with_location(conn,
+                                  S.gas_table,
+                                  "volume_l",
+                                  start_utc,
+                                  end_utc,
+                                  **kwargs)
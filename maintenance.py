@@ -0,0 +1,374 @@
+import schemas_and_tables as S
+from metrics import metrics
+from partitions import partition_set_from_config, period_bounds
+from topic_router import router_from_config
+import argparse
+import configparser
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+""" Retention for the archive tables. Rows older than each table's
+    retention period are deleted in small chunks, each in its own
+    short transaction, sized so the write lock is never held for
+    longer than a budget, with a pause between them for the ingest
+    to get in. The freed pages are then given back to the file system
+    a few at a time with auto_vacuum=INCREMENTAL. The rollups and gas
+    totals are never deleted, so hourly and daily values are kept
+    after the readings they came from have gone.
+    Runs as a background thread of store-mqtt-data.py, or once when
+    run directly, e.g. from cron.
+"""
+
+logger = logging.getLogger(__name__)
+
+# PRAGMA auto_vacuum value for INCREMENTAL
+INCREMENTAL = 2
+
+
+class Maintenance:
+    """ Enforces retention, a dict of archive table objects to the
+    number of seconds to keep their rows, on the DB at abs_db_path,
+    using its own connection. Every interval_s, or on run_once(),
+    old rows are deleted in chunks of chunk_rows, and freed pages
+    given back vacuum_pages at a time. Both sizes adapt so each
+    transaction holds the write lock for at most about budget_s,
+    with pause_s between them.
+    With a PartitionSet, partition files are deleted whole, once
+    every archive table's retention has passed the end of their
+    period and they've been sealed. Rows inside them aren't
+    deleted, so are kept for the longest retention.
+    """
+
+    def __init__(self, abs_db_path, retention, interval_s=3600, budget_s=0.05,
+                 pause_s=0.2, chunk_rows=500, vacuum_pages=100, busy_timeout_s=5.0,
+                 partitions=None):
+
+        self.abs_db_path = abs_db_path
+        self.retention = retention
+        self.interval_s = interval_s
+        self.budget_s = budget_s
+        self.pause_s = pause_s
+        self.chunk_rows = max(1, chunk_rows)
+        self.vacuum_pages = max(1, vacuum_pages)
+        self.busy_timeout_s = busy_timeout_s
+        self.partitions = partitions
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _adapt(self, size, elapsed_s):
+        """ Return the next chunk size, from the last one and how
+        long it held the lock for.
+        """
+
+        # Aim a little under the budget, and grow slowly,
+        # as the time per row varies.
+        if elapsed_s > self.budget_s * 0.8:
+            return max(1, int(size * self.budget_s * 0.7 / elapsed_s))
+        if elapsed_s < self.budget_s / 2:
+            return min(int(size * 1.25) + 1, 50000)
+
+        return size
+
+    def _locked(self, conn, statement, params=()):
+        """ Run a statement in its own write transaction, returns the
+        number of rows changed and how long the lock was held.
+        Waiting for the lock, up to busy_timeout_s, isn't counted.
+        """
+
+        conn.execute("BEGIN IMMEDIATE")
+        start = time.perf_counter()
+        try:
+            changed = conn.execute(statement, params).rowcount
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        elapsed_s = time.perf_counter() - start
+
+        metrics.observe("maintenance_lock_seconds", elapsed_s)
+
+        return changed, elapsed_s
+
+    def expire_table(self, conn, table, cutoff_utc):
+        """ Delete a table's rows from before cutoff_utc, in chunks,
+        returns how many were deleted. Rows are mostly stored in time
+        order, so they're read in rowid order from the start, which is
+        a seek, and the deleting stops at the first row that's newer,
+        rather than scanning every row left in the table. A row stored
+        late, with an older time than rows before it, is deleted once
+        those rows have expired too.
+        """
+
+        deleted = 0
+        last_rowid = 0
+
+        while not self._stop.is_set():
+            # Found outside the transaction, so reading
+            # them doesn't hold the lock.
+            rows = conn.execute(f"SELECT rowid, timestamp_utc FROM {table.tablename} "
+                                "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                (last_rowid, self.chunk_rows)).fetchall()
+
+            expired = []
+            for rowid, timestamp_utc in rows:
+                if timestamp_utc is not None and timestamp_utc >= cutoff_utc:
+                    break
+                expired.append(rowid)
+            if not expired:
+                break
+
+            changed, elapsed_s = self._locked(conn,
+                                              f"DELETE FROM {table.tablename} "
+                                              "WHERE rowid >= ? AND rowid <= ? "
+                                              "AND timestamp_utc < ?",
+                                              (expired[0], expired[-1], cutoff_utc))
+            deleted += changed
+            metrics.inc("rows_expired_total", (("table", table.tablename),), changed)
+            self.chunk_rows = self._adapt(self.chunk_rows, elapsed_s)
+            last_rowid = expired[-1]
+
+            if len(expired) < len(rows):
+                # Reached the rows to keep
+                break
+
+            self._stop.wait(self.pause_s)
+
+        if deleted:
+            logger.info(f"Deleted {deleted} rows from {table.tablename} older than "
+                        f"{time.strftime('%Y-%m-%d %H:%M', time.gmtime(cutoff_utc))} UTC")
+
+        return deleted
+
+    def drop_partitions(self, now):
+        """ Delete the partition files whose whole period has
+        passed every archive table's retention.
+        """
+
+        if len(self.retention) < len(S.archive_tables()):
+            # Something in every partition is kept forever
+            return None
+
+        cutoff_utc = now - max(self.retention.values())
+
+        for key, path in self.partitions.existing(0, cutoff_utc):
+            if period_bounds(key)[1] > cutoff_utc:
+                continue
+            if not self.partitions.is_sealed(key):
+                logger.warning(f"Partition {path} has expired, but isn't sealed yet.")
+                continue
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            logger.info(f"Deleted expired partition {path}")
+
+        return None
+
+    def vacuum(self, conn):
+        """ Give free pages back to the file system, a few at a time """
+
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != INCREMENTAL:
+            logger.debug(f"{self.abs_db_path} doesn't have auto_vacuum=INCREMENTAL, "
+                         "freed pages are reused, but the file won't shrink.")
+            return None
+
+        freed = 0
+        while not self._stop.is_set():
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free_pages:
+                break
+
+            # incremental_vacuum frees one page per step, and
+            # only executescript() steps it to the end.
+            start = time.perf_counter()
+            conn.executescript(f"BEGIN IMMEDIATE; "
+                               f"PRAGMA incremental_vacuum({self.vacuum_pages}); COMMIT;")
+            elapsed_s = time.perf_counter() - start
+            metrics.observe("maintenance_lock_seconds", elapsed_s)
+
+            freed += min(free_pages, self.vacuum_pages)
+            self.vacuum_pages = self._adapt(self.vacuum_pages, elapsed_s)
+
+            self._stop.wait(self.pause_s)
+
+        if freed:
+            logger.info(f"Gave back {freed} free pages of {self.abs_db_path}")
+
+        return None
+
+    def run_once(self):
+        """ Delete everything past its retention, then vacuum """
+
+        now = time.time()
+        conn = sqlite3.connect(self.abs_db_path,
+                               timeout=self.busy_timeout_s,
+                               isolation_level=None)
+        try:
+            for table, keep_s in self.retention.items():
+                self.expire_table(conn, table, now - keep_s)
+
+            if self.partitions:
+                self.drop_partitions(now)
+
+            self.vacuum(conn)
+        finally:
+            conn.close()
+
+        return None
+
+    def _run(self):
+
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except (sqlite3.Error, OSError):
+                logger.exception("Maintenance failed, will try again.")
+            self._stop.wait(self.interval_s)
+
+        return None
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+        self._thread.start()
+
+        return None
+
+    def stop(self):
+        """ Stop after the current chunk """
+
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+        return None
+
+
+def retention_from_config(config):
+    """ Return the retention, by table object, from the days set per
+    measure (e.g. `temp`, `gas`) in the `[retention]` section of a
+    ConfigParser, or default. 0 or unset keeps rows forever.
+    """
+
+    default_days = config.getfloat("retention", "default", fallback=0)
+
+    measures = {_: S.env_tables[_]["table"] for _ in S.env_tables}
+    measures["gas"] = S.gas_table
+
+    retention = {}
+    for measure, table in measures.items():
+        days = config.getfloat("retention", measure, fallback=default_days)
+        if days > 0:
+            retention[table] = days * 86400
+
+    return retention
+
+
+def maintenance_from_config(config, abs_db_path, start=True):
+    """ Create a Maintenance from the `[retention]` section of a
+    ConfigParser, and start its thread if start is True, or
+    return None if retention isn't enabled.
+    """
+
+    if not config.getboolean("retention", "enabled", fallback=False):
+        return None
+
+    section = "retention"
+    partitions = partition_set_from_config(config, abs_db_path)
+
+    retention = retention_from_config(config)
+    for table, keep_s in retention.items():
+        logger.info(f"Keeping {table.tablename} rows for {keep_s / 86400:g} days")
+
+    # Partition files are only ever deleted whole, so every
+    # table in them is kept for the longest retention.
+    kept_forever = len(retention) < len(S.archive_tables())
+    if partitions and retention and (kept_forever or len(set(retention.values())) > 1):
+        longest = "forever" if kept_forever else f"{max(retention.values()) / 86400:g} days"
+        logger.warning(f"Retention differs between the archive tables, but partitioned "
+                       f"readings are all kept for the longest, {longest}.")
+
+    maintenance = Maintenance(abs_db_path,
+                              retention,
+                              interval_s=config.getfloat(section, "interval_s", fallback=3600),
+                              budget_s=config.getfloat(section, "budget_ms", fallback=50) / 1000,
+                              pause_s=config.getfloat(section, "pause_ms", fallback=200) / 1000,
+                              chunk_rows=config.getint(section, "chunk_rows", fallback=500),
+                              vacuum_pages=config.getint(section, "vacuum_pages", fallback=100),
+                              busy_timeout_s=config.getfloat("storage-settings",
+                                                             "busy_timeout_s", fallback=5.0),
+                              partitions=partitions)
+    if start:
+        maintenance.start()
+
+    return maintenance
+
+
+def enable_incremental_vacuum(abs_db_path):
+    """ Switch an existing DB to auto_vacuum=INCREMENTAL, which needs
+    a full VACUUM, so locks the DB for as long as that takes.
+    """
+
+    conn = sqlite3.connect(abs_db_path, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == INCREMENTAL:
+            logger.info(f"{abs_db_path} already has auto_vacuum=INCREMENTAL")
+            return None
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        logger.warning(f"Running VACUUM on {abs_db_path}, this can take a while.")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+    return None
+
+
+def main():
+    """ Apply the retention in the config file once """
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s",
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="maintenance",
+                                     description=("Delete archived readings older than "
+                                                  "the [retention] settings, and give "
+                                                  "the space back."))
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help=("Switch a DB created by an older version to "
+                              "auto_vacuum=INCREMENTAL, with a full VACUUM. "
+                              "Stop store-mqtt-data.py first."))
+    parser.add_argument("-db", "--database",
+                        help=("Path to Sqlite3 DB to maintain. If "
+                              "not specified location defined "
+                              "in `store-mqtt-data.conf` "
+                              "is used."))
+
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(os.path.abspath("store-mqtt-data.conf"))
+    # For measures added by routes
+    router_from_config(config)
+
+    if args.database:
+        abs_db_path = os.path.abspath(args.database)
+    else:
+        abs_db_path = os.path.abspath(config.get("storage-settings", "db_path", fallback=None))
+
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum(abs_db_path)
+        return None
+
+    maintenance = maintenance_from_config(config, abs_db_path, start=False)
+    if maintenance is None:
+        parser.error("Set enabled=true in the [retention] section of store-mqtt-data.conf")
+
+    maintenance.run_once()
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
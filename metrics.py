@@ -0,0 +1,244 @@
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+""" Lightweight counters, histograms and gauges for the ingest path,
+    and a small HTTP server publishing them in the Prometheus text
+    format. Recording a value is a dict update under a lock, so the
+    instrumentation can stay on in production; the server is only
+    started if enabled in the `[metrics]` section of the config.
+"""
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "store_mqtt"
+
+# Upper bounds in seconds, from 50us up to 5s.
+LATENCY_BUCKETS_S = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                     0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+BATCH_SIZE_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+class Histogram:
+    """ Counts of observations in fixed buckets, plus their sum """
+
+    def __init__(self, buckets=LATENCY_BUCKETS_S):
+
+        self.buckets = buckets
+        # One count per bucket, plus the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+        return None
+
+
+class Metrics:
+    """ Registry of all the metrics. Each metric name can have any
+    number of label sets, given as a tuple of (label, value) pairs.
+    """
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauge_functions = {}
+        self._last_seen = {}
+        self._help = {}
+
+    def describe(self, name, help_text):
+        """ Set the HELP text shown for a metric """
+
+        self._help[name] = help_text
+
+        return None
+
+    def inc(self, name, labels=(), amount=1):
+        """ Increase a counter """
+
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+        return None
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS_S):
+        """ Add an observation, usually a duration in seconds,
+        to a histogram. The buckets are fixed by the first one.
+        """
+
+        key = (name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+        return None
+
+    def gauge_function(self, name, func, labels=()):
+        """ Register a function returning a gauge's current value,
+        called each time the metrics are rendered.
+        """
+
+        with self._lock:
+            self._gauge_functions[(name, labels)] = func
+
+        return None
+
+    def seen(self, station_id):
+        """ Record that a message was just received from a station """
+
+        self._last_seen[station_id] = time.time()
+
+        return None
+
+    @staticmethod
+    def _labels(labels, extra=()):
+
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+
+        escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                   for k, v in labels]
+
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def render(self):
+        """ Return all the metrics in the Prometheus text format """
+
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: (list(v.counts), v.sum, v.count, v.buckets)
+                          for k, v in self._histograms.items()}
+            gauge_functions = dict(self._gauge_functions)
+
+        lines = []
+        described = set()
+
+        def header(name, metric_type):
+            if name in described:
+                return
+            described.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {PREFIX}_{name} {self._help[name]}")
+            lines.append(f"# TYPE {PREFIX}_{name} {metric_type}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{PREFIX}_{name}{self._labels(labels)} {value}")
+
+        for (name, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + [float("inf")], counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{PREFIX}_{name}_bucket"
+                             f"{self._labels(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{PREFIX}_{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{PREFIX}_{name}_count{self._labels(labels)} {count}")
+
+        for (name, labels), func in sorted(gauge_functions.items()):
+            header(name, "gauge")
+            try:
+                value = func()
+            except Exception:
+                logger.exception(f"Gauge {name} failed")
+                continue
+            lines.append(f"{PREFIX}_{name}{self._labels(labels)} {value}")
+
+        now = time.time()
+        for station_id, seen in sorted(self._last_seen.items()):
+            header("seconds_since_last_message", "gauge")
+            lines.append(f"{PREFIX}_seconds_since_last_message"
+                         f"{self._labels([('station_id', station_id)])} {now - seen:.3f}")
+
+        return "\n".join(lines) + "\n"
+
+
+# The registry used by everything, like a logger.
+metrics = Metrics()
+
+metrics.describe("messages_received_total", "MQTT messages received, per topic family")
+metrics.describe("readings_archived_total", "Readings written to an archive table")
+metrics.describe("readings_skipped_total", "Readings not archived by the archive policy")
+metrics.describe("messages_dropped_total", "Messages that couldn't be decoded or weren't wanted")
+metrics.describe("batch_readings_dropped_total", "Bad readings skipped in batch messages, whose other readings were stored")
+metrics.describe("db_jobs_failed_total", "Readings whose DB work raised an error")
+metrics.describe("decode_seconds", "Time to decode a message")
+metrics.describe("db_seconds", "Time spent in each DB operation, not including the others it does")
+metrics.describe("commit_seconds", "Time to commit a batch of readings")
+metrics.describe("batch_size", "Number of jobs in each committed batch")
+metrics.describe("seconds_since_last_message", "Time since a station last sent a message")
+metrics.describe("readings_coalesced_total", "Env readings superseded in lastUpdates by a newer one in the same window")
+metrics.describe("readings_overflowed_total", "Env readings arriving with the coalescing buffer full")
+metrics.describe("rows_expired_total", "Archived rows deleted by the retention policy")
+metrics.describe("duplicates_dropped_total", "Resent QoS 1 messages dropped as already received")
+metrics.describe("broker_connected", "1 while connected to a [broker:...], otherwise 0")
+metrics.describe("broker_queue_depth", "Messages from a [broker:...] waiting to be decoded")
+metrics.describe("readings_unpartitioned_total", "Archived readings written to the main DB, as their partition wasn't attached")
+metrics.describe("maintenance_lock_seconds", "Time the write lock was held by each maintenance transaction")
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    registry = metrics
+
+    def do_GET(self):
+
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return None
+
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        return None
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood the log
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def start_http_server(host="127.0.0.1", port=9108, registry=metrics):
+    """ Serve the metrics at http://host:port/metrics from a
+    daemon thread. Returns the server, call shutdown() to stop it.
+    """
+
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    return server
+
+
+def metrics_server_from_config(config):
+    """ Start the metrics server if enabled in the `[metrics]`
+    section of a ConfigParser, returns the server or None.
+    """
+
+    if not config.getboolean("metrics", "enabled", fallback=False):
+        return None
+
+    return start_http_server(config.get("metrics", "host", fallback="127.0.0.1"),
+                             config.getint("metrics", "port", fallback=9108))
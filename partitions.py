@@ -0,0 +1,483 @@
+import schemas_and_tables as S
+from storage import Storage, storage_from_config
+from metrics import metrics
+import datetime
+import heapq
+import logging
+import os
+import re
+import sqlite3
+import stat
+import time
+
+""" Optional time partitioning of the archive tables. Archived readings
+    are written into one SQLite3 file per period (month or year), which
+    is ATTACHed to the writer's connection, while lastUpdates, stations
+    and the rollups stay in the main DB. Once a period is over, and a
+    grace period has passed, its file is detached, switched out of WAL
+    mode and made read-only, so it can be backed up or moved once.
+    open_range() and query_range() read across the partitions a time
+    range needs.
+"""
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ["month", "year"]
+
+KEY_PATTERNS = {"month": re.compile(r"\d{4}-\d{2}"),
+                "year": re.compile(r"\d{4}")}
+
+
+def period_key(timestamp_utc, period="month"):
+    """ Return the name of the period a timestamp falls in,
+    e.g. `2024-03` for month, or `2024` for year.
+    """
+
+    dt = datetime.datetime.fromtimestamp(timestamp_utc, datetime.timezone.utc)
+
+    if period == "month":
+        return f"{dt.year:04d}-{dt.month:02d}"
+
+    return f"{dt.year:04d}"
+
+
+def period_bounds(key):
+    """ Return the (start, end) UTC timestamps of a period name,
+    end being the start of the following period.
+    """
+
+    if len(key) == 7:
+        year, month = int(key[:4]), int(key[5:])
+        start = datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
+        if month == 12:
+            end = datetime.datetime(year + 1, 1, 1, tzinfo=datetime.timezone.utc)
+        else:
+            end = datetime.datetime(year, month + 1, 1, tzinfo=datetime.timezone.utc)
+    else:
+        year = int(key)
+        start = datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc)
+        end = datetime.datetime(year + 1, 1, 1, tzinfo=datetime.timezone.utc)
+
+    return start.timestamp(), end.timestamp()
+
+
+def period_keys(start_utc, end_utc, period="month"):
+    """ Return the names of all the periods from start_utc
+    to end_utc, in order.
+    """
+
+    keys = []
+    key = period_key(start_utc, period)
+    last = period_key(end_utc, period)
+
+    while True:
+        keys.append(key)
+        if key == last:
+            return keys
+        key = period_key(period_bounds(key)[1], period)
+
+
+class PartitionSet:
+    """ The partition files for one main DB, named after it, e.g.
+    `<partition_dir>/home-2024-03.sqlite3` for `home.sqlite3`.
+    """
+
+    def __init__(self, abs_db_path, partition_dir=None, period="month"):
+
+        if period not in PERIODS:
+            raise ValueError(f"Partition period must be one of {PERIODS}, not {period}")
+
+        self.stem = os.path.splitext(os.path.basename(abs_db_path))[0]
+        if partition_dir is None:
+            partition_dir = os.path.join(os.path.dirname(abs_db_path),
+                                         f"{self.stem}-partitions")
+        self.partition_dir = os.path.abspath(partition_dir)
+        self.period = period
+
+    def path(self, key):
+
+        return os.path.join(self.partition_dir, f"{self.stem}-{key}.sqlite3")
+
+    @staticmethod
+    def alias(key):
+        """ Schema name the partition is attached as """
+
+        return "p_" + key.replace("-", "_")
+
+    def existing(self, start_utc, end_utc):
+        """ Return (key, path) of the partition files that
+        exist for a time range.
+        """
+
+        return [(_, self.path(_)) for _ in period_keys(start_utc, end_utc, self.period)
+                if os.path.exists(self.path(_))]
+
+    def all(self):
+        """ Return (key, path) of every partition file, in order """
+
+        if not os.path.isdir(self.partition_dir):
+            return []
+
+        prefix = f"{self.stem}-"
+        keys = [_[len(prefix):-len(".sqlite3")] for _ in os.listdir(self.partition_dir)
+                if _.startswith(prefix) and _.endswith(".sqlite3")]
+
+        return [(_, self.path(_)) for _ in sorted(keys)
+                if KEY_PATTERNS[self.period].fullmatch(_)]
+
+    def is_sealed(self, key):
+
+        path = self.path(key)
+
+        # Check the mode rather than os.access(), which is
+        # always True for root.
+        return os.path.exists(path) and not (os.stat(path).st_mode & stat.S_IWUSR)
+
+
+class PartitionedStorage(Storage):
+    """ A Storage that writes the archive tables into time partitions.
+    Before each transaction the partitions for the current period,
+    and for the previous period during its grace period, are attached.
+    Readings with timestamps in any other period are written to the
+    main DB's table instead, as SQLite can't attach a DB within a
+    transaction, and sealed partitions can't be written to.
+    Partitions whose grace period has passed are sealed: detached,
+    switched to rollback journal mode and made read-only.
+    """
+
+    def __init__(self, abs_db_path, partition_dir=None, period="month",
+                 seal_after_days=2, **kwargs):
+
+        super().__init__(abs_db_path, **kwargs)
+
+        self.partitions = PartitionSet(abs_db_path, partition_dir, period)
+        self.seal_after_s = seal_after_days * 86400
+        self.partitioned = {_.tablename: _ for _ in S.archive_tables()}
+        self._storage_kwargs = kwargs
+        self._attached = set()
+        # Attached by attach_range(), kept until release_range()
+        self._pinned = set()
+        # Ever attached by attach_range(), not sealed until release_range()
+        self._held = set()
+        # Periods that have had readings written to the main DB
+        self._unpartitioned = set()
+
+        os.makedirs(self.partitions.partition_dir, exist_ok=True)
+        logger.info(f"Partitioning {list(self.partitioned)} by {period} "
+                    f"into {self.partitions.partition_dir}")
+
+    def attach(self, key):
+        """ Attach a partition, creating it first if needed.
+        Not possible within a transaction.
+        """
+
+        if key in self._attached:
+            return None
+
+        path = self.partitions.path(key)
+        alias = self.partitions.alias(key)
+
+        if self.partitions.is_sealed(key):
+            raise RuntimeError(f"Partition {path} is sealed, it can't be written to")
+
+        S.bootstrap_db(path, list(self.partitioned.values()), migrate=False)
+
+        self.conn.execute("ATTACH DATABASE ? AS " + alias, (path,))
+        self.conn.execute(f"PRAGMA {alias}.journal_mode="
+                          f"{self._storage_kwargs.get('journal_mode', 'WAL')}")
+        self.conn.execute(f"PRAGMA {alias}.synchronous="
+                          f"{self._storage_kwargs.get('synchronous', 'NORMAL')}")
+        self._attached.add(key)
+
+        logger.info(f"Attached partition {path} as {alias}")
+
+        return None
+
+    def detach(self, key):
+
+        if key not in self._attached:
+            return None
+
+        self.conn.execute(f"DETACH DATABASE {self.partitions.alias(key)}")
+        self._attached.discard(key)
+
+        return None
+
+    def seal(self, key):
+        """ Make a finished partition immutable: a single file,
+        with no WAL, that's read-only.
+        """
+
+        self.detach(key)
+
+        path = self.partitions.path(key)
+        if not os.path.exists(path) or self.partitions.is_sealed(key):
+            return None
+
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            conn.close()
+
+        mode = os.stat(path).st_mode
+        os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+        logger.info(f"Sealed partition {path}")
+
+        return None
+
+    def begin(self):
+        """ Attach the partitions that may be written to, and seal
+        any that have just passed their grace period, then start
+        the transaction.
+        """
+
+        now = time.time()
+        wanted = {period_key(now, self.partitions.period),
+                  period_key(now - self.seal_after_s, self.partitions.period)}
+
+        for key in sorted(self._attached - wanted - self._pinned):
+            if period_bounds(key)[1] + self.seal_after_s < now and key not in self._held:
+                self.seal(key)
+            else:
+                self.detach(key)
+
+        for key in sorted(wanted - self._attached):
+            self.attach(key)
+
+        super().begin()
+
+        return None
+
+    def _alias_for(self, timestamp_utc):
+        """ Return the schema name of the partition for a reading, or
+        `main` if its partition isn't attached and can't be now. e.g.
+        a late reading, or one replayed from the spool after an outage.
+        The main DB's tables are read by open_range() and query_range()
+        as well as the partitions, so these readings aren't lost.
+        """
+
+        key = period_key(timestamp_utc, self.partitions.period)
+
+        if key in self._attached:
+            return self.partitions.alias(key)
+
+        if not self.conn.in_transaction and not self.partitions.is_sealed(key):
+            self.attach(key)
+            return self.partitions.alias(key)
+
+        if key not in self._unpartitioned:
+            self._unpartitioned.add(key)
+            logger.warning(f"Readings for partition {key} can't be written to it now, "
+                           "storing them in the main DB instead.")
+        metrics.inc("readings_unpartitioned_total")
+
+        return "main"
+
+    def partitioned_statement(self, table, alias, verb="INSERT"):
+
+        key = (verb, alias, table.tablename)
+
+        if key not in self._statements:
+            self._statements[key] = (f"{verb} INTO {alias}.{table.tablename}"
+                                     f"({table.cols_as_string()}) "
+                                     f"VALUES({table.named_placeholders()})")
+
+        return self._statements[key]
+
+    def insert(self, table, row):
+
+        if table.tablename not in self.partitioned:
+            return super().insert(table, row)
+
+        alias = self._alias_for(row["timestamp_utc"])
+        self.conn.execute(self.partitioned_statement(table, alias), row)
+
+        return None
+
+    def insert_many(self, table, rows):
+
+        if table.tablename not in self.partitioned:
+            return super().insert_many(table, rows)
+
+        by_alias = {}
+        for row in rows:
+            by_alias.setdefault(self._alias_for(row["timestamp_utc"]), []).append(row)
+
+        for alias, alias_rows in by_alias.items():
+            self.conn.executemany(self.partitioned_statement(table, alias), alias_rows)
+
+        return None
+
+    def attach_range(self, start_utc, end_utc):
+        """ Attach every partition from start_utc to end_utc, e.g.
+        before importing old readings, in place of those attached by
+        the last call, and keep them attached until release_range().
+        None of the partitions attached like this are sealed until
+        then, so an import can come back to them. Sealed partitions
+        are skipped, their readings go to the main DB. Not possible
+        within a transaction, and limited by SQLite to 9 at once.
+        """
+
+        keys = period_keys(start_utc, end_utc, self.partitions.period)
+
+        # Detached to make room, but still held
+        for key in sorted(self._pinned - set(keys)):
+            self.detach(key)
+        self._pinned = set()
+
+        for key in keys:
+            if key not in self._attached and self.partitions.is_sealed(key):
+                logger.warning(f"Partition {key} is sealed, its readings will "
+                               "be stored in the main DB.")
+                continue
+            self.attach(key)
+            self._pinned.add(key)
+            self._held.add(key)
+
+        return None
+
+    def release_range(self):
+        """ Let partitions attached by attach_range() be detached,
+        and sealed, as usual at the next transaction, and seal any
+        already detached whose grace period has passed.
+        """
+
+        now = time.time()
+        for key in sorted(self._held - self._attached):
+            if period_bounds(key)[1] + self.seal_after_s < now:
+                self.seal(key)
+
+        self._pinned = set()
+        self._held = set()
+
+        return None
+
+
+def partition_set_from_config(config, abs_db_path):
+    """ Return the PartitionSet for a DB from the `[storage-settings]`
+    section of a ConfigParser, or None if it isn't partitioned.
+    """
+
+    partition_by = config.get("storage-settings", "partition_by", fallback="none")
+    if partition_by == "none":
+        return None
+
+    return PartitionSet(abs_db_path,
+                        config.get("storage-settings", "partition_dir", fallback=None),
+                        partition_by)
+
+
+def partition_connections(partitions):
+    """ Yield a read-only connection to each partition file of a
+    PartitionSet in turn, e.g. to rebuild something from all the
+    archived readings, without the limit on attached DBs.
+    """
+
+    for key, path in partitions.all():
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
+def has_table(conn, tablename):
+    """ Whether a table is in a connection's main schema. Partitions
+    from before a measure was added don't have its table.
+    """
+
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type == 'table' AND name == ?",
+                        (tablename,)).fetchone() is not None
+
+
+def partitioned_storage_from_config(config, abs_db_path):
+    """ Create a PartitionedStorage, using the partition settings in
+    `[storage-settings]` as well as the usual Storage ones.
+    """
+
+    section = "storage-settings"
+
+    return storage_from_config(config,
+                               abs_db_path,
+                               storage_class=PartitionedStorage,
+                               partition_dir=config.get(section, "partition_dir",
+                                                        fallback=None),
+                               period=config.get(section, "partition_by"),
+                               seal_after_days=config.getfloat(section,
+                                                               "partition_seal_after_days",
+                                                               fallback=2))
+
+
+def open_range(abs_db_path, start_utc, end_utc, partition_dir=None, period="month"):
+    """ Return a read-only connection to the main DB with the partitions
+    for start_utc to end_utc attached. Each archive table name is
+    shadowed by a temporary view combining the main DB's table with
+    the same table in every attached partition, so queries can be
+    written as if there were no partitions, e.g.
+    `SELECT * FROM temperature WHERE station_id == ? AND timestamp_utc >= ?`.
+    SQLite can attach at most 9 partitions at once, use query_range()
+    for longer ranges.
+    """
+
+    partitions = PartitionSet(abs_db_path, partition_dir, period)
+    existing = partitions.existing(start_utc, end_utc)
+
+    conn = sqlite3.connect(f"file:{abs_db_path}?mode=ro", uri=True)
+
+    try:
+        for key, path in existing:
+            conn.execute("ATTACH DATABASE ? AS " + partitions.alias(key),
+                         (f"file:{path}?mode=ro",))
+
+        for table in S.archive_tables():
+            sources = [f"SELECT * FROM main.{table.tablename}"]
+            sources += [f"SELECT * FROM {partitions.alias(key)}.{table.tablename}"
+                        for key, _ in existing]
+            conn.execute(f"CREATE TEMP VIEW {table.tablename} AS "
+                         + " UNION ALL ".join(sources))
+    except sqlite3.Error:
+        conn.close()
+        raise
+
+    return conn
+
+
+def query_range(abs_db_path, table, start_utc, end_utc, columns="*",
+                where="", params=(), partition_dir=None, period="month",
+                descending=False):
+    """ Yield rows of an archive table between start_utc and end_utc,
+    ordered by timestamp_utc, newest first if descending. The main DB
+    can have readings from any time, so each partition's are read on
+    its own connection, with no limit on how many, and merged with
+    the main DB's.
+    where is an extra condition, e.g. `station_id == ?` with params.
+    """
+
+    partitions = PartitionSet(abs_db_path, partition_dir, period)
+    condition = "timestamp_utc >= ? AND timestamp_utc <= ?"
+    if where:
+        condition += f" AND ({where})"
+
+    paths = [abs_db_path] + [_[1] for _ in partitions.existing(start_utc, end_utc)]
+
+    conns = []
+    try:
+        cursors = []
+        for path in paths:
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            conns.append(conn)
+            if not has_table(conn, table.tablename):
+                continue
+            # With the time first, to merge on
+            cursors.append(conn.execute(f"SELECT timestamp_utc, {columns} "
+                                        f"FROM {table.tablename} WHERE {condition} "
+                                        f"ORDER BY timestamp_utc{' DESC' if descending else ''}",
+                                        (start_utc, end_utc, *params)))
+
+        for row in heapq.merge(*cursors, key=lambda _: _[0], reverse=descending):
+            yield row[1:]
+    finally:
+        for conn in conns:
+            conn.close()
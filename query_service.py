@@ -0,0 +1,290 @@
+import collections
+import http.server
+import itertools
+import json
+import logging
+import threading
+import time
+import urllib.parse
+import schemas_and_tables as S
+from partitions import query_range
+
+""" A small read-only HTTP/JSON API for dashboards, run from a thread
+    of the ingest process, so they don't need to poll the SQLite file.
+    The latest value of every station's measures, and a ring buffer of
+    each one's recent readings, are kept in memory as they're received,
+    and served without touching the DB. Longer ranges of history are
+    read from the archive tables on a separate read-only connection,
+    which in WAL mode never blocks the writer.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Gas readings are kept under this measure name
+GAS_MEASURE = "gas"
+
+
+class RecentReadings:
+    """ The latest reading, and up to per_station recent readings, of
+    each (station_id, measure), as dicts of station_id, measure,
+    timestamp_utc and value. Thread safe: add() is called by
+    the thread storing readings, the rest by the HTTP threads.
+    """
+
+    def __init__(self, per_station=1000):
+
+        self.per_station = per_station
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._recent = {}
+        # Readings from before this haven't been kept
+        self.started_utc = time.time()
+
+    def load_latest(self, last_updates, env_tables=S.env_tables):
+        """ Fill the latest values from a LastUpdatesCache, so
+        they're available before the first readings arrive.
+        """
+
+        measures = {env_tables[_]["measure"]: _ for _ in env_tables}
+
+        with self._lock:
+            for (station_id, measure_type), entry in last_updates.entries.items():
+                if measure_type not in measures or entry["timestamp_utc"] is None:
+                    continue
+                self._latest[(station_id, measures[measure_type])] = \
+                    {"station_id": station_id,
+                     "measure": measures[measure_type],
+                     "timestamp_utc": entry["timestamp_utc"],
+                     "value": entry["measure_value"]}
+
+        return None
+
+    def add(self, kind, decoded):
+        """ Keep a decoded reading, or list of them for a batch """
+
+        if kind == "gas":
+            readings = [{"station_id": decoded["station_id"],
+                         "measure": GAS_MEASURE,
+                         "timestamp_utc": decoded["timestamp_utc"],
+                         "value": decoded["volume_l"]}]
+        else:
+            if kind != "batch":
+                decoded = [decoded]
+            readings = [{"station_id": _["station_id"],
+                         "measure": _["measure"],
+                         "timestamp_utc": _["timestamp_utc"],
+                         "value": _["measure_value"]} for _ in decoded]
+
+        with self._lock:
+            for reading in readings:
+                key = (reading["station_id"], reading["measure"])
+                recent = self._recent.get(key)
+                if recent is None:
+                    recent = self._recent[key] = collections.deque(maxlen=self.per_station)
+                recent.append(reading)
+
+                latest = self._latest.get(key)
+                if latest is None or reading["timestamp_utc"] >= latest["timestamp_utc"]:
+                    self._latest[key] = reading
+
+        return None
+
+    def latest(self, station_id=None):
+        """ Return the latest readings, of one or all stations """
+
+        with self._lock:
+            return [self._latest[_] for _ in sorted(self._latest)
+                    if station_id is None or _[0] == station_id]
+
+    def covered_from(self, station_id, measure):
+        """ Return the time from which all readings of a station's
+        measure are in memory.
+        """
+
+        with self._lock:
+            recent = self._recent.get((station_id, measure))
+            if recent is None or len(recent) < recent.maxlen:
+                return self.started_utc
+            return recent[0]["timestamp_utc"]
+
+    def recent(self, station_id, measure, start_utc=None, end_utc=None):
+        """ Return the readings in memory of a station's measure,
+        optionally only those between start_utc and end_utc.
+        """
+
+        with self._lock:
+            readings = list(self._recent.get((station_id, measure), ()))
+
+        return [_ for _ in readings
+                if (start_utc is None or _["timestamp_utc"] >= start_utc)
+                and (end_utc is None or _["timestamp_utc"] <= end_utc)]
+
+
+def history_from_db(abs_db_path, station_id, measure, start_utc, end_utc,
+                    max_rows=10000, partition_dir=None, period="month"):
+    """ Read up to max_rows archived readings of a station's measure
+    from the DB, and its partitions, with read-only connections, in
+    time order. If there are more, the newest max_rows are returned,
+    as dashboards show the end of the range.
+    """
+
+    if measure == GAS_MEASURE:
+        table, column = S.gas_table, "volume_l"
+    elif measure in S.env_tables:
+        table, column = S.env_tables[measure]["table"], S.env_tables[measure]["measure"]
+    else:
+        raise KeyError(measure)
+
+    rows = query_range(abs_db_path, table, start_utc, end_utc,
+                       columns=f"timestamp_utc, {column}",
+                       where="station_id == ?", params=(station_id,),
+                       partition_dir=partition_dir, period=period,
+                       descending=True)
+    try:
+        newest = list(itertools.islice(rows, max_rows))
+    finally:
+        # Closes the connections if max_rows stopped it early
+        rows.close()
+
+    return [{"station_id": station_id,
+             "measure": measure,
+             "timestamp_utc": timestamp_utc,
+             "value": value} for timestamp_utc, value in reversed(newest)]
+
+
+class _QueryHandler(http.server.BaseHTTPRequestHandler):
+
+    service = None
+
+    def do_GET(self):
+
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+
+        try:
+            if url.path == "/latest":
+                body = self.service.recent.latest(params.get("station_id"))
+            elif url.path == "/recent":
+                body = self.service.recent.recent(params["station_id"],
+                                                  params.get("measure", "temp"),
+                                                  _float(params.get("from")))
+            elif url.path == "/history":
+                body = self.service.history(params["station_id"],
+                                            params.get("measure", "temp"),
+                                            _float(params.get("from")),
+                                            _float(params.get("to")))
+            else:
+                self.send_error(404)
+                return None
+        except (KeyError, ValueError) as e:
+            self.send_error(400, f"Bad or missing parameter {e}")
+            return None
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+        return None
+
+    def log_message(self, format, *args):
+        # Dashboards poll every few seconds
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def _float(value):
+
+    return None if value is None else float(value)
+
+
+class QueryService:
+    """ Serves, at http://host:port:
+    - `/latest[?station_id=]` the latest value of every measure
+    - `/recent?station_id=&measure=[&from=]` readings in memory
+    - `/history?station_id=&measure=&from=[&to=]` readings from
+      memory if it has all of them, otherwise from the archive,
+      wrapped in a dict saying which.
+    Times are UTC epoch seconds, measure is an env measure or `gas`.
+    """
+
+    def __init__(self, abs_db_path, recent, host="127.0.0.1", port=9109,
+                 max_rows=10000, partition_dir=None, period="month"):
+
+        self.abs_db_path = abs_db_path
+        self.recent = recent
+        self.max_rows = max_rows
+        self.partition_dir = partition_dir
+        self.period = period
+
+        handler = type("QueryHandler", (_QueryHandler,), {"service": self})
+        self.server = http.server.ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+
+    def history(self, station_id, measure, start_utc, end_utc=None):
+
+        if start_utc is None:
+            raise ValueError("from")
+
+        if start_utc >= self.recent.covered_from(station_id, measure):
+            return {"source": "memory",
+                    "readings": self.recent.recent(station_id, measure, start_utc, end_utc)}
+
+        end_utc = time.time() if end_utc is None else end_utc
+        return {"source": "db",
+                "readings": history_from_db(self.abs_db_path, station_id, measure,
+                                            start_utc, end_utc, self.max_rows,
+                                            self.partition_dir, self.period)}
+
+    def start(self):
+
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name="query-http", daemon=True)
+        thread.start()
+
+        host, port = self.server.server_address[:2]
+        logger.info(f"Serving queries on http://{host}:{port}/")
+
+        return None
+
+    def shutdown(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+        return None
+
+
+def recent_readings_from_config(config):
+    """ Return a RecentReadings if the `[query]` section of a
+    ConfigParser enables the query service, otherwise None.
+    """
+
+    if not config.getboolean("query", "enabled", fallback=False):
+        return None
+
+    return RecentReadings(config.getint("query", "per_station", fallback=1000))
+
+
+def query_service_from_config(config, abs_db_path, recent):
+    """ Start the query service set in the `[query]` section of
+    a ConfigParser serving recent, returns it or None.
+    """
+
+    if recent is None:
+        return None
+
+    partition_by = config.get("storage-settings", "partition_by", fallback="none")
+
+    service = QueryService(abs_db_path,
+                           recent,
+                           config.get("query", "host", fallback="127.0.0.1"),
+                           config.getint("query", "port", fallback=9109),
+                           max_rows=config.getint("query", "max_rows", fallback=10000),
+                           partition_dir=config.get("storage-settings", "partition_dir",
+                                                    fallback=None),
+                           period="month" if partition_by == "none" else partition_by)
+    service.start()
+
+    return service
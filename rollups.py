@@ -0,0 +1,258 @@
+import schemas_and_tables as S
+from partitions import has_table, partition_connections, partition_set_from_config
+import itertools
+import sqlite3
+import configparser
+import os
+import argparse
+import logging
+
+""" Maintain the hourly and daily rollup tables, which hold the
+    count, sum, min and max of the archived readings in each
+    time bucket, so graphs don't have to aggregate the raw archive.
+    Run directly to rebuild the rollups from the archive tables.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def bucket_start(timestamp_utc, bucket_s):
+    """ Return the start of the bucket of bucket_s seconds
+    that a timestamp falls into.
+    """
+
+    return int(timestamp_utc // bucket_s * bucket_s)
+
+
+def _env_upsert_statement(rollup_table):
+    """ Insert a bucket with a single reading, or add the
+    reading to the existing bucket.
+    """
+
+    return (f"INSERT INTO {rollup_table.tablename}"
+            f"({rollup_table.cols_as_string()}) "
+            "VALUES(:station_id, :measure_type, :bucket_start_utc, "
+            ":reading_count, :value_sum, :value_min, :value_max) "
+            f"ON CONFLICT({', '.join(rollup_table.primarykeys)}) DO UPDATE SET "
+            "reading_count = reading_count + excluded.reading_count, "
+            "value_sum = value_sum + excluded.value_sum, "
+            "value_min = MIN(value_min, excluded.value_min), "
+            "value_max = MAX(value_max, excluded.value_max)")
+
+
+def _gas_upsert_statement(rollup_table):
+
+    return (f"INSERT INTO {rollup_table.tablename}"
+            f"({rollup_table.cols_as_string()}) "
+            "VALUES(:station_id, :bucket_start_utc, :reading_count, :volume_l_sum) "
+            f"ON CONFLICT({', '.join(rollup_table.primarykeys)}) DO UPDATE SET "
+            "reading_count = reading_count + excluded.reading_count, "
+            "volume_l_sum = volume_l_sum + excluded.volume_l_sum")
+
+
+# Built once, as they're used for every archived reading.
+ENV_UPSERTS = {_: _env_upsert_statement(S.env_rollup_tables[_]) for _ in S.env_rollup_tables}
+
+GAS_UPSERTS = {_: _gas_upsert_statement(S.gas_rollup_tables[_]) for _ in S.gas_rollup_tables}
+
+
+def add_env_reading(storage, decoded):
+    """ Add an archived environment reading to each of the
+    env rollup tables.
+    """
+
+    for granularity, statement in ENV_UPSERTS.items():
+        storage.conn.execute(statement,
+                             {"station_id": decoded["station_id"],
+                              "measure_type": decoded["measure_type"],
+                              "bucket_start_utc": bucket_start(decoded["timestamp_utc"],
+                                                               S.ROLLUP_BUCKETS_S[granularity]),
+                              "reading_count": 1,
+                              "value_sum": decoded["measure_value"],
+                              "value_min": decoded["measure_value"],
+                              "value_max": decoded["measure_value"]})
+
+    return None
+
+
+def add_env_readings(storage, readings):
+    """ Add a list of archived environment readings to each of the
+    env rollup tables, with one executemany per table.
+    """
+
+    for granularity, statement in ENV_UPSERTS.items():
+        bucket_s = S.ROLLUP_BUCKETS_S[granularity]
+        storage.conn.executemany(statement,
+                                 [{"station_id": _["station_id"],
+                                   "measure_type": _["measure_type"],
+                                   "bucket_start_utc": bucket_start(_["timestamp_utc"], bucket_s),
+                                   "reading_count": 1,
+                                   "value_sum": _["measure_value"],
+                                   "value_min": _["measure_value"],
+                                   "value_max": _["measure_value"]}
+                                  for _ in readings])
+
+    return None
+
+
+def add_gas_reading(storage, decoded):
+    """ Add an archived gas reading to each of the gas rollup
+    tables. Meter readings are totals, not usage, so are skipped.
+    """
+
+    if decoded["is_meter_reading"]:
+        return None
+
+    for granularity, statement in GAS_UPSERTS.items():
+        storage.conn.execute(statement,
+                             {"station_id": decoded["station_id"],
+                              "bucket_start_utc": bucket_start(decoded["timestamp_utc"],
+                                                               S.ROLLUP_BUCKETS_S[granularity]),
+                              "reading_count": 1,
+                              "volume_l_sum": decoded["volume_l"]})
+
+    return None
+
+
+def backfill(conn, env_tables=S.env_tables, gas_table=S.gas_table, partitions=None):
+    """ Rebuild all the rollup tables from the archive tables, in
+    the main DB and, given a PartitionSet, every partition file.
+    Each archive table is read once, in a single GROUP BY into
+    the finest rollup, and the coarser rollups are built from that.
+    Runs within the caller's transaction, so existing rollups are
+    replaced atomically.
+    """
+
+    cur = conn.cursor()
+
+    # Finest granularity first, the others are built from it.
+    granularities = sorted(S.ROLLUP_BUCKETS_S, key=S.ROLLUP_BUCKETS_S.get)
+    finest = granularities[0]
+
+    for rollup_tables in (S.env_rollup_tables, S.gas_rollup_tables):
+        for rollup_table in rollup_tables.values():
+            cur.execute(f"DELETE FROM {rollup_table.tablename}")
+
+    finest_s = S.ROLLUP_BUCKETS_S[finest]
+    env_finest = S.env_rollup_tables[finest]
+    gas_finest = S.gas_rollup_tables[finest]
+
+    # Partitions are read with their own connections, as they can't
+    # be attached in a transaction. A bucket can have readings from
+    # more than one, e.g. late ones in the main DB, so they're added.
+    sources = [conn]
+    if partitions is not None:
+        sources = itertools.chain(sources, partition_connections(partitions))
+
+    for source in sources:
+        read = source.cursor()
+        read.row_factory = sqlite3.Row
+
+        for env_type in env_tables.values():
+            table = env_type["table"].tablename
+            measure = env_type["measure"]
+            if not has_table(source, table):
+                continue
+            read.execute(f"SELECT station_id, ? AS measure_type, "
+                         f"CAST(timestamp_utc / {finest_s} AS INTEGER) * {finest_s} "
+                         f"AS bucket_start_utc, COUNT(*) AS reading_count, "
+                         f"SUM({measure}) AS value_sum, MIN({measure}) AS value_min, "
+                         f"MAX({measure}) AS value_max "
+                         f"FROM {table} "
+                         f"WHERE timestamp_utc IS NOT NULL AND {measure} IS NOT NULL "
+                         f"GROUP BY station_id, bucket_start_utc",
+                         (measure,))
+            cur.executemany(ENV_UPSERTS[finest], map(dict, read))
+
+        if has_table(source, gas_table.tablename):
+            read.execute(f"SELECT station_id, "
+                         f"CAST(timestamp_utc / {finest_s} AS INTEGER) * {finest_s} "
+                         f"AS bucket_start_utc, COUNT(*) AS reading_count, "
+                         f"SUM(volume_l) AS volume_l_sum "
+                         f"FROM {gas_table.tablename} "
+                         f"WHERE timestamp_utc IS NOT NULL "
+                         f"AND NOT COALESCE(is_meter_reading, FALSE) "
+                         f"GROUP BY station_id, bucket_start_utc")
+            cur.executemany(GAS_UPSERTS[finest], map(dict, read))
+
+        logger.info(f"Rolled up {source.execute('PRAGMA database_list').fetchone()[2]} "
+                    f"into {env_finest.tablename} and {gas_finest.tablename}")
+
+    for granularity in granularities[1:]:
+        bucket_s = S.ROLLUP_BUCKETS_S[granularity]
+        env_rollup = S.env_rollup_tables[granularity]
+        gas_rollup = S.gas_rollup_tables[granularity]
+
+        cur.execute(f"INSERT INTO {env_rollup.tablename}({env_rollup.cols_as_string()}) "
+                    f"SELECT station_id, measure_type, "
+                    f"CAST(bucket_start_utc / {bucket_s} AS INTEGER) * {bucket_s} AS bucket, "
+                    f"SUM(reading_count), SUM(value_sum), MIN(value_min), MAX(value_max) "
+                    f"FROM {env_finest.tablename} "
+                    f"GROUP BY station_id, measure_type, bucket")
+
+        cur.execute(f"INSERT INTO {gas_rollup.tablename}({gas_rollup.cols_as_string()}) "
+                    f"SELECT station_id, "
+                    f"CAST(bucket_start_utc / {bucket_s} AS INTEGER) * {bucket_s} AS bucket, "
+                    f"SUM(reading_count), SUM(volume_l_sum) "
+                    f"FROM {gas_finest.tablename} "
+                    f"GROUP BY station_id, bucket")
+
+        logger.info(f"Rolled up {granularity} buckets")
+
+    return None
+
+
+def main():
+    """ Rebuild the rollup tables of a DB from its archive tables """
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s",
+                        level=logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="rollups",
+                                     description=("Rebuild the hourly and daily "
+                                                  "rollup tables from the archived "
+                                                  "readings."))
+    parser.add_argument("-db", "--database",
+                        help=("Path to Sqlite3 DB to update. If "
+                              "not specified location defined "
+                              "in `store-mqtt-data.conf` "
+                              "is used."))
+
+    args = parser.parse_args()
+
+    # Also needed for the partition settings
+    config = configparser.ConfigParser()
+
+    config_file_name = "store-mqtt-data.conf"
+    config_abs_path = os.path.abspath(config_file_name)
+    config.read(str(config_abs_path))
+
+    if args.database:
+        abs_db_path = os.path.abspath(args.database)
+    else:
+        db_path = config.get("storage-settings", "db_path", fallback=None)
+        abs_db_path = os.path.abspath(db_path)
+
+    # Make sure the DB is at the current schema, which
+    # includes creating the rollup tables.
+    S.bootstrap_db(abs_db_path, S.all_tables(), S.all_statements())
+
+    conn = sqlite3.connect(abs_db_path, isolation_level=None)
+    try:
+        # IMMEDIATE takes the write lock up front, so no readings
+        # can be archived, and missed, while the rollups are rebuilt.
+        conn.execute("BEGIN IMMEDIATE")
+        backfill(conn, partitions=partition_set_from_config(config, abs_db_path))
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
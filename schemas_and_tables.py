@@ -1,12 +1,17 @@
+import datetime
+import logging
 import re
 import sqlite3
 
 """ Contains the table class, plus schemas and resulting
     table objects needed for the storing of the home monitoring
     data in the Sqlite3 DB, as well as the create_table()
-    function.
+    and bootstrap_db() functions, and the list of schema
+    migrations for upgrading existing DBs.
 """
 
+logger = logging.getLogger(__name__)
+
 
 class table:
     """ Object to hold a simple definition for an SQLite
@@ -16,7 +21,7 @@ class table:
     SQLite schema.
     """
 
-    def __init__(self, tablename, schema_string):
+    def __init__(self, tablename, schema_string, indexes=None):
         """ Takes a table name and schema as a
         string, e.g.
         `colA INTEGER PRIMARY KEY, colB STRING, colC INTEGER` etc.
@@ -24,10 +29,13 @@ class table:
         It's very sensitive to have comma-space separation between
         entries; if there's only a comma it's likely to produce
         weird results.
+        indexes is an optional list of secondary indexes, each a
+        tuple of column names, e.g. `[("colB", "colC")]`.
         """
 
         self.tablename = tablename
         self.schema = {}
+        self.indexes = [tuple(_) for _ in (indexes or [])]
         self.primarykeys = ["rowid"]  # default if no other defined
 
         # Get the primary key, if defined on a row of its own
@@ -104,16 +112,112 @@ class table:
 
         return ":" + ", :".join(self.colnames())
 
+    def index_name(self, columns):
+        """ Return the name used for the index on a tuple of columns """
+
+        return f"{self.tablename}_{'_'.join(columns)}_idx"
+
+    def index_statements(self):
+        """ Return a list of `CREATE INDEX IF NOT EXISTS` statements,
+            one for each of the table's secondary indexes.
+        """
+
+        return [(f"CREATE INDEX IF NOT EXISTS {self.index_name(_)} "
+                 f"ON {self.tablename}({', '.join(_)})") for _ in self.indexes]
+
 
 def create_table(abs_db_path:str, table:table)-> None:
-    """ Create a table in the named SQLite3 DB from a table object """
+    """ Create a table, and its indexes, in the named SQLite3 DB
+    from a table object """
 
     with sqlite3.connect(abs_db_path) as conn:
         cur = conn.cursor()
         cur.execute(f"CREATE TABLE IF NOT EXISTS {repr(table)}")
+        for statement in table.index_statements():
+            cur.execute(statement)
 
     return None
 
+
+def schema_version(conn:sqlite3.Connection)-> int:
+    """ Return the version of the newest migration applied
+    to the DB, 0 if there's none recorded.
+    """
+
+    cur = conn.cursor()
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {repr(schema_version_table)}")
+    res = cur.execute(f"SELECT MAX(version) FROM {schema_version_table.tablename}")
+
+    return res.fetchone()[0] or 0
+
+
+def bootstrap_db(abs_db_path:str, tables:list, statements:list=(), migrate:bool=True)-> int:
+    """ Create any missing tables and indexes, and bring an
+    existing DB up to the latest schema version by applying
+    any migrations it hasn't had yet. statements are run last,
+    and should be idempotent, e.g. `CREATE VIEW IF NOT EXISTS`.
+    Set migrate to False for DBs holding only some of the tables,
+    such as archive partitions, which only get tables and indexes.
+    A new DB is created at the latest version, so it doesn't
+    need the migrations, and with auto_vacuum=INCREMENTAL.
+    Everything happens in one transaction on one connection,
+    so a failure leaves the DB as it was.
+    Returns the schema version the DB is now at.
+    """
+
+    latest = MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+    conn = sqlite3.connect(abs_db_path, isolation_level=None)
+    try:
+        # Only takes effect on a new DB, before any tables are
+        # created, lets maintenance.py give freed pages back.
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+
+        res = cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type == 'table'")
+        is_new_db = res.fetchone()[0] == 0
+
+        current = schema_version(conn)
+
+        for table in tables:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {repr(table)}")
+
+        if migrate and not is_new_db:
+            for version, description, steps in MIGRATIONS:
+                if version <= current:
+                    continue
+                logger.info(f"Migrating DB to version {version}: {description}")
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        cur.execute(step)
+
+        for table in tables:
+            for statement in table.index_statements():
+                cur.execute(statement)
+
+        for statement in statements:
+            cur.execute(statement)
+
+        if migrate and latest > current:
+            cur.execute(f"INSERT INTO {schema_version_table.tablename}"
+                        f"({schema_version_table.cols_as_string()}) "
+                        f"VALUES(?, ?)",
+                        (latest, datetime.datetime.now(datetime.timezone.utc).timestamp()))
+
+        cur.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    return latest
+
 # -- Schemas --
 
 TEMPERATURE_SCHEMA = ("timestamp_utc TIMESTAMP, "
@@ -154,16 +258,198 @@ GAS_SCHEMA = ("timestamp_utc TIMESTAMP, "
               "volume_l INTEGER, "
               "is_meter_reading BOOLEAN")
 
+# Aggregates of the archived readings per time bucket, kept up
+# to date as readings are archived, see rollups.py.
+# Mean is value_sum / reading_count.
+ENV_ROLLUP_SCHEMA = ("station_id STRING NOT NULL, "
+                     "measure_type STRING NOT NULL, "
+                     "bucket_start_utc TIMESTAMP NOT NULL, "
+                     "reading_count INTEGER, "
+                     "value_sum FLOAT, "
+                     "value_min FLOAT, "
+                     "value_max FLOAT, "
+                     "PRIMARY KEY(station_id, measure_type, bucket_start_utc)")
+
+GAS_ROLLUP_SCHEMA = ("station_id STRING NOT NULL, "
+                     "bucket_start_utc TIMESTAMP NOT NULL, "
+                     "reading_count INTEGER, "
+                     "volume_l_sum INTEGER, "
+                     "PRIMARY KEY(station_id, bucket_start_utc)")
+
+# Running total of gas used per station, one row per gasUse row,
+# reset to the meter's value by meter readings, see gas_totals.py.
+GAS_TOTAL_SCHEMA = ("station_id STRING NOT NULL, "
+                    "timestamp_utc TIMESTAMP NOT NULL, "
+                    "total_l INTEGER, "
+                    "is_meter_reading BOOLEAN")
+
+# Single row counter, increased by triggers on every change to
+# the stations table, so cached copies know when to reload.
+STATIONS_VERSION_SCHEMA = ("id INTEGER PRIMARY KEY, "
+                           "version INTEGER")
+
+# One row per migration applied by bootstrap_db()
+SCHEMA_VERSION_SCHEMA = ("version INTEGER PRIMARY KEY, "
+                         "applied_utc TIMESTAMP")
+
+# Archive tables are nearly always queried for one
+# station over a time range.
+STATION_TIME_INDEX = [("station_id", "timestamp_utc")]
+
 # -- Create table objects from schemas:
 
 last_update_table = table("lastUpdates", LAST_UPDATE_SCHEMA)
 
-stations_table = table("stations", STATION_SCHEMA)
+stations_table = table("stations", STATION_SCHEMA,
+                       indexes=[("station_id", "from_timestamp_utc"),
+                                ("location", "sublocation")])
 
-env_tables = {"temp": {"table": table("temperature", TEMPERATURE_SCHEMA),
+stations_version_table = table("stationsVersion", STATIONS_VERSION_SCHEMA)
+
+env_tables = {"temp": {"table": table("temperature", TEMPERATURE_SCHEMA,
+                                      indexes=STATION_TIME_INDEX),
                        "measure": "temp_c"},
-              "humidity": {"table": table("humidity", HUMIDITY_SCHEMA),
+              "humidity": {"table": table("humidity", HUMIDITY_SCHEMA,
+                                          indexes=STATION_TIME_INDEX),
                            "measure": "humidity_pct"}
               }
 
-gas_table = table("gasUse", GAS_SCHEMA)
+gas_table = table("gasUse", GAS_SCHEMA, indexes=STATION_TIME_INDEX)
+
+gas_totals_table = table("gasTotals", GAS_TOTAL_SCHEMA,
+                         indexes=[("station_id", "timestamp_utc"),
+                                  ("station_id", "is_meter_reading", "timestamp_utc")])
+
+# Bucket sizes in seconds for each rollup granularity
+ROLLUP_BUCKETS_S = {"hourly": 3600,
+                    "daily": 86400}
+
+env_rollup_tables = {"hourly": table("envRollupHourly", ENV_ROLLUP_SCHEMA),
+                     "daily": table("envRollupDaily", ENV_ROLLUP_SCHEMA)}
+
+gas_rollup_tables = {"hourly": table("gasRollupHourly", GAS_ROLLUP_SCHEMA),
+                     "daily": table("gasRollupDaily", GAS_ROLLUP_SCHEMA)}
+
+schema_version_table = table("schemaVersion", SCHEMA_VERSION_SCHEMA)
+
+
+def add_env_table(measure, tablename, column):
+    """ Add an archive table for a new environment measure, e.g. from
+    the config, with a single FLOAT column for its values. It's
+    created by bootstrap_db() like the others.
+    """
+
+    # SQLite's names aren't case sensitive, and the views share them
+    taken = [_.tablename for _ in all_tables() + [schema_version_table]]
+    taken += [f"{_.tablename}ByLocation" for _ in archive_tables()]
+    if tablename.lower() in [_.lower() for _ in taken]:
+        raise ValueError(f"Table {tablename} is already in the DB, "
+                         f"measure {measure} needs another table")
+
+    schema = ("timestamp_utc TIMESTAMP, "
+              "station_id STRING, "
+              f"{column} FLOAT")
+
+    env_tables[measure] = {"table": table(tablename, schema, indexes=STATION_TIME_INDEX),
+                           "measure": column}
+
+    return None
+
+
+def all_tables():
+    """ Return all the table objects the DB should contain """
+
+    tables = [last_update_table, stations_table, stations_version_table, gas_table,
+              gas_totals_table]
+    tables += [env_tables[_]["table"] for _ in env_tables.keys()]
+    tables += list(env_rollup_tables.values()) + list(gas_rollup_tables.values())
+
+    return tables
+
+
+def archive_tables():
+    """ Return the table objects of the archived readings,
+    which can be split into time partitions.
+    """
+
+    return [env_tables[_]["table"] for _ in env_tables.keys()] + [gas_table]
+
+
+def location_view_statement(archive_table, value_column):
+    """ Return the statement creating a view of an archive table with
+    each reading joined to the location its station was at, at the
+    time of the reading. Named e.g. `temperatureByLocation`.
+    Readings from a station with no entry covering their time get
+    a NULL location.
+    """
+
+    return (f"CREATE VIEW IF NOT EXISTS {archive_table.tablename}ByLocation AS "
+            f"SELECT r.rowid AS reading_id, r.timestamp_utc, r.station_id, "
+            f"s.location, s.sublocation, r.{value_column} "
+            f"FROM {archive_table.tablename} AS r "
+            f"LEFT JOIN {stations_table.tablename} AS s "
+            f"ON s.station_id == r.station_id "
+            f"AND s.from_timestamp_utc <= r.timestamp_utc "
+            f"AND (s.to_timestamp_utc IS NULL OR r.timestamp_utc <= s.to_timestamp_utc)")
+
+
+def all_statements():
+    """ Return the triggers, views and other statements run after
+    the tables are created, in the order they have to run.
+    """
+
+    statements = [(f"INSERT OR IGNORE INTO {stations_version_table.tablename}"
+                   f"(id, version) VALUES(1, 0)")]
+
+    for action in ("INSERT", "UPDATE", "DELETE"):
+        statements.append(f"CREATE TRIGGER IF NOT EXISTS "
+                          f"{stations_table.tablename}_{action.lower()}_version "
+                          f"AFTER {action} ON {stations_table.tablename} BEGIN "
+                          f"UPDATE {stations_version_table.tablename} "
+                          f"SET version = version + 1 WHERE id == 1; END")
+
+    statements += [location_view_statement(env_tables[_]["table"], env_tables[_]["measure"])
+                   for _ in env_tables.keys()]
+    statements.append(location_view_statement(gas_table, "volume_l"))
+
+    return statements
+
+# -- Migrations:
+
+def _backfill_rollups(conn):
+    """ Fill the new rollup tables from the existing archive """
+
+    # Imported here as rollups itself needs this module
+    import rollups
+    rollups.backfill(conn)
+
+    return None
+
+
+def _backfill_gas_totals(conn):
+    """ Fill the new gasTotals table from the existing gasUse rows """
+
+    import gas_totals
+    gas_totals.backfill(conn)
+
+    return None
+
+
+# Each entry is (version, description, steps), where the steps are
+# SQL statements, or functions taking the connection, that upgrade
+# a DB from the previous version. New tables and declared indexes
+# are created by bootstrap_db() itself, so a migration is only needed
+# when an existing table has to change. Append only, and never
+# edit a migration once released.
+MIGRATIONS = [(1,
+               "Add station_id, timestamp_utc indexes to archive tables",
+               []),
+              (2,
+               "Add hourly and daily rollup tables",
+               [_backfill_rollups]),
+              (3,
+               "Add stations indexes, change counter and location views",
+               []),
+              (4,
+               "Add gasTotals running totals",
+               [_backfill_gas_totals])]
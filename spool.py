@@ -0,0 +1,273 @@
+import logging
+import os
+import struct
+import threading
+import zlib
+
+""" A crash safe spool of the raw MQTT messages. Each message is
+    appended to a file as it's received, before any DB work, and
+    acknowledged once the readings from it are committed. Anything
+    not acknowledged when the script stops, or crashes, is replayed
+    from the file at the next start up. Appends are flushed and
+    fsync'd in batches by a background thread, and the file is
+    cut back to just the unacknowledged messages at each checkpoint.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Each record is a header of the CRC32 and length of the body,
+# then the body: receive time, topic length, topic and payload.
+HEADER = struct.Struct("<II")
+BODY_START = struct.Struct("<dH")
+
+
+class SpooledMessage:
+    """ A message read back from the spool, with the same topic
+    and payload attributes as a paho MQTTMessage, as well as
+    its original receive time and its sequence number.
+    """
+
+    def __init__(self, topic, payload, receive_time, seq):
+
+        self.topic = topic
+        self.payload = payload
+        self.receive_time = receive_time
+        self.seq = seq
+
+    def __repr__(self):
+
+        return f"SpooledMessage({self.topic!r}, {self.payload!r}, {self.receive_time}, {self.seq})"
+
+
+def encode_record(receive_time, topic, payload):
+
+    topic = topic.encode()
+    body = BODY_START.pack(receive_time, len(topic)) + topic + payload
+
+    return HEADER.pack(zlib.crc32(body), len(body)) + body
+
+
+def read_records(f):
+    """ Yield (receive_time, topic, payload) from a spool file,
+    stopping at the end or at the first incomplete or corrupt
+    record, which is what a crash part way through an append
+    leaves behind. Returns the offset the valid records end at.
+    """
+
+    offset = 0
+
+    while True:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            break
+
+        crc, length = HEADER.unpack(header)
+        body = f.read(length)
+        if len(body) < length or zlib.crc32(body) != crc:
+            logger.warning(f"Spool has a damaged record at offset {offset}, "
+                           "ignoring it and anything after it.")
+            break
+
+        receive_time, topic_length = BODY_START.unpack_from(body)
+        topic_end = BODY_START.size + topic_length
+        yield (receive_time,
+               body[BODY_START.size:topic_end].decode(),
+               body[topic_end:])
+
+        offset += HEADER.size + length
+
+    return offset
+
+
+class Spool:
+    """ The spool file at path. Messages left in it from before are
+    loaded on opening, see unacknowledged() to replay them.
+    append() returns a sequence number to pass to ack() once the
+    message has been dealt with.
+    """
+
+    def __init__(self, path, fsync_interval_s=0.2, checkpoint_interval_s=10):
+
+        self.path = path
+        self.fsync_interval_s = fsync_interval_s
+        self.checkpoint_interval_s = checkpoint_interval_s
+        self._lock = threading.Lock()
+        # seq: encoded record, for everything not acknowledged
+        self._pending = {}
+        self._next_seq = 0
+        self._dirty = False
+
+        self._load()
+        self.file = open(path, "ab")
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="spool-sync", daemon=True)
+        self._thread.start()
+
+    def _load(self):
+
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path, "rb") as f:
+            records = read_records(f)
+            while True:
+                try:
+                    record = next(records)
+                except StopIteration as end:
+                    valid_length = end.value
+                    break
+                self._pending[self._next_seq] = encode_record(*record)
+                self._next_seq += 1
+
+        # Drop any partly written record at the end,
+        # so new ones aren't appended after it.
+        if os.path.getsize(self.path) != valid_length:
+            os.truncate(self.path, valid_length)
+
+        if self._pending:
+            logger.warning(f"Spool {self.path} has {len(self._pending)} "
+                           "messages to replay.")
+
+        return None
+
+    def unacknowledged(self):
+        """ Return SpooledMessages for everything not yet acknowledged,
+        in the order they were received.
+        """
+
+        with self._lock:
+            pending = sorted(self._pending.items())
+
+        messages = []
+        for seq, record in pending:
+            body = record[HEADER.size:]
+            receive_time, topic_length = BODY_START.unpack_from(body)
+            topic_end = BODY_START.size + topic_length
+            messages.append(SpooledMessage(body[BODY_START.size:topic_end].decode(),
+                                           body[topic_end:],
+                                           receive_time,
+                                           seq))
+
+        return messages
+
+    def pending(self):
+        """ Return the number of unacknowledged messages """
+
+        return len(self._pending)
+
+    def append(self, receive_time, topic, payload):
+        """ Spool a message, returns its sequence number. It's
+        written to disk at the next sync, which is at most
+        fsync_interval_s away.
+        """
+
+        record = encode_record(receive_time, topic, payload)
+
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._pending[seq] = record
+            self.file.write(record)
+            self._dirty = True
+
+        return seq
+
+    def ack(self, seq):
+        """ Mark a message as dealt with, so it won't be replayed """
+
+        with self._lock:
+            self._pending.pop(seq, None)
+
+        return None
+
+    def sync(self):
+        """ Flush and fsync anything appended since the last sync """
+
+        with self._lock:
+            if not self._dirty:
+                return None
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self._dirty = False
+
+        return None
+
+    def checkpoint(self):
+        """ Cut the file back to the unacknowledged messages, which
+        is usually none, so the file is just truncated.
+        """
+
+        with self._lock:
+            self.file.flush()
+
+            if not self._pending:
+                self.file.truncate(0)
+                os.fsync(self.file.fileno())
+                self._dirty = False
+                return None
+
+            # Rewrite just the outstanding records, and swap
+            # the new file in, so a crash leaves one or the other.
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for seq in sorted(self._pending):
+                    f.write(self._pending[seq])
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+            self.file.close()
+            self.file = open(self.path, "ab")
+            self._dirty = False
+
+            logger.debug(f"Spool checkpoint kept {len(self._pending)} messages.")
+
+        return None
+
+    def _run(self):
+
+        since_checkpoint = 0.0
+
+        while not self._stop.wait(self.fsync_interval_s):
+            try:
+                self.sync()
+                since_checkpoint += self.fsync_interval_s
+                if since_checkpoint >= self.checkpoint_interval_s:
+                    self.checkpoint()
+                    since_checkpoint = 0.0
+            except OSError:
+                logger.exception(f"Writing spool {self.path} failed")
+
+        return None
+
+    def close(self):
+        """ Stop the sync thread, and checkpoint one last time """
+
+        self._stop.set()
+        self._thread.join()
+        self.checkpoint()
+        self.file.close()
+
+        if self._pending:
+            logger.warning(f"Spool {self.path} closed with {len(self._pending)} "
+                           "messages to replay at the next start.")
+
+        return None
+
+
+def spool_from_config(config, abs_db_path):
+    """ Open the spool set in the `[spool]` section of a ConfigParser,
+    or return None if it's not enabled. Its path defaults to the
+    DB's path with `.spool` on the end.
+    """
+
+    if not config.getboolean("spool", "enabled", fallback=False):
+        return None
+
+    path = config.get("spool", "path", fallback=None) or abs_db_path + ".spool"
+
+    return Spool(os.path.abspath(path),
+                 fsync_interval_s=config.getfloat("spool", "fsync_interval_s", fallback=0.2),
+                 checkpoint_interval_s=config.getfloat("spool", "checkpoint_interval_s",
+                                                       fallback=10))
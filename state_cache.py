@@ -0,0 +1,102 @@
+import logging
+import time
+
+""" Contains the LastUpdatesCache, an in-memory copy of the
+    lastUpdates table, so deciding whether to archive a reading
+    doesn't need to read from the DB.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class LastUpdatesCache:
+    """ Holds one row of the lastUpdates table per
+    (station_id, measure_type) as a dict of column values.
+    The cache is the source of truth while running, the table is
+    written back from it by flush(), either on every reading or,
+    if flush_interval_s is set, at most once per interval.
+    Each key also has a policy state dict, for the archive policy
+    to keep anything it needs between readings. These aren't
+    stored in the DB.
+    Not thread safe, it should only be used by the thread doing
+    the DB work.
+    """
+
+    def __init__(self, last_update_table, flush_interval_s=0):
+
+        self.table = last_update_table
+        self.flush_interval_s = flush_interval_s
+        self.entries = {}
+        self.policy_states = {}
+        self.dirty = set()
+        self._last_flush = time.monotonic()
+
+    def load(self, storage):
+        """ Fill the cache from the lastUpdates table """
+
+        res = storage.conn.execute(f"SELECT {self.table.cols_as_string()} "
+                                   f"FROM {self.table.tablename}")
+
+        cols = self.table.colnames()
+        self.entries = {}
+        for row in res:
+            entry = dict(zip(cols, row))
+            self.entries[(entry["station_id"], entry["measure_type"])] = entry
+
+        self.dirty = set()
+
+        logger.info(f"Loaded {len(self.entries)} entries from {self.table.tablename}")
+
+        return None
+
+    def get(self, station_id, measure_type):
+        """ Return the cached row for a station and measure,
+        or None if it has never reported.
+        """
+
+        return self.entries.get((station_id, measure_type))
+
+    def policy_state(self, station_id, measure_type):
+        """ Return the archive policy's state dict for a station
+        and measure, created empty the first time.
+        """
+
+        return self.policy_states.setdefault((station_id, measure_type), {})
+
+    def record(self, decoded):
+        """ Store a complete lastUpdates row, taken from the decoded
+        reading, and mark it to be written back.
+        """
+
+        key = (decoded["station_id"], decoded["measure_type"])
+        self.entries[key] = {_: decoded[_] for _ in self.table.colnames()}
+        self.dirty.add(key)
+
+        return None
+
+    def flush(self, storage, force=False):
+        """ Write changed rows back to the lastUpdates table, if
+        the flush interval has elapsed or force is True.
+        The rows are marked as changed again if the transaction
+        they're written in is rolled back.
+        """
+
+        if not self.dirty:
+            return None
+
+        now = time.monotonic()
+        if not force and (now - self._last_flush) < self.flush_interval_s:
+            return None
+
+        keys = self.dirty
+        rows = [self.entries[_] for _ in keys]
+
+        storage.replace_many(self.table, rows)
+
+        self.dirty = set()
+        storage.on_rollback(lambda: self.dirty.update(keys))
+        self._last_flush = now
+
+        logger.debug(f"Wrote {len(rows)} rows to {self.table.tablename}")
+
+        return None
@@ -0,0 +1,207 @@
+import contextlib
+import logging
+import sqlite3
+import threading
+import time
+from metrics import metrics
+
+""" Contains the Storage class, which owns the long lived SQLite3
+    connection used for writing readings, tuned with PRAGMAs from
+    the config file, and builds each table's statements only once.
+"""
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_MODES = ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]
+
+SYNCHRONOUS_LEVELS = ["OFF", "NORMAL", "FULL", "EXTRA"]
+
+
+class Storage:
+    """ A single persistent connection to the DB, plus the INSERT
+    and REPLACE statements for each table object it has been
+    asked to write to.
+    The connection is in autocommit mode, use transaction() to
+    group writes. It may be handed between threads, but must only
+    be used by one thread at a time. transaction() makes sure of
+    this, other threads' transactions wait for it to finish.
+    """
+
+    def __init__(self,
+                 abs_db_path,
+                 journal_mode="WAL",
+                 synchronous="NORMAL",
+                 cache_size_kib=8192,
+                 mmap_size_mb=0,
+                 busy_timeout_s=5.0):
+
+        journal_mode = journal_mode.upper()
+        synchronous = synchronous.upper()
+
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(f"journal_mode must be one of {JOURNAL_MODES}, not {journal_mode}")
+
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f"synchronous must be one of {SYNCHRONOUS_LEVELS}, not {synchronous}")
+
+        self.abs_db_path = abs_db_path
+        self._statements = {}
+        self._lock = threading.RLock()
+        # Callbacks to run if the current transaction is rolled back
+        self._on_rollback = []
+
+        self.conn = sqlite3.connect(abs_db_path,
+                                    timeout=busy_timeout_s,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+
+        # journal_mode returns the mode actually set, which
+        # may differ, e.g. WAL isn't possible for :memory: DBs
+        set_mode = self.conn.execute(f"PRAGMA journal_mode={journal_mode}").fetchone()[0]
+        self.conn.execute(f"PRAGMA synchronous={synchronous}")
+        # Negative cache size is in KiB rather than pages
+        self.conn.execute(f"PRAGMA cache_size=-{int(cache_size_kib)}")
+        self.conn.execute(f"PRAGMA mmap_size={int(mmap_size_mb) * 1024 * 1024}")
+
+        logger.info(f"Opened {abs_db_path} with journal_mode={set_mode}, "
+                    f"synchronous={synchronous}, cache_size={cache_size_kib}KiB, "
+                    f"mmap_size={mmap_size_mb}MB")
+
+    def statement(self, table, verb="INSERT"):
+        """ Return the `INSERT` (or `REPLACE`) statement with named
+        placeholders for a table object, building it the first
+        time it's asked for.
+        """
+
+        key = (verb, table.tablename)
+
+        if key not in self._statements:
+            self._statements[key] = (f"{verb} INTO {table.tablename}"
+                                     f"({table.cols_as_string()}) "
+                                     f"VALUES({table.named_placeholders()})")
+
+        return self._statements[key]
+
+    def insert(self, table, row):
+        """ Insert one row, a dict with a key for every column """
+
+        self.conn.execute(self.statement(table), row)
+
+        return None
+
+    def insert_many(self, table, rows):
+        """ Insert an iterable of row dicts """
+
+        self.conn.executemany(self.statement(table), rows)
+
+        return None
+
+    def replace(self, table, row):
+        """ Insert one row, replacing any row with the same primary key """
+
+        self.conn.execute(self.statement(table, "REPLACE"), row)
+
+        return None
+
+    def replace_many(self, table, rows):
+        """ Replace an iterable of row dicts """
+
+        self.conn.executemany(self.statement(table, "REPLACE"), rows)
+
+        return None
+
+    def begin(self):
+        """ Start a transaction. Anything that can't be done inside
+        one, such as attaching DBs, has to happen here first.
+        """
+
+        self.conn.execute("BEGIN")
+        self._on_rollback = []
+
+        return None
+
+    def on_rollback(self, callback):
+        """ Call `callback()` if the writes made so far in the current
+        transaction are rolled back, e.g. so rows written from a
+        cache are marked to be written again. Forgotten once the
+        transaction commits.
+        """
+
+        self._on_rollback.append(callback)
+
+        return None
+
+    def rollback_mark(self):
+        """ Return a mark to pass to rolled_back(), for when only the
+        writes after it, e.g. back to a savepoint, are rolled back.
+        """
+
+        return len(self._on_rollback)
+
+    def rolled_back(self, mark=0):
+        """ Run, newest first, the on_rollback() callbacks registered
+        since `mark`, once their writes have been rolled back.
+        """
+
+        callbacks = self._on_rollback[mark:]
+        del self._on_rollback[mark:]
+
+        for callback in reversed(callbacks):
+            try:
+                callback()
+            except Exception:
+                logger.exception(f"Rollback callback {callback!r} failed")
+
+        return None
+
+    def committed(self):
+        """ Forget the on_rollback() callbacks, once their writes have
+        been committed.
+        """
+
+        self._on_rollback = []
+
+        return None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Run the enclosed writes in one transaction, which is
+        rolled back if an exception is raised.
+        """
+
+        with self._lock:
+            self.begin()
+            try:
+                yield self
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                self.rolled_back()
+                raise
+            else:
+                start = time.perf_counter()
+                self.conn.execute("COMMIT")
+                metrics.observe("commit_seconds", time.perf_counter() - start)
+                self.committed()
+
+    def close(self):
+
+        self.conn.close()
+
+        return None
+
+
+def storage_from_config(config, abs_db_path, storage_class=Storage, **kwargs):
+    """ Create a Storage for abs_db_path with the PRAGMA settings
+    from the `[storage-settings]` section of a ConfigParser.
+    Any kwargs are passed on to storage_class, a Storage subclass.
+    """
+
+    section = "storage-settings"
+
+    return storage_class(abs_db_path,
+                         journal_mode=config.get(section, "journal_mode", fallback="WAL"),
+                         synchronous=config.get(section, "synchronous", fallback="NORMAL"),
+                         cache_size_kib=config.getint(section, "cache_size_kib", fallback=8192),
+                         mmap_size_mb=config.getint(section, "mmap_size_mb", fallback=0),
+                         busy_timeout_s=config.getfloat(section, "busy_timeout_s", fallback=5.0),
+                         **kwargs)
@@ -1,12 +1,31 @@
 import paho.mqtt.client as mqtt
 import datetime
 import os
-import sqlite3
 import configparser
 import logging
 from pathlib import Path
 import re
+import signal
+import time
+import asyncio
 import schemas_and_tables as S
+import rollups
+import gas_totals
+from batch_writer import BatchWriter
+from state_cache import LastUpdatesCache
+from storage import storage_from_config
+from archive_policies import parse_policy, policies_from_config
+from partitions import partitioned_storage_from_config
+from metrics import metrics, metrics_server_from_config
+from workers import workers_from_config
+from spool import SpooledMessage, spool_from_config
+from topic_router import router_from_config
+from query_service import query_service_from_config, recent_readings_from_config
+from coalescer import coalescer_from_config
+from diagnostics import diagnostics_from_config
+from maintenance import maintenance_from_config
+from duplicates import duplicate_filter_from_config
+from async_ingest import BROKER_PREFIX, brokers_from_config, run_brokers
 
 # Setup the logger, default to debug, will change in main()
 # based on config file values
@@ -22,34 +41,9 @@ LOGGING_LEVELS ={"DEBUG": logging.DEBUG,
                  "CRITICAL": logging.CRITICAL}
 
 
-def decode_env_message(msg, env_tables):
-    """ Decode an environment MQTT Message to a dict
-    for insertion into the DB.
-    Expecting a message topic of:
-    `env/<environment measurement>/<station_id>`
-    and a payload of the relevant value.
-    """
-
-    routing = msg.topic.split("/")
-
-    # Check that it's one we can deal with
-    if routing[1] not in env_tables.keys():
-        logging.warn("Env type {routing[1]} not recognised, and not stored.")
-        return 1
-    
-    # Reformat to a dict we can use for insertion later
-    decoded = {"station_id": routing[2],
-               "timestamp_utc": datetime.datetime.now(datetime.timezone.utc).timestamp(),
-               "measure_type": env_tables[routing[1]]["measure"],
-               "measure_value": float(msg.payload.decode()),
-               "measure": routing[1]}
-
-    return decoded
-
-
-def archive_env_measurement(decoded, abs_db_path, env_tables):
+def archive_env_measurement(storage, decoded, env_tables):
     """ Write the decoded reading onto the relevant table of environmental
-    measurements
+    measurements, and add it to the rollups.
     """
 
     # Duplicate decoded data slightly, to make the dict and
@@ -57,89 +51,223 @@ def archive_env_measurement(decoded, abs_db_path, env_tables):
     decoded[decoded["measure_type"]] = decoded["measure_value"]
     
     table = env_tables[decoded["measure"]]["table"]
-             
-    insert_statement = (f"INSERT INTO {table.tablename}({table.cols_as_string()}) "
-                        f"VALUES({table.named_placeholders()})")
 
-    with sqlite3.connect(abs_db_path) as conn:
-        cur = conn.cursor()
-        cur.execute(insert_statement, decoded)
+    start = time.perf_counter()
+    storage.insert(table, decoded)
+    rollups.add_env_reading(storage, decoded)
+    metrics.observe("db_seconds", time.perf_counter() - start,
+                    (("operation", "archive_env_measurement"),))
+    metrics.inc("readings_archived_total", (("family", "env"),))
 
     logger.debug(f"Archived {decoded['measure_type']}: {decoded['measure_value']} into {table.tablename}")
 
     return None
 
-    
-def update_env_latest(decoded, abs_db_path, archive_interval_s, env_tables, last_update_table):
+
+def decide_archive(decoded, current, archive_policies, last_updates):
+    """ Fill in the decoded reading's last archive time and value
+    from current, its station's lastUpdates row, and return the
+    (timestamp_utc, value) readings the measure's archive policy
+    says to archive.
+    """
+
+    if current is None:
+        decoded["last_archive_time_utc"] = None
+        decoded["last_archive_value"] = None
+    else:
+        decoded["last_archive_time_utc"] = current["last_archive_time_utc"]
+        decoded["last_archive_value"] = current["last_archive_value"]
+
+    policy = archive_policies[decoded["measure"]]
+    state = last_updates.policy_state(decoded["station_id"], decoded["measure_type"])
+
+    # Usually just this reading, but some policies archive
+    # an earlier one, with its own timestamp.
+    return policy.decide(state, current,
+                         decoded["timestamp_utc"], decoded["measure_value"])
+
+
+def update_env_latest(storage, decoded, archive_policies, env_tables, last_updates):
     """ Update the lastUpdates table with a value,
-    and if update more than archive_interval_s seconds ago
+    and if the archive policy for the measure says so,
     also the main archive table for that measure type.
+    The previous archive time and value come from the
+    last_updates cache, so no read from the DB is needed.
     """
-    
-    # Now just missing last_archive_time_utc, but have to check what the
-    # current value in the table is first.
 
-    query = ("SELECT last_archive_time_utc, last_archive_value FROM lastUpdates "
-             "WHERE station_id == ? "
-             "AND measure_type == ?")
+    # Not including archiving, which is timed on its own
+    start = time.perf_counter()
 
-    # Connect via URI as we only need a read only connection for this
-    ro_uri_path = "file:" + abs_db_path + "?mode=ro"
-    
-    with sqlite3.connect(ro_uri_path, uri=True) as conn:
-       cur = conn.cursor()
-       res = cur.execute(query, (decoded["station_id"], decoded["measure_type"]))
-
-       result = res.fetchall()
-       logger.debug(f"Current lastUpdates values: {result}")
-       
-       if result == []:
-           # No result yet
-           last_archive = 0
-           last_archive_val = None
-       else:
-           last_archive = result[0][0]
-           last_archive_val = float(result[0][1])
-       # Exit the DB connection
-
-       # TODO only archive it value has changed, and write last archive value
-       # into lastUpdates
-    if (((decoded["timestamp_utc"] - last_archive) > archive_interval_s) and
-        (decoded["measure_value"] != last_archive_val)):
-        # means we should also archive these values
+    current = last_updates.get(decoded["station_id"], decoded["measure_type"])
+    logger.debug(f"Current lastUpdates values: {current}")
+
+    to_archive = decide_archive(decoded, current, archive_policies, last_updates)
+
+    elapsed_s = time.perf_counter() - start
+
+    for timestamp_utc, value in to_archive:
+        reading = dict(decoded, timestamp_utc=timestamp_utc, measure_value=value)
         # return None if successful
-        archive_failure = archive_env_measurement(decoded, abs_db_path, env_tables)
-        
+        archive_failure = archive_env_measurement(storage, reading, env_tables)
+
         if not archive_failure:
             # archive successful
-            decoded["last_archive_time_utc"] = decoded["timestamp_utc"]
-            decoded["last_archive_value"] = decoded["measure_value"]
+            decoded["last_archive_time_utc"] = timestamp_utc
+            decoded["last_archive_value"] = value
         else:
             # failed to archive
-            logger.warning(f"Failed the archive reading: {decoded}")
-            decoded["last_archive_time_utc"] = last_archive
-            decoded["last_archive_value"] = last_archive_val
+            logger.warning(f"Failed the archive reading: {reading}")
+
+    if not to_archive:
+        metrics.inc("readings_skipped_total", (("family", "env"),))
+
+    # With the latest update time dict complete, we can update
+    # the cache, which writes back to the lastUpdates table
+    # now, or later if writes are being batched.
+    start = time.perf_counter()
+    last_updates.record(decoded)
+    last_updates.flush(storage)
+
+    metrics.observe("db_seconds", elapsed_s + time.perf_counter() - start,
+                    (("operation", "update_env_latest"),))
 
+    return None
+
+
+def update_env_batch(storage, readings, archive_policies, env_tables, last_updates):
+    """ As update_env_latest(), for a list of decoded readings from
+    one batch message, which can have several readings of each
+    measure. They're decided on in time order, then the archived
+    readings are written with one executemany per table. Only the
+    newest reading of each measure is kept in lastUpdates.
+    """
+
+    start = time.perf_counter()
+
+    # Newest reading in this batch, per (station_id, measure_type)
+    latest = {}
+    to_insert = {}
+
+    for decoded in sorted(readings, key=lambda _: _["timestamp_utc"]):
+        key = (decoded["station_id"], decoded["measure_type"])
+        current = latest.get(key) or last_updates.get(*key)
+
+        to_archive = decide_archive(decoded, current, archive_policies, last_updates)
+
+        for timestamp_utc, value in to_archive:
+            reading = dict(decoded, timestamp_utc=timestamp_utc, measure_value=value)
+            reading[decoded["measure_type"]] = value
+            to_insert.setdefault(decoded["measure"], []).append(reading)
+            decoded["last_archive_time_utc"] = timestamp_utc
+            decoded["last_archive_value"] = value
+
+        if not to_archive:
+            metrics.inc("readings_skipped_total", (("family", "batch"),))
+
+        latest[key] = decoded
+
+    for measure, rows in to_insert.items():
+        storage.insert_many(env_tables[measure]["table"], rows)
+        rollups.add_env_readings(storage, rows)
+        metrics.inc("readings_archived_total", (("family", "batch"),), len(rows))
+
+    for key, decoded in latest.items():
+        current = last_updates.get(*key)
+        if current is None or current["timestamp_utc"] is None or \
+           decoded["timestamp_utc"] >= current["timestamp_utc"]:
+            last_updates.record(decoded)
+        elif (decoded["last_archive_time_utc"] or 0) > (current["last_archive_time_utc"] or 0):
+            # A newer reading arrived before this batch, keep
+            # it, but with what the batch archived.
+            last_updates.record(dict(current,
+                                     last_archive_time_utc=decoded["last_archive_time_utc"],
+                                     last_archive_value=decoded["last_archive_value"]))
+    last_updates.flush(storage)
+
+    metrics.observe("db_seconds", time.perf_counter() - start,
+                    (("operation", "update_env_batch"),))
+
+    return None
+
+
+def run_db_job(userdata, func, *args, seqs=()):
+    """ Hand a database job to the writer thread if we're running
+    with write_behind enabled, otherwise run it straight away
+    in its own transaction. Jobs are called as `func(storage, *args)`.
+    The spooled messages seqs are acknowledged once the job is
+    committed, and left to be replayed if it fails.
+    """
+
+    writer = userdata["writer"]
+
+    if writer:
+        writer.submit(func, *args,
+                      on_commit=(lambda: acknowledge(userdata, *seqs)) if seqs else None)
     else:
-        decoded["last_archive_time_utc"] = last_archive
-        decoded["last_archive_value"] = last_archive_val
+        storage = userdata["storage"]
+        try:
+            with storage.transaction():
+                func(storage, *args)
+        except Exception:
+            metrics.inc("db_jobs_failed_total", (("job", func.__name__),))
+            raise
+        acknowledge(userdata, *seqs)
+
+    return None
+
+
+def receive_message(userdata, msg):
+    """ Return the time a message was received, and its spool
+    sequence number, appending it to the spool if enabled.
+    Messages replayed from the spool keep their original time.
+    """
 
-    # With the latest update time dict complete, we can
-    # update the latest table. Does it make sense to do
-    # within the above DB connection, or create a new one as below?
+    spool = userdata["spool"]
 
-    insert_statement = (f"REPLACE INTO {last_update_table.tablename}"
-                        f"({last_update_table.cols_as_string()}) "
-                        f"VALUES({last_update_table.named_placeholders()})")
+    if isinstance(msg, SpooledMessage):
+        return msg.receive_time, msg.seq
 
-    with sqlite3.connect(abs_db_path) as conn:
-       cur = conn.cursor()
-       cur.execute(insert_statement, decoded)
+    receive_time = datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+    if spool is None:
+        return receive_time, None
+
+    return receive_time, spool.append(receive_time, msg.topic, msg.payload)
+
+
+def acknowledge(userdata, *seqs):
+    """ Remove messages from the spool, once their readings are
+    committed, or they've been dropped. See run_db_job().
+    """
+
+    spool = userdata["spool"]
+
+    for seq in seqs:
+        if seq is not None:
+            spool.ack(seq)
 
-    logger.debug(f"updated lastUpdates table")
-       
     return None
-    
+
+
+def replay_spool(userdata):
+    """ Pass any messages left in the spool by the last
+    run back through on_message().
+    """
+
+    spool = userdata["spool"]
+    if spool is None:
+        return None
+
+    messages = spool.unacknowledged()
+
+    for msg in messages:
+        on_message(None, userdata, msg)
+
+    if messages:
+        logger.warning(f"Replayed {len(messages)} spooled messages.")
+
+    return None
+
 
 def on_connect(client, userdata, flags, rc):
     """ The callback for when the client receives a CONNACK response from the server."""
@@ -157,6 +285,8 @@ def on_connect(client, userdata, flags, rc):
         rc_string = f"{rc}: Unknown response"
     
     logger.warning(f"Connected to {client._host}:{client._port} with result: {rc_string}")
+    if flags.get("session present"):
+        logger.info("Resuming the broker's session, missed QoS 1 messages will follow.")
 
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
@@ -169,61 +299,385 @@ def on_connect(client, userdata, flags, rc):
     
     return None
 
-def on_env_message(client, userdata, msg):
-    """ Write the recorded value to the last Update
-        table, and the archive table if enough
-        time has elapsed
+def on_message(client, userdata, msg):
+    """ Decode any message, as set by the route for its topic,
+    then write it to the lastUpdates and archive tables for an
+    environment reading, or the gasUse table for gas.
     """
-    
-    decoded = decode_env_message(msg, userdata["env_tables"])
+
+    # Resent QoS 1 messages already seen are dropped before they're
+    # spooled, messages replayed from the spool were never acked.
+    duplicates = userdata["duplicates"]
+    if (duplicates and not isinstance(msg, SpooledMessage)
+            and duplicates.is_duplicate(msg)):
+        return None
+
+    received, seq = receive_message(userdata, msg)
+
+    match = userdata["router"].match(msg.topic)
+    if match is None:
+        logger.warning(f"No route for {msg.topic}, not stored.")
+        metrics.inc("messages_dropped_total", (("family", "unrouted"),))
+        acknowledge(userdata, seq)
+        return None
+
+    route, station_id = match
+    family = (("family", route.kind),)
+    metrics.inc("messages_received_total", family)
+
+    start = time.perf_counter()
+    try:
+        decoded = route.decode(station_id, msg.payload, received)
+    except ValueError:
+        logger.warning(f"Couldn't decode {msg.topic}: {msg.payload!r}, dropped.")
+        metrics.inc("messages_dropped_total", family)
+        acknowledge(userdata, seq)
+        return None
+    metrics.observe("decode_seconds", time.perf_counter() - start, family)
+
+    metrics.seen(station_id)
 
     logger.debug(f"Received and decoded: {str(decoded)}")
 
-    update_env_latest(decoded,
-                      userdata["db_abs_path"],
-                      userdata["archive_interval_s"],
-                      userdata["env_tables"],
-                      userdata["last_update_table"])
+    if userdata["relay"]:
+        # In a worker process, the main process stores it
+        userdata["relay"].put(route.kind, decoded)
+        return None
+
+    try:
+        store_reading(userdata, route.kind, decoded, seq)
+    except Exception:
+        # Left in the spool, if there is one, for the next start
+        logger.exception(f"Failed to store {decoded}")
+        return None
 
     return None
 
-def archive_gas_reading(msg, gas_table, abs_db_path):
-    """ Add the last used volume of gas into the
-    archive. 
-    """
 
-    routing = msg.topic.split("/")
+def store_env_reading(userdata, decoded, seqs=()):
+    """ Update lastUpdates, and maybe archive, a decoded reading """
 
-    decoded = {"timestamp_utc": datetime.datetime.now(datetime.timezone.utc).timestamp(),
-               "station_id": routing[2],
-               "volume_l": int(msg.payload.decode()),
-               "is_meter_reading": False} # always false, other only manually added.
+    run_db_job(userdata,
+               update_env_latest,
+               decoded,
+               userdata["archive_policies"],
+               userdata["env_tables"],
+               userdata["last_updates"],
+               seqs=seqs)
 
-    logger.debug(f"Received and decoded: {str(decoded)}")
+    return None
 
-    insert_statement = (f"INSERT INTO {gas_table.tablename}("
-                        f"{gas_table.cols_as_string()}) "
-                        f"VALUES({gas_table.named_placeholders()})")
+def archive_gas_reading(storage, decoded, gas_table):
+    """ Add the last used volume of gas into the
+    archive, the rollups and the running totals.
+    """
 
-    with sqlite3.connect(abs_db_path) as conn:
-        cur = conn.cursor()
-        cur.execute(insert_statement, decoded)
+    start = time.perf_counter()
+    storage.insert(gas_table, decoded)
+    rollups.add_gas_reading(storage, decoded)
+    gas_totals.add_gas_reading(storage, decoded)
+    metrics.observe("db_seconds", time.perf_counter() - start,
+                    (("operation", "archive_gas_reading"),))
+    metrics.inc("readings_archived_total", (("family", "gas"),))
 
     logger.debug(f"Archived volume_l: {decoded['volume_l']} into {gas_table.tablename}")
         
     return None
 
-def on_gas_message(client, userdata, msg):
-    """ Callback function to write a gas
-        reading into the database.
-        This doesn't add an entry to the lastUpdates table
-        Expects a message with a topic in the format:
-        `utility/gas/<station_id>`
+def store_gas_reading(userdata, decoded, seqs=()):
+    """ Archive a decoded gas reading """
+
+    run_db_job(userdata,
+               archive_gas_reading,
+               decoded,
+               userdata["gas_table"],
+               seqs=seqs)
+
+    return None
+
+
+def store_env_batch(userdata, readings, seqs=()):
+    """ Store the decoded readings from a batch message """
+
+    run_db_job(userdata,
+               update_env_batch,
+               readings,
+               userdata["archive_policies"],
+               userdata["env_tables"],
+               userdata["last_updates"],
+               seqs=seqs)
+
+    return None
+
+
+# How decoded messages are stored, by the kind of their route
+STORE_FUNCTIONS = {"env": store_env_reading,
+                   "gas": store_gas_reading,
+                   "batch": store_env_batch}
+
+
+def store_reading(userdata, kind, decoded, seq=None):
+    """ Store a decoded reading by the kind of its route, keep it
+    in memory for the query service, if it's running, and
+    acknowledge its spooled message, seq, once it's committed.
+    Env readings go through the coalescer, if enabled.
+    """
+
+    if userdata["recent"]:
+        userdata["recent"].add(kind, decoded)
+
+    if kind == "env" and userdata["coalescer"]:
+        userdata["coalescer"].add(decoded, seq)
+        return None
+
+    STORE_FUNCTIONS[kind](userdata, decoded, () if seq is None else (seq,))
+
+    return None
+
+
+def store_coalesced(userdata, readings, seqs):
+    """ Store the env readings held by the coalescer, as one batch,
+    so only the newest of each station's measures is written to
+    lastUpdates, though the archive policy decides on all of them.
     """
 
-    archive_gas_reading(msg,
-                        userdata["gas_table"],
-                        userdata["db_abs_path"])
+    if readings:
+        store_env_batch(userdata, readings, seqs)
+    else:
+        # Only dropped readings' messages
+        acknowledge(userdata, *seqs)
+
+    return None
+
+
+def store_relayed(pool, userdata):
+    """ Store the readings relayed by a WorkerPool's processes
+    until interrupted, then those still on their way.
+    """
+
+    try:
+        for kind, decoded in pool.readings():
+            count_relayed(kind, decoded)
+            store_reading(userdata, kind, decoded)
+    finally:
+        for kind, decoded in pool.stop():
+            count_relayed(kind, decoded)
+            store_reading(userdata, kind, decoded)
+
+    return None
+
+
+def count_relayed(kind, decoded):
+    """ Count a message decoded by a worker, as the metrics the
+    workers record in their own processes aren't served.
+    """
+
+    metrics.inc("messages_received_total", (("family", kind),))
+
+    # A batch's readings are all from one station
+    first = decoded[0] if isinstance(decoded, list) and decoded else decoded
+    if first:
+        metrics.seen(first["station_id"])
+
+    return None
+
+
+def run_client(config, userdata, client_id, clean_session):
+    """ Receive messages with a single MQTT client, until
+    interrupted, then disconnect.
+    """
+
+    client = mqtt.Client(client_id=client_id,
+                         clean_session=clean_session,
+                         userdata=userdata)
+
+    # set username and password
+    uname = config.get("client", "username", fallback=None)
+    paswd = config.get("client", "password", fallback=None)
+    client.username_pw_set(uname, password=paswd)
+
+    client.on_connect = on_connect
+    # Every message goes to on_message(), which finds its
+    # route, rather than paho matching each one to a callback.
+    client.on_message = on_message
+
+    client.connect(config.get("mqtt_server", "host", fallback="127.0.0.1"),
+                   config.getint("mqtt-server", "port", fallback=1883),
+                   config.getint("mqtt-server", "timeout", fallback=60))
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    # Blocking call that processes network traffic, dispatches callbacks and
+    # handles reconnecting.
+    # Other loop*() functions are available that give a threaded interface and a
+    # manual interface.
+    try:
+        client.loop_forever()
+    finally:
+        client.disconnect()
+
+    return None
+
+
+def queue_states(userdata, pool=None):
+    """ Return the number of readings, messages or jobs waiting
+    in each queue, for the diagnostics.
+    """
+
+    states = {"last_updates_unwritten": len(userdata["last_updates"].dirty)}
+
+    if userdata["writer"]:
+        states["writer_jobs"] = userdata["writer"].queue.qsize()
+    if userdata["coalescer"]:
+        states["coalescer_readings"] = userdata["coalescer"].pending()
+    if userdata["spool"]:
+        states["spool_unacknowledged"] = userdata["spool"].pending()
+    if pool:
+        states["worker_batches"] = pool.queue.qsize()
+
+    return states
+
+
+def on_writer_failure(error):
+    """ Stop main() as if by SIGTERM, if the writer thread couldn't
+    carry on, rather than keep receiving messages it won't store.
+    """
+
+    logger.critical(f"Stopping, the writer failed: {error!r}")
+    os.kill(os.getpid(), signal.SIGTERM)
+
+    return None
+
+
+def on_sigterm(signum, frame):
+    """ Turn systemd's SIGTERM into a normal exit, so that
+    main() can drain the writer queue before stopping.
+    """
+
+    raise SystemExit(0)
+
+
+def setup_storage(config, db_abs_path, subscriptions, router=None):
+    """ Create or upgrade the DB, and set up everything the
+    callbacks need to store readings in it, as set in the
+    `[storage-settings]` section of config.
+    router is the TopicRouter, created from config if not given.
+    Returns the userdata dict for the MQTT client, which
+    should be passed to shutdown_storage() when finished.
+    """
+
+    # Before the DB is set up, as routes can add new measures' tables
+    if router is None:
+        router = router_from_config(config)
+
+    # Create tables and indexes in SQLite3DB, and upgrade
+    # it if it was created by an older version.
+    version = S.bootstrap_db(db_abs_path, S.all_tables(), S.all_statements())
+    logging.info(f"Database at schema version {version}")
+
+
+    archive_interval_s = config.getint("storage-settings", "archive_interval_s", fallback=600)
+
+    # Which readings get archived, per measure
+    archive_policies = policies_from_config(config, S.env_tables, archive_interval_s)
+    for measure, spec in router.policies().items():
+        archive_policies[measure] = parse_policy(spec, archive_interval_s)
+
+    # Keep the lastUpdates table in memory, so we don't have to
+    # read it for every reading.
+    last_updates = LastUpdatesCache(S.last_update_table,
+                                    flush_interval_s=config.getfloat("storage-settings",
+                                                                     "last_updates_flush_s",
+                                                                     fallback=0))
+    # One long lived connection does all the writing, optionally
+    # with the archive tables split into a file per month or year.
+    if config.get("storage-settings", "partition_by", fallback="none") != "none":
+        storage = partitioned_storage_from_config(config, db_abs_path)
+    else:
+        storage = storage_from_config(config, db_abs_path)
+
+    last_updates.load(storage)
+
+    # Latest values and recent readings kept for the query service
+    recent = recent_readings_from_config(config)
+    if recent:
+        recent.load_latest(last_updates)
+
+    # Raw messages are spooled to a file before any DB work, and
+    # replayed by replay_spool() if they never got committed.
+    spool = spool_from_config(config, db_abs_path)
+
+    # With write_behind the callbacks only decode and queue the
+    # readings, a separate thread does all the DB work.
+    writer = None
+    if config.getboolean("storage-settings", "write_behind", fallback=False):
+        writer = BatchWriter(storage,
+                             flush_size=config.getint("storage-settings", "flush_size",
+                                                      fallback=500),
+                             max_flush_latency_s=config.getfloat("storage-settings",
+                                                                 "max_flush_latency_s",
+                                                                 fallback=1.0),
+                             on_failure=on_writer_failure)
+        writer.start()
+        metrics.gauge_function("writer_queue_depth", writer.queue.qsize)
+        logging.info(f"Write behind enabled, flushing every {writer.flush_size} "
+                     f"readings or {writer.max_flush_latency_s}s")
+
+    # Various things that we have to make available to all
+    # callback functions. Ends up being pretty exhaustive
+    # as we have to pass the same object to all functions,
+    # if they need all the details or not. 
+    userdata = {"db_abs_path": db_abs_path,
+                "last_update_table": S.last_update_table,
+                "last_updates": last_updates,
+                "env_tables": S.env_tables,
+                "gas_table": S.gas_table,
+                "archive_interval_s": archive_interval_s,
+                "archive_policies": archive_policies,
+                "storage": storage,
+                "writer": writer,
+                "relay": None,
+                "spool": spool,
+                "router": router,
+                "recent": recent,
+                "coalescer": None,
+                "duplicates": duplicate_filter_from_config(config),
+                "subscriptions": subscriptions}
+
+    # Env readings held for a short window, and stored together
+    userdata["coalescer"] = coalescer_from_config(
+        config, lambda readings, seqs: store_coalesced(userdata, readings, seqs))
+
+    return userdata
+
+
+def shutdown_storage(userdata):
+    """ Commit anything still queued or cached, and close the DB """
+
+    writer = userdata["writer"]
+    storage = userdata["storage"]
+    last_updates = userdata["last_updates"]
+
+    if userdata["coalescer"]:
+        userdata["coalescer"].stop()
+
+    # Any lastUpdates rows still waiting on a batched
+    # write are written out last.
+    if writer and writer.failure:
+        # Anything not committed is left in the spool, if enabled
+        logging.error(f"Writer had stopped, {writer.queue.qsize()} queued jobs lost.")
+        writer.stop()
+    elif writer:
+        logging.info(f"Stopping, draining {writer.queue.qsize()} queued jobs.")
+        writer.submit(last_updates.flush, True)
+        writer.stop()
+    else:
+        with storage.transaction():
+            last_updates.flush(storage, force=True)
+    storage.close()
+
+    if userdata["spool"]:
+        userdata["spool"].close()
 
     return None
 
@@ -254,70 +708,84 @@ def main():
     db_abs_path = os.path.abspath(db_path)
     logging.info(f"Using database: {db_abs_path}")
 
+    # With clean_session=false the broker keeps the subscriptions, and
+    # queues QoS 1 messages, while we're disconnected or restarting.
+    client_id = config.get("client", "client_id", fallback=None)
+    clean_session = config.getboolean("client", "clean_session", fallback=True)
+    if not clean_session and not client_id:
+        raise RuntimeError(f"clean_session=false needs a client_id, please add to {config_abs_path}")
+
 
     # Now set the user desired log level
     user_log_level = config.get("client", "log_level", fallback="INFO").upper()
     logging.info(f"Now logging at level: {user_log_level}")
     logger.setLevel(LOGGING_LEVELS[user_log_level])
     
-    # Collect the subscription topics, callback functions and QoS
-    # settings in one place:
-    subscriptions = [("env/temp/+", on_env_message, 0),
-                     ("env/humidity/+", on_env_message, 0),
-                     ("utility/gas/+", on_gas_message, 0)]
-
-    # Create tables in SQLite3DB
-    tables_to_create = [S.last_update_table, S.stations_table, S.gas_table]
-
-    tables_to_create += [S.env_tables[_]["table"] for _ in S.env_tables.keys()]
-
-    # Keep track of creation success.
-    tables_created = []
-
-    for table in tables_to_create:
-        tables_created.append(S.create_table(db_abs_path, table))
-
-    if any(tables_created):
-        # Not all tables where created, which will probably have
-        # already thrown an exception, but if not:
-        raise RuntimeError("Not all tables created in SQLite DB as required.")
-
-
-    archive_interval_s = config.getint("storage-settings", "archive_interval_s", fallback=600)
-    # Various things that we have to make available to all
-    # callback functions. Ends up being pretty exhaustive
-    # as we have to pass the same object to all functions,
-    # if they need all the details or not. 
-    client_userdata = {"db_abs_path": db_abs_path,
-                       "last_update_table": S.last_update_table,
-                       "env_tables": S.env_tables,
-                       "gas_table": S.gas_table,
-                       "archive_interval_s": archive_interval_s,
-                       "subscriptions": subscriptions} 
-
-    client_id = config.get("client", "client_id", fallback=None)
-    client = mqtt.Client(client_id=client_id,
-                         userdata=client_userdata)
-
-    # set username and password
-    uname = config.get("client", "username", fallback=None)
-    paswd = config.get("client", "password", fallback=None)
-    client.username_pw_set(uname, password=paswd)
-
-    client.on_connect = on_connect
-
-    for sub in subscriptions:
-        client.message_callback_add(sub[0], sub[1])
-
-    client.connect(config.get("mqtt_server", "host", fallback="127.0.0.1"),
-                   config.getint("mqtt-server", "port", fallback=1883),
-                   config.getint("mqtt-server", "timeout", fallback=60))
+    # The subscription topics and their QoS come from the
+    # [route:<topic>] sections, all handled by on_message().
+    router = router_from_config(config)
+    subscriptions = router.subscriptions(on_message)
+
+    # With a [workers] count, forked worker processes receive and
+    # decode the messages, and this process only stores them. They're
+    # started before the DB is opened, so don't inherit the connection.
+    pool = workers_from_config(config, subscriptions, router)
+
+    # With [broker:<name>] sections each broker has its own connection,
+    # all in this process, and all feeding the one write behind queue.
+    several_brokers = any(_.startswith(BROKER_PREFIX) for _ in config.sections())
+    if several_brokers:
+        if pool:
+            raise RuntimeError(f"Use either [workers] or [broker:...] sections, not both, "
+                               f"in {config_abs_path}")
+        if not config.getboolean("storage-settings", "write_behind", fallback=False):
+            logging.info("Using write_behind, as there are [broker:...] sections.")
+            config.set("storage-settings", "write_behind", "true")
+
+    if pool:
+        pool.start()
+
+    client_userdata = setup_storage(config, db_abs_path, subscriptions, router)
+
+    # Optional Prometheus endpoint, see the [metrics] section
+    metrics_server = metrics_server_from_config(config)
+
+    # Optional JSON API for dashboards, see the [query] section
+    query_service = query_service_from_config(config, db_abs_path,
+                                              client_userdata["recent"])
+
+    # Deletes readings past their retention, see [retention]
+    maintenance = maintenance_from_config(config, db_abs_path)
+
+    # Profiling, memory and thread dumps on signals, see [diagnostics]
+    diagnostics_from_config(config, lambda: queue_states(client_userdata, pool))
+
+    # Anything received but not committed last time
+    replay_spool(client_userdata)
+
+    # One shutdown, whichever way the messages are received
+    try:
+        if pool:
+            signal.signal(signal.SIGTERM, on_sigterm)
+            store_relayed(pool, client_userdata)
+        elif several_brokers:
+            # Each connection drops its own resent messages
+            client_userdata["duplicates"] = None
+            connections = brokers_from_config(config, router,
+                                              lambda client, msg: on_message(client, client_userdata, msg))
+            asyncio.run(run_brokers(connections))
+        else:
+            run_client(config, client_userdata, client_id, clean_session)
+    finally:
+        if metrics_server:
+            metrics_server.shutdown()
+        if query_service:
+            query_service.shutdown()
+        if maintenance:
+            maintenance.stop()
+        shutdown_storage(client_userdata)
 
-    # Blocking call that processes network traffic, dispatches callbacks and
-    # handles reconnecting.
-    # Other loop*() functions are available that give a threaded interface and a
-    # manual interface.
-    client.loop_forever()
+    return None
 
     
 if __name__ == "__main__":
@@ -0,0 +1,401 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+""" Benchmark of analytics.py against the equivalent SQL queries, and
+    against reading the rows one by one in Python. Builds a temporary
+    DB of synthetic temperature and gas readings, with gaps, and an
+    outside temperature station replaced halfway through, then times
+    each analysis, checks the answers agree, and reports JSON.
+
+    e.g. two years of readings every 5 minutes:
+    python3 tests/benchmark_analytics.py --output analytics.json
+    python3 tests/benchmark_analytics.py --years 5 --baseline analytics.json
+"""
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+sys.path.insert(0, str(REPO_DIR))
+import analytics
+import locations
+import schemas_and_tables as S
+
+START_UTC = 1609459200  # 2021-01-01
+
+
+def build_db(args, abs_db_path):
+    """ Fill a new DB with readings every args.interval_s for args.years,
+    returns the end time. Station `t-inside` is in the living room
+    throughout, `t-old` outside for the first half, then `t-new`.
+    """
+
+    rng = random.Random(args.seed)
+    S.bootstrap_db(abs_db_path, S.all_tables(), S.all_statements())
+    end_utc = START_UTC + int(args.years * 365 * 86400)
+    middle_utc = START_UTC + (end_utc - START_UTC) // 2
+
+    stations = [("t-inside", "home", "living room", START_UTC, None),
+                ("t-old", "home", "outside", START_UTC, middle_utc - 1),
+                ("t-new", "home", "outside", middle_utc, None),
+                ("g-meter", "home", "meter", START_UTC, None)]
+
+    temps = []
+    gas = []
+    gap_until = 0
+    for timestamp_utc in range(START_UTC, end_utc, args.interval_s):
+        if timestamp_utc < gap_until:
+            continue
+        if rng.random() < args.gap_ratio:
+            # A few hours without readings
+            gap_until = timestamp_utc + rng.randint(2, 12) * 3600
+            continue
+
+        season = math.cos(2 * math.pi * (timestamp_utc - START_UTC) / (365 * 86400))
+        day = math.cos(2 * math.pi * (timestamp_utc % 86400) / 86400 + math.pi)
+        outside = round(10 - 8 * season + 4 * day + rng.gauss(0, 1), 1)
+        temps.append((timestamp_utc, "t-inside", round(20 - season + rng.gauss(0, 0.3), 1)))
+        temps.append((timestamp_utc, "t-old" if timestamp_utc < middle_utc else "t-new", outside))
+        # Heating, plus some hot water
+        litres = max(0, 15.5 - outside) * args.interval_s / 3600 * 12 + rng.random() * 5
+        gas.append((timestamp_utc, "g-meter", int(litres), False))
+
+    with sqlite3.connect(abs_db_path) as conn:
+        conn.executemany(f"INSERT INTO {S.stations_table.tablename}"
+                         "(station_id, location, sublocation, from_timestamp_utc, "
+                         "to_timestamp_utc, is_current) VALUES(?, ?, ?, ?, ?, ?)",
+                         [(*_, _[4] is None) for _ in stations])
+        conn.executemany("INSERT INTO temperature(timestamp_utc, station_id, temp_c) "
+                         "VALUES(?, ?, ?)", temps)
+        conn.executemany("INSERT INTO gasUse(timestamp_utc, station_id, volume_l, "
+                         "is_meter_reading) VALUES(?, ?, ?, ?)", gas)
+
+    return end_utc
+
+
+def best_of(repeat, func):
+    """ Return the result of func, and its fastest time of repeat runs """
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    return result, min(times)
+
+
+def sql_buckets(conn, station_id, start_utc, end_utc, interval_s):
+
+    return conn.execute(f"SELECT CAST(timestamp_utc / {interval_s} AS INTEGER) * {interval_s} "
+                        "AS bucket, COUNT(*), MIN(temp_c), MAX(temp_c), AVG(temp_c) "
+                        "FROM temperature WHERE station_id == ? AND timestamp_utc >= ? "
+                        "AND timestamp_utc <= ? GROUP BY bucket ORDER BY bucket",
+                        (station_id, start_utc, end_utc)).fetchall()
+
+
+def python_buckets(conn, station_id, start_utc, end_utc, interval_s):
+    """ Aggregates built row by row, as a Python script would """
+
+    buckets = {}
+    cur = conn.execute("SELECT timestamp_utc, temp_c FROM temperature WHERE station_id == ? "
+                       "AND timestamp_utc >= ? AND timestamp_utc <= ? ORDER BY timestamp_utc",
+                       (station_id, start_utc, end_utc))
+    for timestamp_utc, value in cur:
+        bucket = buckets.setdefault(timestamp_utc // interval_s * interval_s,
+                                    {"count": 0, "min": value, "max": value, "sum": 0})
+        bucket["count"] += 1
+        bucket["sum"] += value
+        bucket["min"] = min(bucket["min"], value)
+        bucket["max"] = max(bucket["max"], value)
+
+    return [(k, v["count"], v["min"], v["max"], v["sum"] / v["count"])
+            for k, v in sorted(buckets.items())]
+
+
+def load_series(conn, start_utc, end_utc, names=("inside", "outside", "gas")):
+    """ Return a dict of the named series, loaded into arrays """
+
+    loaders = {"inside": lambda: analytics.load_series(conn, "temp", "t-inside",
+                                                       start_utc, end_utc),
+               "outside": lambda: analytics.load_location(conn, "temp", start_utc, end_utc,
+                                                          "home", "outside"),
+               "gas": lambda: analytics.load_series(conn, "gas", "g-meter",
+                                                    start_utc, end_utc)}
+
+    return {_: loaders[_]() for _ in names}
+
+
+def numpy_buckets(series, start_utc, end_utc, interval_s):
+
+    times, values = series["inside"]
+    result = analytics.aggregate(times, values, interval_s, start_utc, end_utc)
+    keep = result["count"] > 0
+
+    return list(zip(result["start"][keep], result["count"][keep], result["min"][keep],
+                    result["max"][keep], result["mean"][keep]))
+
+
+def same_rows(a, b):
+    """ Whether two lists of result rows are equal, with NULL as NaN """
+
+    return len(a) == len(b) and all(np.allclose(np.array(x, dtype=float),
+                                                np.array(y, dtype=float), equal_nan=True)
+                                    for x, y in zip(a, b))
+
+
+def sql_gaps(conn, station_id, start_utc, end_utc, max_gap_s):
+
+    return conn.execute("SELECT previous, timestamp_utc FROM "
+                        "(SELECT timestamp_utc, LAG(timestamp_utc) OVER "
+                        "(ORDER BY timestamp_utc) AS previous FROM temperature "
+                        "WHERE station_id == ? AND timestamp_utc >= ? AND timestamp_utc <= ?) "
+                        "WHERE timestamp_utc - previous > ?",
+                        (station_id, start_utc, end_utc, max_gap_s)).fetchall()
+
+
+def numpy_gaps(series, start_utc, end_utc, max_gap_s):
+
+    times, _ = series["inside"]
+
+    return list(zip(*analytics.find_gaps(times, max_gap_s)))
+
+
+# Daily heating degree days outside, from whichever station was there
+HDD_SQL = ("SELECT CAST(t.timestamp_utc / 86400 AS INTEGER) * 86400 AS day, "
+           "MAX(0, ? - AVG(t.temp_c)) FROM temperature AS t JOIN stations AS s "
+           "ON t.station_id == s.station_id AND t.timestamp_utc >= s.from_timestamp_utc "
+           "AND (s.to_timestamp_utc IS NULL OR t.timestamp_utc <= s.to_timestamp_utc) "
+           "WHERE s.location == ? AND s.sublocation == ? "
+           "AND t.timestamp_utc >= ? AND t.timestamp_utc <= ? GROUP BY day ORDER BY day")
+
+
+def sql_degree_days(conn, start_utc, end_utc):
+
+    return conn.execute(HDD_SQL, (analytics.HDD_BASE_C, "home", "outside",
+                                  start_utc, end_utc)).fetchall()
+
+
+def python_degree_days(conn, start_utc, end_utc):
+
+    days = {}
+    for timestamp_utc, _, _, _, value in locations.env_readings_with_location(
+            conn, "temp", start_utc, end_utc, location="home", sublocation="outside"):
+        day = days.setdefault(timestamp_utc // 86400 * 86400, [0, 0])
+        day[0] += value
+        day[1] += 1
+
+    return [(k, max(0, analytics.HDD_BASE_C - v[0] / v[1])) for k, v in sorted(days.items())]
+
+
+def numpy_degree_days(series, start_utc, end_utc):
+
+    times, temps = series["outside"]
+    days, hdd = analytics.degree_days(times, temps, start_utc=start_utc, end_utc=end_utc)
+    keep = ~np.isnan(hdd)
+
+    return list(zip(days[keep], hdd[keep]))
+
+
+def sql_gas_per_degree_day(conn, start_utc, end_utc):
+
+    return conn.execute("WITH hdd(day, degree_days) AS (" + HDD_SQL.replace("ORDER BY day", "") + "), "
+                        "gas(day, litres) AS (SELECT CAST(timestamp_utc / 86400 AS INTEGER) "
+                        "* 86400 AS day, SUM(volume_l) FROM gasUse WHERE station_id == ? "
+                        "AND timestamp_utc >= ? AND timestamp_utc <= ? GROUP BY day) "
+                        "SELECT day, litres, degree_days, "
+                        "CASE WHEN degree_days > 0 THEN litres / degree_days END "
+                        "FROM gas JOIN hdd USING(day) ORDER BY day",
+                        (analytics.HDD_BASE_C, "home", "outside", start_utc, end_utc,
+                         "g-meter", start_utc, end_utc)).fetchall()
+
+
+def numpy_gas_per_degree_day(series, start_utc, end_utc):
+
+    gas_times, volumes = series["gas"]
+    times, temps = series["outside"]
+    result = analytics.gas_per_degree_day(gas_times, volumes, times, temps,
+                                          start_utc, end_utc)
+    # Days with both gas and temperature readings, like the SQL join
+    _, counts = analytics.resample(gas_times, volumes, analytics.DAY_S, "count",
+                                   start_utc, end_utc)
+    keep = (counts > 0) & ~np.isnan(result["degree_days"])
+
+    return list(zip(result["start"][keep], result["litres"][keep],
+                    result["degree_days"][keep], result["litres_per_degree_day"][keep]))
+
+
+def run_benchmark(args, abs_db_path):
+    """ Build the DB, run every case and return the results dict.
+    Each case is timed as SQL, as numpy including loading the arrays
+    it needs, and as numpy on arrays already loaded, which is the
+    cost of each further analysis of the same readings.
+    """
+
+    start = time.perf_counter()
+    end_utc = build_db(args, abs_db_path)
+    build_s = time.perf_counter() - start
+    max_gap_s = 3 * args.interval_s
+
+    # (SQL, rows in Python, numpy on loaded arrays, series it loads)
+    cases = {"daily_stats": (lambda c: sql_buckets(c, "t-inside", START_UTC, end_utc, 86400),
+                             lambda c: python_buckets(c, "t-inside", START_UTC, end_utc, 86400),
+                             lambda s: numpy_buckets(s, START_UTC, end_utc, 86400),
+                             ["inside"]),
+             "hourly_stats": (lambda c: sql_buckets(c, "t-inside", START_UTC, end_utc, 3600),
+                              lambda c: python_buckets(c, "t-inside", START_UTC, end_utc, 3600),
+                              lambda s: numpy_buckets(s, START_UTC, end_utc, 3600),
+                              ["inside"]),
+             "gaps": (lambda c: sql_gaps(c, "t-inside", START_UTC, end_utc, max_gap_s),
+                      None,
+                      lambda s: numpy_gaps(s, START_UTC, end_utc, max_gap_s),
+                      ["inside"]),
+             "location_degree_days": (lambda c: sql_degree_days(c, START_UTC, end_utc),
+                                      lambda c: python_degree_days(c, START_UTC, end_utc),
+                                      lambda s: numpy_degree_days(s, START_UTC, end_utc),
+                                      ["outside"]),
+             "gas_per_degree_day": (lambda c: sql_gas_per_degree_day(c, START_UTC, end_utc),
+                                    None,
+                                    lambda s: numpy_gas_per_degree_day(s, START_UTC, end_utc),
+                                    ["outside", "gas"])}
+
+    results = {"build_s": build_s, "cases": {}}
+
+    conn = sqlite3.connect(f"file:{abs_db_path}?mode=ro", uri=True)
+    try:
+        results["temperature_rows"] = conn.execute("SELECT COUNT(*) FROM temperature").fetchone()[0]
+        results["gas_rows"] = conn.execute("SELECT COUNT(*) FROM gasUse").fetchone()[0]
+
+        series, load_s = best_of(args.repeat, lambda: load_series(conn, START_UTC, end_utc))
+        results["numpy_load_all_s"] = load_s
+
+        for name, (sql, python_rows, numpy_loaded, needs) in cases.items():
+            case = {}
+            answers = []
+
+            answer, case["sql_s"] = best_of(args.repeat, lambda: sql(conn))
+            answers.append(answer)
+            if python_rows:
+                answer, case["python_rows_s"] = best_of(args.repeat, lambda: python_rows(conn))
+                answers.append(answer)
+
+            answer, case["numpy_s"] = best_of(args.repeat,
+                                              lambda: numpy_loaded(load_series(conn, START_UTC,
+                                                                               end_utc, needs)))
+            answers.append(answer)
+            answer, case["numpy_loaded_s"] = best_of(args.repeat, lambda: numpy_loaded(series))
+            answers.append(answer)
+
+            case["rows"] = len(answers[0])
+            case["match"] = all(same_rows(answers[0], _) for _ in answers)
+            results["cases"][name] = case
+
+        # Every analysis, as separate SQL queries, or loading once
+        _, sql_s = best_of(args.repeat, lambda: [_[0](conn) for _ in cases.values()])
+
+        def all_numpy():
+            loaded = load_series(conn, START_UTC, end_utc)
+            return [_[2](loaded) for _ in cases.values()]
+
+        _, numpy_s = best_of(args.repeat, all_numpy)
+        results["all_cases"] = {"sql_s": sql_s, "numpy_s": numpy_s}
+    finally:
+        conn.close()
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Return a list of regressions compared to a previous
+    result, beyond the fractional tolerance, or wrong answers.
+    """
+
+    regressions = []
+
+    for name, case in results["cases"].items():
+        if not case["match"]:
+            regressions.append(f"{name} doesn't match the SQL result")
+        old = baseline["results"]["cases"].get(name)
+        if not old:
+            continue
+        for key in ("numpy_s", "numpy_loaded_s"):
+            if case[key] > old[key] * (1 + tolerance):
+                regressions.append(f"{name} {key} rose from {old[key] * 1000:.1f}ms "
+                                   f"to {case[key] * 1000:.1f}ms")
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(prog="benchmark_analytics",
+                                     description=("Benchmark analytics.py against "
+                                                  "the equivalent SQL queries."))
+    parser.add_argument("--years", type=float, default=2,
+                        help="Years of synthetic readings")
+    parser.add_argument("--interval-s", type=int, default=300,
+                        help="Seconds between each station's readings")
+    parser.add_argument("--gap-ratio", type=float, default=0.001,
+                        help="Chance of a gap of a few hours after each reading")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs of each case, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db-dir",
+                        help=("Directory for the temporary DB, to benchmark "
+                              "the storage it's on. Defaults to the system temp dir."))
+    parser.add_argument("--label", default="",
+                        help="Free text label stored with the results")
+    parser.add_argument("--output",
+                        help="Write the JSON results here as well as to stdout")
+    parser.add_argument("--baseline",
+                        help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help=("Fractional change from the baseline allowed "
+                              "before it's reported as a regression"))
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.db_dir) as tmp_dir:
+        abs_db_path = os.path.join(tmp_dir, "benchmark.sqlite3")
+        results = run_benchmark(args, abs_db_path)
+
+    report = {"label": args.label,
+              "settings": {_: getattr(args, _) for _ in vars(args)
+                           if _ not in ("output", "baseline", "label")},
+              "environment": {"python": platform.python_version(),
+                              "sqlite": sqlite3.sqlite_version,
+                              "numpy": np.__version__,
+                              "machine": platform.machine()},
+              "results": results}
+
+    output = json.dumps(report, indent=2)
+    print(output)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    regressions = [f"{name} doesn't match the SQL result"
+                   for name, case in results["cases"].items() if not case["match"]]
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
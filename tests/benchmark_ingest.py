@@ -0,0 +1,253 @@
+import argparse
+import configparser
+import importlib.util
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import paho.mqtt.client as mqtt
+
+""" Offline benchmark of the ingest path. Feeds synthetic MQTT messages
+    straight into the on_message() callback of store-mqtt-data.py, with
+    no broker, against a temporary DB, and reports the throughput,
+    callback latency and DB growth as JSON.
+
+    e.g. compare writing each reading as it arrives with write behind:
+    python3 tests/benchmark_ingest.py --output direct.json
+    python3 tests/benchmark_ingest.py --write-behind --baseline direct.json
+"""
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def load_store_mqtt_data():
+    """ Import store-mqtt-data.py, which can't be imported
+    normally because of the dashes in its name.
+    """
+
+    sys.path.insert(0, str(REPO_DIR))
+    spec = importlib.util.spec_from_file_location("store_mqtt_data",
+                                                  REPO_DIR / "store-mqtt-data.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def make_message(topic, payload):
+    """ Build a paho MQTTMessage as it would be received """
+
+    msg = mqtt.MQTTMessage(topic=topic.encode())
+    msg.payload = payload.encode()
+
+    return msg
+
+
+def synthetic_messages(args):
+    """ Generate messages for args.messages
+    readings spread evenly over args.stations stations. A station's
+    value changes with probability args.change_ratio, otherwise it
+    repeats its last value. args.gas_ratio of the messages are gas.
+    """
+
+    rng = random.Random(args.seed)
+    env_measures = ["temp", "humidity"]
+    values = {}
+
+    for i in range(args.messages):
+        station_id = f"bench_station{i % args.stations}"
+
+        if rng.random() < args.gas_ratio:
+            yield make_message(f"utility/gas/{station_id}", str(rng.randint(1, 50)))
+            continue
+
+        measure = env_measures[(i // args.stations) % len(env_measures)]
+        key = (station_id, measure)
+        if key not in values or rng.random() < args.change_ratio:
+            values[key] = round(rng.uniform(10, 30), 1)
+
+        yield make_message(f"env/{measure}/{station_id}", str(values[key]))
+
+
+def db_size(abs_db_path):
+    """ Size of the DB in bytes, including any WAL file """
+
+    return sum(os.path.getsize(_) for _ in (abs_db_path, abs_db_path + "-wal")
+               if os.path.exists(_))
+
+
+def percentile(sorted_values, pct):
+
+    if not sorted_values:
+        return None
+
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+
+    return sorted_values[index]
+
+
+def run_benchmark(args, smd, abs_db_path):
+    """ Run one benchmark and return the results dict """
+
+    config = configparser.ConfigParser()
+    config["storage-settings"] = {"archive_interval_s": str(args.archive_interval_s),
+                                  "write_behind": str(args.write_behind),
+                                  "flush_size": str(args.flush_size),
+                                  "max_flush_latency_s": str(args.max_flush_latency_s),
+                                  "last_updates_flush_s": str(args.last_updates_flush_s),
+                                  "journal_mode": args.journal_mode,
+                                  "synchronous": args.synchronous}
+    config["archive-policy"] = {"default": args.archive_policy}
+
+    userdata = smd.setup_storage(config, abs_db_path, [])
+
+    size_before = db_size(abs_db_path)
+    latencies = []
+    interval = 1 / args.rate if args.rate else 0
+
+    start = time.perf_counter()
+    for i, msg in enumerate(synthetic_messages(args)):
+        if interval:
+            # Pace the messages, without drifting
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        t0 = time.perf_counter()
+        smd.on_message(None, userdata, msg)
+        latencies.append(time.perf_counter() - t0)
+
+    callbacks_done = time.perf_counter()
+    # Include the time to commit everything still queued
+    smd.shutdown_storage(userdata)
+    finished = time.perf_counter()
+
+    size_after = db_size(abs_db_path)
+
+    with sqlite3.connect(abs_db_path) as conn:
+        archived = sum(conn.execute(f"SELECT COUNT(*) FROM {_}").fetchone()[0]
+                       for _ in ["temperature", "humidity", "gasUse"])
+
+    latencies.sort()
+    elapsed = finished - start
+
+    return {"messages": args.messages,
+            "archived_rows": archived,
+            "elapsed_s": elapsed,
+            "drain_s": finished - callbacks_done,
+            "msgs_per_s": args.messages / elapsed,
+            "callback_latency_ms": {"mean": statistics.fmean(latencies) * 1000,
+                                    "p50": percentile(latencies, 50) * 1000,
+                                    "p99": percentile(latencies, 99) * 1000,
+                                    "max": latencies[-1] * 1000},
+            "db_bytes_before": size_before,
+            "db_bytes_after": size_after,
+            "db_bytes_per_message": (size_after - size_before) / args.messages}
+
+
+def compare(results, baseline, tolerance):
+    """ Return a list of regressions compared to a previous
+    result, beyond the fractional tolerance.
+    """
+
+    regressions = []
+
+    old = baseline["results"]["msgs_per_s"]
+    new = results["msgs_per_s"]
+    if new < old * (1 - tolerance):
+        regressions.append(f"msgs_per_s fell from {old:.1f} to {new:.1f}")
+
+    old = baseline["results"]["callback_latency_ms"]["p99"]
+    new = results["callback_latency_ms"]["p99"]
+    if new > old * (1 + tolerance):
+        regressions.append(f"p99 callback latency rose from {old:.3f}ms to {new:.3f}ms")
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(prog="benchmark_ingest",
+                                     description=("Benchmark the ingest path of "
+                                                  "store-mqtt-data.py without a broker."))
+    parser.add_argument("--stations", type=int, default=100,
+                        help="Number of stations sending readings")
+    parser.add_argument("--messages", type=int, default=20000,
+                        help="Total number of messages to send")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Messages per second to send at, 0 for as fast as possible")
+    parser.add_argument("--change-ratio", type=float, default=0.5,
+                        help="Fraction of readings whose value differs from the last")
+    parser.add_argument("--gas-ratio", type=float, default=0.1,
+                        help="Fraction of messages that are gas readings")
+    parser.add_argument("--archive-interval-s", type=int, default=0,
+                        help="archive_interval_s setting")
+    parser.add_argument("--archive-policy", default="interval",
+                        help=("Archive policy for all measures, as in the "
+                              "[archive-policy] config section"))
+    parser.add_argument("--write-behind", action="store_true",
+                        help="Enable the write behind queue")
+    parser.add_argument("--flush-size", type=int, default=500)
+    parser.add_argument("--max-flush-latency-s", type=float, default=1.0)
+    parser.add_argument("--last-updates-flush-s", type=float, default=0)
+    parser.add_argument("--journal-mode", default="WAL")
+    parser.add_argument("--synchronous", default="NORMAL")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db-dir",
+                        help=("Directory for the temporary DB, to benchmark "
+                              "the storage it's on. Defaults to the system temp dir."))
+    parser.add_argument("--label", default="",
+                        help="Free text label stored with the results")
+    parser.add_argument("--output",
+                        help="Write the JSON results here as well as to stdout")
+    parser.add_argument("--baseline",
+                        help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help=("Fractional change from the baseline allowed "
+                              "before it's reported as a regression"))
+
+    args = parser.parse_args()
+
+    smd = load_store_mqtt_data()
+    # Don't let per message logging skew the numbers
+    smd.logger.setLevel("WARNING")
+
+    with tempfile.TemporaryDirectory(dir=args.db_dir) as tmp_dir:
+        abs_db_path = os.path.join(tmp_dir, "benchmark.sqlite3")
+        results = run_benchmark(args, smd, abs_db_path)
+
+    report = {"label": args.label,
+              "settings": {_: getattr(args, _) for _ in vars(args)
+                           if _ not in ("output", "baseline", "label")},
+              "environment": {"python": platform.python_version(),
+                              "sqlite": sqlite3.sqlite_version,
+                              "machine": platform.machine()},
+              "results": results}
+
+    output = json.dumps(report, indent=2)
+    print(output)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+""" The modules are at the top of the repo, rather than in a package,
+    so it's put on the path for the tests.
+"""
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+
+
+@pytest.fixture
+def smd():
+    """ A freshly imported store-mqtt-data.py """
+
+    from import_captures import load_store_mqtt_data
+
+    return load_store_mqtt_data()
+
+
+@pytest.fixture
+def partitioned_db(tmp_path):
+    """ A DB partitioned by month, with hourly kitchen temperatures
+    from three months in their partitions, and a few in the main DB,
+    as if from before partitioning was turned on. Returns its path
+    and the times of all the readings.
+    """
+
+    import configparser
+
+    import import_captures
+    import schemas_and_tables as S
+    from storage import Storage
+
+    db_path = str(tmp_path / "partitioned.sqlite3")
+    start_utc = 1700000000
+
+    times = [start_utc + _ * 3600 for _ in range(0, 70 * 24, 5)]
+    capture = tmp_path / "capture.txt"
+    with open(capture, "w") as f:
+        for t in times:
+            f.write(f"{t} env/temp/kitchen {t // 3600 % 30}\n")
+
+    config = configparser.ConfigParser()
+    config.read_dict({"storage-settings": {"archive_interval_s": "0",
+                                           "partition_by": "month"}})
+    import_captures.import_captures(db_path, [str(capture)], config=config)
+
+    main_times = [start_utc + 1800, start_utc + 40 * 86400 + 1800, start_utc + 69 * 86400]
+    storage = Storage(db_path)
+    with storage.transaction():
+        for t in main_times:
+            storage.insert(S.env_tables["temp"]["table"],
+                           {"timestamp_utc": t, "station_id": "kitchen", "temp_c": t // 3600 % 30})
+    storage.close()
+
+    return db_path, sorted(times + main_times)
@@ -0,0 +1,39 @@
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import analytics
+
+""" Fitting gas use against heating degree days """
+
+
+def test_fit_leaves_out_days_without_temperatures():
+
+    start_utc = 1700006400 - 1700006400 % analytics.DAY_S
+    days = 6
+    # 50l base load plus 10l per degree day, with the outside
+    # temperature 1C lower each day
+    day_temps = [10.5 - _ for _ in range(days)]
+    litres = [50 + 10 * (analytics.HDD_BASE_C - _) for _ in day_temps]
+
+    gas_times = start_utc + np.arange(days) * analytics.DAY_S + 43200
+    volumes = np.array(litres, dtype=float)
+
+    # Hourly temperatures, except on days 2 and 4, which have none,
+    # and one after the last day, so its last hour is counted
+    temp_times = np.array([start_utc + day * analytics.DAY_S + hour * 3600
+                           for day in range(days) if day not in (2, 4)
+                           for hour in range(24)] + [start_utc + days * analytics.DAY_S],
+                          dtype=float)
+    temps = np.array([day_temps[min(int((_ - start_utc) // analytics.DAY_S), days - 1)]
+                      for _ in temp_times])
+
+    end_utc = start_utc + days * analytics.DAY_S - 1
+    result = analytics.gas_per_degree_day(gas_times, volumes, temp_times, temps,
+                                          start_utc, end_utc, method="integral")
+
+    assert np.isnan(result["degree_days"][[2, 4]]).all()
+    assert math.isclose(result["fit_litres_per_degree_day"], 10, rel_tol=1e-3)
+    assert math.isclose(result["fit_base_load_l"], 50, rel_tol=1e-2)
@@ -0,0 +1,81 @@
+import pytest
+
+from archive_policies import parse_policy
+
+""" Which readings each archive policy archives """
+
+
+def archived(policy, readings):
+    """ Run readings through a policy, keeping lastUpdates as the
+    storage would, and return those archived.
+    """
+
+    state = {}
+    last_update = None
+    result = []
+
+    for timestamp_utc, value in readings:
+        decided = policy.decide(state, last_update, timestamp_utc, value)
+        result += decided
+
+        last_update = dict(last_update or {"last_archive_time_utc": None,
+                                           "last_archive_value": None})
+        if decided:
+            last_update["last_archive_time_utc"], last_update["last_archive_value"] = decided[-1]
+        last_update["timestamp_utc"] = timestamp_utc
+        last_update["measure_value"] = value
+
+    return result
+
+
+def test_interval():
+
+    policy = parse_policy("interval", archive_interval_s=600)
+
+    assert archived(policy, [(1000, 20), (1300, 21), (1700, 21), (2400, 21), (2500, 22), (2600, 23)]) == \
+        [(1000, 20), (1700, 21), (2500, 22)]
+
+
+def test_deadband_abs_with_heartbeat():
+
+    policy = parse_policy("deadband abs=0.5 max_gap_s=3600")
+
+    assert archived(policy, [(0, 20), (60, 20.3), (120, 20.6), (180, 20.2), (3800, 20.2)]) == \
+        [(0, 20), (120, 20.6), (3800, 20.2)]
+
+
+def test_deadband_pct():
+
+    policy = parse_policy("deadband pct=10")
+
+    assert archived(policy, [(0, 10), (60, 10.5), (120, 11.5), (180, 12)]) == [(0, 10), (120, 11.5)]
+
+
+def test_swinging_door():
+
+    policy = parse_policy("swinging_door deviation=0.5")
+    readings = [(0, 0), (10, 1), (20, 2), (30, 3), (40, 2), (50, 1)]
+
+    # Only the turning point, the rest are on straight lines
+    assert archived(policy, readings) == [(0, 0), (30, 3)]
+
+
+def test_swinging_door_heartbeat():
+
+    policy = parse_policy("swinging_door deviation=0.5 max_gap_s=100")
+
+    assert archived(policy, [(0, 0), (50, 0), (100, 0), (150, 0)]) == [(0, 0), (50, 0), (100, 0)]
+
+
+@pytest.mark.parametrize("spec, message", [("swinging_door deviaton=0.5", "deviaton"),
+                                           ("deadband abs", "abs"),
+                                           ("swinging_door", "deviation="),
+                                           ("deadband max_gap_s=60", "abs= or pct="),
+                                           ("fancy", "Unknown archive policy")])
+def test_bad_specs_are_named(spec, message):
+
+    with pytest.raises(ValueError, match=message) as error:
+        parse_policy(spec)
+
+    if not spec.startswith("fancy"):
+        assert repr(spec) in str(error.value)
@@ -0,0 +1,164 @@
+import asyncio
+import socket
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+
+from async_ingest import BrokerConnection
+
+""" A broker connection's reconnecting and flow control, with a stub
+    client in place of paho's, and a socketpair for its socket.
+"""
+
+SETTINGS = {"host": "broker", "port": 1883, "keepalive": 60, "client_id": "test",
+            "username": None, "password": None, "clean_session": True,
+            "min_backoff_s": 0.01, "max_backoff_s": 0.05, "high_water": 4,
+            "duplicate_slots": 0}
+
+
+class StubClient:
+    """ Connects to a socketpair, and has the CONNACK give the next
+    of connack_codes, after which a refused connection is closed
+    by the broker, as Mosquitto does.
+    """
+
+    def __init__(self, connection, connack_codes=()):
+
+        self.connection = connection
+        self.connack_codes = list(connack_codes)
+        self.attempts = 0
+        self.subscribed = []
+        self.sockets = []
+
+    def connect(self, host, port, keepalive):
+        # In the executor, as paho's would be
+
+        self.attempts += 1
+        rc = self.connack_codes.pop(0) if self.connack_codes else 0
+        sock, peer = socket.socketpair()
+        self.sockets += [sock, peer]
+        self.connection._on_socket_open(self, None, sock)
+        self.connection.loop.call_soon_threadsafe(self._connack, sock, rc)
+
+        return 0
+
+    def _connack(self, sock, rc):
+
+        self.connection._on_connect(self, None, {}, rc)
+        if rc:
+            self.connection._on_socket_close(self, None, sock)
+
+        return None
+
+    def loop_read(self):
+
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_misc(self):
+
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def subscribe(self, subscriptions):
+
+        self.subscribed.append(subscriptions)
+
+        return None
+
+    def disconnect(self):
+
+        if self.connection._sock:
+            self.connection._on_socket_close(self, None, self.connection._sock)
+
+        return None
+
+    def close(self):
+
+        for sock in self.sockets:
+            sock.close()
+
+        return None
+
+
+async def wait_for(condition, timeout_s=5):
+
+    deadline = asyncio.get_running_loop().time() + timeout_s
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+    return None
+
+
+def test_reconnects_after_a_refused_connack():
+
+    connection = BrokerConnection("test", SETTINGS, [("env/temp/+", 1)], lambda *_: None)
+    client = connection.client = StubClient(connection, [mqtt.CONNACK_REFUSED_NOT_AUTHORIZED,
+                                                         mqtt.CONNACK_REFUSED_NOT_AUTHORIZED])
+
+    async def run():
+        connection.loop = asyncio.get_running_loop()
+        connection.queue = asyncio.Queue()
+        stop = asyncio.Event()
+        runner = asyncio.create_task(connection.run(stop))
+
+        await wait_for(lambda: connection.connected)
+        # Backed off twice, then reset by the successful connection
+        assert connection._backoff_s == SETTINGS["min_backoff_s"]
+
+        stop.set()
+        await runner
+        await connection.close()
+
+        return None
+
+    try:
+        asyncio.run(run())
+    finally:
+        client.close()
+
+    assert client.attempts == 3
+    assert client.subscribed == [[("env/temp/+", 1)]]
+    assert connection._sock is None
+
+
+def test_pauses_reading_at_high_water():
+
+    handled = []
+    connection = BrokerConnection("test", SETTINGS, [], lambda client, msg: handled.append(msg))
+    client = connection.client = StubClient(connection)
+
+    def message(mid):
+
+        return SimpleNamespace(topic="env/temp/kitchen", payload=b"21.5", qos=1, dup=False, mid=mid)
+
+    async def run():
+        connection.loop = asyncio.get_running_loop()
+        connection.queue = asyncio.Queue()
+        connection._closed = asyncio.Event()
+        client.connect("broker", 1883, 60)
+        await wait_for(lambda: connection._sock is not None)
+
+        for mid in range(4):
+            connection._on_message(client, None, message(mid))
+        assert connection._paused
+        # Not reading from the socket
+        assert not connection.loop.remove_reader(connection._sock)
+
+        # Resumed once the decoder's down to half of high_water
+        decoder = asyncio.create_task(connection.decode())
+        await wait_for(lambda: not connection._paused)
+        assert connection.loop.remove_reader(connection._sock)
+        connection.loop.add_reader(connection._sock, client.loop_read)
+
+        await wait_for(lambda: len(handled) == 4)
+        await connection.close()
+        decoder.cancel()
+
+        return None
+
+    try:
+        asyncio.run(run())
+    finally:
+        client.close()
+
+    assert [_.mid for _ in handled] == [0, 1, 2, 3]
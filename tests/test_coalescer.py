@@ -0,0 +1,113 @@
+import configparser
+import sqlite3
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from coalescer import Coalescer
+from metrics import metrics
+from topic_router import router_from_config
+
+""" Holding env readings, and what happens when too many are held """
+
+
+def reading(value, station_id="kitchen"):
+
+    return {"station_id": station_id, "measure_type": "temp_c", "measure_value": value}
+
+
+def overflowed(policy):
+
+    return metrics._counters.get(("readings_overflowed_total", (("overflow", policy),)), 0)
+
+
+class Sink:
+
+    def __init__(self):
+
+        self.calls = []
+
+    def __call__(self, readings, seqs):
+
+        self.calls.append(([_["measure_value"] for _ in readings], seqs))
+
+        return None
+
+
+@pytest.mark.parametrize("policy, kept", [("drop-oldest", [2, 3, 4]),
+                                          ("drop-newest", [1, 2, 3])])
+def test_drop_policies(policy, kept):
+
+    sink = Sink()
+    # Not started, so only flushed when asked
+    coalescer = Coalescer(sink, max_pending=3, overflow=policy)
+    before = overflowed(policy)
+
+    for seq, value in enumerate([1, 2, 3, 4]):
+        coalescer.add(reading(value), seq)
+    coalescer.flush()
+
+    assert overflowed(policy) - before == 1
+    # The dropped reading's message is acknowledged too
+    assert sink.calls == [(kept, [0, 1, 2, 3])]
+
+
+def test_block_policy_waits_for_a_flush():
+
+    sink = Sink()
+    coalescer = Coalescer(sink, max_pending=2, overflow="block")
+    before = overflowed("block")
+
+    coalescer.add(reading(1), 0)
+    coalescer.add(reading(2), 1)
+    adding = threading.Thread(target=coalescer.add, args=(reading(3), 2))
+    adding.start()
+    adding.join(0.2)
+    assert adding.is_alive()
+
+    coalescer.flush()
+    adding.join(2)
+    assert not adding.is_alive()
+    coalescer.flush()
+
+    assert overflowed("block") - before == 1
+    # Its message is only acknowledged with the reading
+    assert sink.calls == [([1, 2], [0, 1]), ([3], [2])]
+
+
+def test_window_flushes():
+
+    sink = Sink()
+    coalescer = Coalescer(sink, window_s=0.05)
+    coalescer.start()
+    coalescer.add(reading(1), 0)
+    coalescer.add(reading(2))
+    coalescer.stop()
+
+    assert sink.calls == [([1, 2], [0])]
+
+
+def test_newest_reading_wins(smd, tmp_path):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    config = configparser.ConfigParser()
+    config.read_dict({"storage-settings": {"archive_interval_s": "0"},
+                      "coalesce": {"enabled": "true", "window_s": "60"}})
+    router = router_from_config(config)
+    userdata = smd.setup_storage(config, db_path, router.subscriptions(smd.on_message), router)
+
+    for topic, payload in [("env/temp/kitchen", b"21.0"), ("env/temp/hall", b"18.0"),
+                           ("env/temp/kitchen", b"21.5"), ("env/humidity/kitchen", b"50"),
+                           ("env/temp/kitchen", b"22.0")]:
+        smd.on_message(None, userdata, SimpleNamespace(topic=topic, payload=payload,
+                                                       qos=0, dup=False, mid=0))
+    assert userdata["coalescer"].pending() == 5
+    smd.shutdown_storage(userdata)
+
+    conn = sqlite3.connect(db_path)
+    assert sorted(conn.execute("SELECT station_id, measure_type, measure_value "
+                               "FROM lastUpdates").fetchall()) == \
+        [("hall", "temp_c", 18.0), ("kitchen", "humidity_pct", 50.0),
+         ("kitchen", "temp_c", 22.0)]
+    conn.close()
@@ -0,0 +1,37 @@
+import pstats
+
+import schemas_and_tables as S
+from batch_writer import BatchWriter
+from diagnostics import Diagnostics
+from storage import Storage
+
+""" Profiling the threads doing the ingest work """
+
+
+def writer_job(storage):
+
+    storage.conn.execute("SELECT 1")
+
+    return None
+
+
+def test_profile_includes_the_writer_thread(tmp_path):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    S.bootstrap_db(db_path, S.all_tables(), S.all_statements())
+    writer = BatchWriter(Storage(db_path), max_flush_latency_s=0.01)
+    writer.start()
+
+    diagnostics = Diagnostics(str(tmp_path / "diagnostics"))
+    diagnostics._in_background = lambda func, *args: func(*args)
+
+    diagnostics.toggle_profile()
+    writer.submit(writer_job)
+    writer.stop()
+    diagnostics.toggle_profile()
+    writer.storage.close()
+
+    [path] = (tmp_path / "diagnostics").glob("profile-*.prof")
+    functions = {_[2] for _ in pstats.Stats(str(path)).stats}
+    assert "writer_job" in functions
+    assert "toggle_profile" in functions
@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+from duplicates import DuplicateFilter
+
+""" Dropping QoS 1 messages resent by the broker """
+
+
+def message(mid, payload, dup=False, qos=1, topic="env/temp/kitchen"):
+
+    return SimpleNamespace(topic=topic, payload=payload, mid=mid, qos=qos, dup=dup)
+
+
+def test_resent_message_is_dropped():
+
+    duplicates = DuplicateFilter(slots=8)
+
+    assert not duplicates.is_duplicate(message(1, b"21.5"))
+    assert duplicates.is_duplicate(message(1, b"21.5", dup=True))
+    # Without the dup flag it's a new message
+    assert not duplicates.is_duplicate(message(1, b"21.5"))
+
+
+def test_reused_packet_id_is_kept():
+
+    duplicates = DuplicateFilter(slots=8)
+
+    assert not duplicates.is_duplicate(message(1, b"21.5"))
+    assert not duplicates.is_duplicate(message(1, b"22.0", dup=True))
+    assert not duplicates.is_duplicate(message(1, b"21.5", dup=True, topic="env/temp/hall"))
+    # QoS 0 messages all have packet id 0
+    assert not duplicates.is_duplicate(message(0, b"21.5", qos=0))
+    assert not duplicates.is_duplicate(message(0, b"21.5", dup=True, qos=0))
+
+
+def test_oldest_are_forgotten():
+
+    duplicates = DuplicateFilter(slots=2)
+
+    for mid in (1, 2, 3):
+        duplicates.is_duplicate(message(mid, b"21.5"))
+
+    assert not duplicates.is_duplicate(message(1, b"21.5", dup=True))
+    assert duplicates.is_duplicate(message(3, b"21.5", dup=True))
@@ -0,0 +1,96 @@
+import io
+import json
+
+import pytest
+
+import export_data
+import schemas_and_tables as S
+from storage import Storage
+
+""" Exporting only the rows added since the last export """
+
+START_UTC = 1700000000
+
+
+def add(db_path, *offsets_s):
+
+    storage = Storage(db_path)
+    with storage.transaction():
+        for offset_s in offsets_s:
+            storage.insert(S.gas_table, {"timestamp_utc": START_UTC + offset_s,
+                                         "station_id": "meter",
+                                         "volume_l": offset_s,
+                                         "is_meter_reading": False})
+    storage.close()
+
+    return None
+
+
+def exported(db_path, state_path):
+
+    f = io.StringIO()
+    export_data.export(db_path, "gas", f, fmt="ndjson", state_path=str(state_path))
+
+    return [json.loads(_)["volume_l"] for _ in f.getvalue().splitlines()]
+
+
+def test_since_last(tmp_path):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    state_path = tmp_path / "state.json"
+    S.bootstrap_db(db_path, S.all_tables(), S.all_statements())
+
+    add(db_path, 1, 2)
+    assert exported(db_path, state_path) == [1, 2]
+    add(db_path, 3)
+    assert exported(db_path, state_path) == [3]
+    assert exported(db_path, state_path) == []
+
+
+def test_since_last_after_rowids_are_reused(tmp_path, caplog):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    state_path = tmp_path / "state.json"
+    S.bootstrap_db(db_path, S.all_tables(), S.all_statements())
+
+    add(db_path, 1, 2, 3)
+    assert exported(db_path, state_path) == [1, 2, 3]
+
+    # As if restored from a backup taken after the first reading,
+    # the new readings get the rowids of the ones already exported.
+    storage = Storage(db_path)
+    with storage.transaction():
+        storage.conn.execute(f"DELETE FROM {S.gas_table.tablename} WHERE volume_l > 1")
+    storage.close()
+    add(db_path, 4, 5)
+
+    assert exported(db_path, state_path) == [4, 5]
+    assert "rowids" in caplog.text
+    add(db_path, 6)
+    assert exported(db_path, state_path) == [6]
+
+
+def test_parquet_with_a_null_first_chunk(tmp_path):
+
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    db_path = str(tmp_path / "test.sqlite3")
+    S.bootstrap_db(db_path, S.all_tables(), S.all_statements())
+
+    storage = Storage(db_path)
+    with storage.transaction():
+        for offset_s, value in enumerate([None, None, 20.5, 21.0]):
+            storage.insert(S.env_tables["temp"]["table"], {"timestamp_utc": START_UTC + offset_s,
+                                                           "station_id": "kitchen",
+                                                           "temp_c": value})
+    storage.close()
+
+    path = tmp_path / "temp.parquet"
+    with open(path, "wb") as f:
+        assert export_data.export(db_path, "temp", f, fmt="parquet", with_location=True,
+                                  chunk_size=2) == 4
+
+    data = pyarrow.parquet.read_table(path)
+    assert data.column("temp_c").to_pylist() == [None, None, 20.5, 21.0]
+    assert data.schema.field("location").type == pyarrow.string()
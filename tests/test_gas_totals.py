@@ -0,0 +1,64 @@
+import pytest
+
+import gas_totals
+import schemas_and_tables as S
+from storage import Storage
+
+""" Gas used over a period, from the running totals """
+
+START_UTC = 1700000000
+
+
+@pytest.fixture
+def storage(tmp_path):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    S.bootstrap_db(db_path, S.all_tables(), S.all_statements())
+    storage = Storage(db_path)
+    yield storage
+    storage.close()
+
+
+def add(storage, station_id, offset_s, volume_l, is_meter_reading=False):
+
+    decoded = {"timestamp_utc": START_UTC + offset_s,
+               "station_id": station_id,
+               "volume_l": volume_l,
+               "is_meter_reading": is_meter_reading}
+    with storage.transaction():
+        storage.insert(S.gas_table, decoded)
+        gas_totals.add_gas_reading(storage, decoded)
+
+    return None
+
+
+def test_usage_from_a_meter_reading(storage):
+
+    add(storage, "meter", 0, 123456, is_meter_reading=True)
+    add(storage, "meter", 60, 5)
+    add(storage, "meter", 120, 7)
+
+    # Not the meter's value
+    assert gas_totals.usage_between(storage.conn, "meter", START_UTC - 60, START_UTC + 180) == 12
+    assert gas_totals.usage_between(storage.conn, "meter", START_UTC + 90, START_UTC + 180) == 7
+    assert gas_totals.usage_between(storage.conn, "meter", START_UTC - 60, START_UTC - 1) == 0
+
+
+def test_usage_from_a_usage_reading(storage):
+
+    add(storage, "meter", 0, 3)
+    add(storage, "meter", 60, 5)
+
+    assert gas_totals.usage_between(storage.conn, "meter", START_UTC - 60, START_UTC + 180) == 8
+    assert gas_totals.usage_between(storage.conn, "meter", START_UTC, START_UTC + 180) == 5
+
+
+def test_usage_across_a_meter_correction(storage):
+
+    add(storage, "meter", 0, 1000, is_meter_reading=True)
+    add(storage, "meter", 60, 5)
+    # The meter says 2l more was used than measured
+    add(storage, "meter", 120, 1007, is_meter_reading=True)
+    add(storage, "meter", 180, 4)
+
+    assert gas_totals.usage_between(storage.conn, "meter", START_UTC - 60, START_UTC + 240) == 11
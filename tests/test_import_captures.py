@@ -0,0 +1,80 @@
+import configparser
+import os
+import sqlite3
+
+import import_captures
+import schemas_and_tables as S
+from partitions import PartitionSet, query_range
+
+""" Importing captures into a partitioned DB """
+
+START_UTC = 1700000000
+HOURS = 60 * 24
+
+
+def write_capture(path, station_id, hours):
+
+    with open(path, "w") as f:
+        for i in hours:
+            f.write(f"{START_UTC + i * 3600} env/temp/{station_id} {15 + i % 10}\n")
+
+    return str(path)
+
+
+def config_for():
+
+    config = configparser.ConfigParser()
+    config.read_dict({"storage-settings": {"archive_interval_s": "0",
+                                           "partition_by": "month"}})
+
+    return config
+
+
+def stored_times(db_path):
+
+    return [_[0] for _ in query_range(db_path, S.env_tables["temp"]["table"],
+                                      START_UTC, START_UTC + HOURS * 3600,
+                                      columns="timestamp_utc")]
+
+
+def test_import_in_several_batches_and_files(tmp_path):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    # The second file goes back into the months of the first
+    first = write_capture(tmp_path / "first.txt", "kitchen", range(0, HOURS, 2))
+    second = write_capture(tmp_path / "second.txt", "hall", range(1, HOURS, 2))
+
+    counts = import_captures.import_captures(db_path, [first, second], config=config_for(),
+                                             batch_size=100)
+    assert counts["readings"] == HOURS
+
+    assert sorted(stored_times(db_path)) == [START_UTC + _ * 3600 for _ in range(HOURS)]
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT COUNT(*) FROM temperature").fetchone()[0] == 0
+    conn.close()
+
+    # Only sealed once the import has finished
+    partitions = PartitionSet(db_path)
+    imported = [_ for _ in partitions.all() if _[0] < "2024-02"]
+    assert [_[0] for _ in imported] == ["2023-11", "2023-12", "2024-01"]
+    assert all(partitions.is_sealed(_[0]) for _ in imported)
+
+
+def test_import_into_sealed_partitions(tmp_path):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    first = write_capture(tmp_path / "first.txt", "kitchen", range(0, HOURS, 2))
+    import_captures.import_captures(db_path, [first], config=config_for())
+
+    sizes = {_: os.path.getsize(path) for _, path in PartitionSet(db_path).all()}
+
+    second = write_capture(tmp_path / "second.txt", "hall", range(1, HOURS, 2))
+    import_captures.import_captures(db_path, [second], config=config_for())
+
+    # The sealed partitions are unchanged, the new readings are in the main DB
+    assert {_: os.path.getsize(path) for _, path in PartitionSet(db_path).all()
+            if _ in sizes} == sizes
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT COUNT(*) FROM temperature").fetchone()[0] == HOURS // 2
+    conn.close()
+    assert sorted(stored_times(db_path)) == [START_UTC + _ * 3600 for _ in range(HOURS)]
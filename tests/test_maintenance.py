@@ -0,0 +1,70 @@
+import configparser
+import logging
+import sqlite3
+
+import schemas_and_tables as S
+from maintenance import Maintenance, maintenance_from_config
+
+""" Retention settings """
+
+
+def config_for(retention, partition_by="month"):
+
+    config = configparser.ConfigParser()
+    config["storage-settings"] = {"partition_by": partition_by}
+    config["retention"] = {"enabled": "true", **retention}
+
+    return config
+
+
+def test_warns_of_shorter_retention_in_partitions(tmp_path, caplog):
+
+    db_path = str(tmp_path / "test.sqlite3")
+
+    with caplog.at_level(logging.WARNING, logger="maintenance"):
+        maintenance_from_config(config_for({"default": "365", "temp": "30"}), db_path,
+                                start=False)
+    assert "kept for the longest, 365 days" in caplog.text
+
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger="maintenance"):
+        maintenance_from_config(config_for({"temp": "30"}), db_path, start=False)
+    assert "kept for the longest, forever" in caplog.text
+
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger="maintenance"):
+        maintenance_from_config(config_for({"default": "365"}), db_path, start=False)
+        maintenance_from_config(config_for({"default": "365", "temp": "30"}, "none"),
+                                db_path, start=False)
+    assert not caplog.records
+
+
+def test_expire_stops_at_the_first_newer_row(tmp_path):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    S.bootstrap_db(db_path, S.all_tables(), S.all_statements())
+    table = S.env_tables["temp"]["table"]
+    now = 1700000000
+    old = now - 100 * 86400
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("BEGIN")
+    times = [old + _ for _ in range(5)] + [now + _ for _ in range(10000)] + [old + 10]
+    conn.executemany(f"INSERT INTO {table.tablename}(timestamp_utc, station_id, temp_c) "
+                     "VALUES(?, 'kitchen', 20)", [(_,) for _ in times])
+    conn.execute("COMMIT")
+
+    maintenance = Maintenance(db_path, {table: 30 * 86400}, pause_s=0, chunk_rows=500)
+    assert maintenance.expire_table(conn, table, now - 30 * 86400) == 5
+
+    # Nothing left to delete, so only the first chunk is read
+    steps = []
+    conn.set_progress_handler(lambda: steps.append(1), 100)
+    assert maintenance.expire_table(conn, table, now - 30 * 86400) == 0
+    conn.set_progress_handler(None, 0)
+    assert len(steps) < 100
+
+    # The late row is kept until the rows before it have expired
+    assert conn.execute(f"SELECT COUNT(*) FROM {table.tablename}").fetchone()[0] == 10001
+    assert maintenance.expire_table(conn, table, now + 20000) == 10001
+    conn.close()
@@ -0,0 +1,84 @@
+import configparser
+import time
+
+from metrics import metrics
+from topic_router import router_from_config
+
+""" What the ingest path counts and times """
+
+
+def setup(smd, tmp_path):
+
+    config = configparser.ConfigParser()
+    config.read_dict({"storage-settings": {"archive_interval_s": "0"}})
+    router = router_from_config(config)
+
+    return smd.setup_storage(config, str(tmp_path / "test.sqlite3"),
+                             router.subscriptions(smd.on_message), router)
+
+
+def histogram_sum(name, labels):
+
+    histogram = metrics._histograms.get((name, labels))
+
+    return histogram.sum if histogram else 0.0
+
+
+def test_archiving_is_timed_once(smd, tmp_path, monkeypatch):
+
+    userdata = setup(smd, tmp_path)
+    archive_env_measurement = smd.archive_env_measurement
+
+    def slow_archive(storage, decoded, env_tables):
+        time.sleep(0.1)
+        return archive_env_measurement(storage, decoded, env_tables)
+
+    monkeypatch.setattr(smd, "archive_env_measurement", slow_archive)
+    latest = (("operation", "update_env_latest"),)
+    before = histogram_sum("db_seconds", latest)
+
+    smd.store_reading(userdata, "env", {"station_id": "kitchen",
+                                        "timestamp_utc": time.time(),
+                                        "measure_type": "temp_c",
+                                        "measure_value": 21.5,
+                                        "measure": "temp"})
+    smd.shutdown_storage(userdata)
+
+    assert histogram_sum("db_seconds", latest) - before < 0.05
+
+
+class StubPool:
+
+    def __init__(self, readings, stopping):
+
+        self._readings = readings
+        self._stopping = stopping
+
+    def readings(self):
+
+        yield from self._readings
+
+    def stop(self):
+
+        yield from self._stopping
+
+
+def test_relayed_messages_are_counted(smd, tmp_path):
+
+    userdata = setup(smd, tmp_path)
+    now = time.time()
+
+    def env(value):
+        return {"station_id": "kitchen", "timestamp_utc": now, "measure_type": "temp_c",
+                "measure_value": value, "measure": "temp"}
+
+    family = (("family", "env"),)
+    before = metrics._counters.get(("messages_received_total", family), 0)
+
+    smd.store_relayed(StubPool([("env", env(21.0)), ("batch", [env(21.5), env(22.0)])],
+                               [("env", env(22.5))]), userdata)
+    smd.shutdown_storage(userdata)
+
+    assert metrics._counters[("messages_received_total", family)] - before == 2
+    assert metrics._counters[("messages_received_total", (("family", "batch"),))] >= 1
+    assert "kitchen" in metrics._last_seen
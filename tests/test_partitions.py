@@ -0,0 +1,56 @@
+import configparser
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import schemas_and_tables as S
+from partitions import PartitionSet, period_key, query_range
+from topic_router import router_from_config
+
+""" Readings for partitions that aren't attached """
+
+
+@pytest.mark.parametrize("write_behind", [True, False])
+def test_old_readings_go_to_main_db(smd, tmp_path, write_behind):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    config = configparser.ConfigParser()
+    config.read_dict({"storage-settings": {"write_behind": str(write_behind).lower(),
+                                           "max_flush_latency_s": "0.05",
+                                           "archive_interval_s": "0",
+                                           "partition_by": "month"}})
+    router = router_from_config(config)
+    userdata = smd.setup_storage(config, db_path, router.subscriptions(smd.on_message), router)
+
+    now = time.time()
+    old = now - 400 * 86400
+    payload = f'["temp", {old}, 18.5]\n["temp", {now}, 21.5]'.encode()
+    smd.on_message(None, userdata, SimpleNamespace(topic="env/batch/kitchen", payload=payload,
+                                                   qos=0, dup=False, mid=0))
+    smd.shutdown_storage(userdata)
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT timestamp_utc FROM temperature").fetchall() == [(old,)]
+    conn.close()
+
+    partitions = PartitionSet(db_path)
+    assert [_[0] for _ in partitions.existing(old, now)] == [period_key(now)]
+    assert [_[0] for _ in query_range(db_path, S.env_tables["temp"]["table"], old, now,
+                                      columns="temp_c")] == [18.5, 21.5]
+
+
+def test_query_range_is_in_time_order(partitioned_db):
+
+    db_path, times = partitioned_db
+    table = S.env_tables["temp"]["table"]
+
+    partitions = PartitionSet(db_path)
+    assert len(partitions.existing(times[0], times[-1])) >= 3
+
+    assert [_[0] for _ in query_range(db_path, table, times[0], times[-1],
+                                      columns="timestamp_utc")] == times
+    assert [_[0] for _ in query_range(db_path, table, times[0], times[-1],
+                                      columns="timestamp_utc",
+                                      descending=True)] == times[::-1]
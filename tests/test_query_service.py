@@ -0,0 +1,16 @@
+import query_service
+
+""" History read from a partitioned DB """
+
+
+def test_capped_history_is_the_newest(partitioned_db):
+
+    db_path, times = partitioned_db
+
+    readings = query_service.history_from_db(db_path, "kitchen", "temp",
+                                             times[0], times[-1], max_rows=50)
+    assert [_["timestamp_utc"] for _ in readings] == times[-50:]
+
+    readings = query_service.history_from_db(db_path, "kitchen", "temp",
+                                             times[0], times[-1], max_rows=len(times) + 1)
+    assert [_["timestamp_utc"] for _ in readings] == times
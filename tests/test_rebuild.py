@@ -0,0 +1,68 @@
+import configparser
+import sqlite3
+
+import gas_totals
+import import_captures
+import rollups
+import schemas_and_tables as S
+from partitions import PartitionSet
+from storage import Storage
+
+""" Rebuilding the rollups and gas totals of a partitioned DB """
+
+START_UTC = 1700000000
+
+TABLES = ["envRollupHourly", "envRollupDaily", "gasRollupHourly", "gasRollupDaily",
+          gas_totals.TOTALS]
+
+
+def snapshot(conn):
+
+    return {_: sorted(conn.execute(f"SELECT * FROM {_}").fetchall()) for _ in TABLES}
+
+
+def test_rebuild_reads_partitions(tmp_path):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    capture = tmp_path / "capture.txt"
+
+    # Three months of readings
+    with open(capture, "w") as f:
+        for i in range(0, 90 * 24):
+            t = START_UTC + i * 3600
+            f.write(f"{t} env/temp/kitchen {15 + i % 10}\n")
+            f.write(f"{t} utility/gas/meter {i % 7}\n")
+
+    config = configparser.ConfigParser()
+    config.read_dict({"storage-settings": {"archive_interval_s": "0",
+                                           "partition_by": "month"}})
+    import_captures.import_captures(db_path, [str(capture)], config=config)
+
+    # and a meter reading part way, added to the main DB
+    meter = {"timestamp_utc": START_UTC + 40 * 86400 + 1800,
+             "station_id": "meter",
+             "volume_l": 100000,
+             "is_meter_reading": True}
+    storage = Storage(db_path)
+    with storage.transaction():
+        storage.insert(S.gas_table, meter)
+        gas_totals.add_gas_reading(storage, meter)
+    storage.close()
+
+    # One per month, and the current month's, attached at start up
+    partitions = PartitionSet(db_path)
+    assert [_[0] for _ in partitions.all()][:4] == ["2023-11", "2023-12", "2024-01", "2024-02"]
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    before = snapshot(conn)
+    assert all(before.values())
+    assert conn.execute("SELECT COUNT(*) FROM temperature").fetchone()[0] == 0
+    assert conn.execute("SELECT MAX(total_l) FROM gasTotals").fetchone()[0] > 100000
+
+    conn.execute("BEGIN IMMEDIATE")
+    rollups.backfill(conn, partitions=partitions)
+    gas_totals.backfill(conn, partitions=partitions)
+    conn.execute("COMMIT")
+
+    assert snapshot(conn) == before
+    conn.close()
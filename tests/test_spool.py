@@ -0,0 +1,72 @@
+import configparser
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from spool import Spool
+from topic_router import router_from_config
+
+""" Messages whose DB job fails stay in the spool, and are replayed """
+
+
+def message(topic, payload):
+
+    return SimpleNamespace(topic=topic, payload=payload, qos=0, dup=False, mid=0)
+
+
+def config_for(write_behind, coalesce):
+
+    config = configparser.ConfigParser()
+    config.read_dict({"storage-settings": {"write_behind": str(write_behind).lower(),
+                                           "max_flush_latency_s": "0.05",
+                                           "archive_interval_s": "0"},
+                      "spool": {"enabled": "true"},
+                      "coalesce": {"enabled": str(coalesce).lower(),
+                                   "window_s": "0.05"}})
+
+    return config
+
+
+def run(smd, config, db_path, messages=()):
+
+    router = router_from_config(config)
+    userdata = smd.setup_storage(config, db_path, router.subscriptions(smd.on_message), router)
+    smd.replay_spool(userdata)
+    for msg in messages:
+        smd.on_message(None, userdata, msg)
+    smd.shutdown_storage(userdata)
+
+    return None
+
+
+@pytest.mark.parametrize("write_behind,coalesce", [(True, False), (False, False), (True, True)])
+def test_failed_job_is_replayed(smd, tmp_path, monkeypatch, write_behind, coalesce):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    config = config_for(write_behind, coalesce)
+    archive_gas_reading = smd.archive_gas_reading
+
+    def archive_gas_reading_fails(storage, decoded, gas_table):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(smd, "archive_gas_reading", archive_gas_reading_fails)
+    run(smd, config, db_path, [message("utility/gas/meter", b"12"),
+                               message("env/temp/kitchen", b"21.5")])
+
+    # Only the failed message is left
+    spool = Spool(db_path + ".spool")
+    assert [(_.topic, _.payload) for _ in spool.unacknowledged()] == [("utility/gas/meter", b"12")]
+    spool.close()
+
+    monkeypatch.setattr(smd, "archive_gas_reading", archive_gas_reading)
+    run(smd, config, db_path)
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT station_id, volume_l FROM gasUse").fetchall() == [("meter", 12)]
+    assert conn.execute("SELECT COUNT(*) FROM temperature").fetchone()[0] == 1
+    conn.close()
+
+    spool = Spool(db_path + ".spool")
+    assert spool.pending() == 0
+    spool.close()
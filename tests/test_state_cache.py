@@ -0,0 +1,79 @@
+import schemas_and_tables as S
+from batch_writer import BatchWriter
+from state_cache import LastUpdatesCache
+from storage import Storage
+
+""" Writing the lastUpdates cache back, when the writes fail """
+
+
+def setup(tmp_path):
+
+    db_path = str(tmp_path / "test.sqlite3")
+    S.create_table(db_path, S.last_update_table)
+
+    storage = Storage(db_path)
+    # A deferred foreign key, so a job can make the commit fail
+    storage.conn.execute("PRAGMA foreign_keys=ON")
+    storage.conn.execute("CREATE TABLE parent(id INTEGER PRIMARY KEY)")
+    storage.conn.execute("CREATE TABLE child(parent_id INTEGER "
+                         "REFERENCES parent(id) DEFERRABLE INITIALLY DEFERRED)")
+
+    cache = LastUpdatesCache(S.last_update_table)
+    cache.record({"station_id": "kitchen",
+                  "timestamp_utc": 1700000000,
+                  "measure_type": "temp_c",
+                  "measure_value": 21.5,
+                  "last_archive_time_utc": 1700000000,
+                  "last_archive_value": 21.5})
+
+    return storage, cache
+
+
+def stored_rows(storage):
+
+    return storage.conn.execute("SELECT COUNT(*) FROM lastUpdates").fetchone()[0]
+
+
+def flush_then_fail(storage, cache):
+
+    cache.flush(storage)
+    raise RuntimeError("Job failed after flushing")
+
+
+def flush_then_break_the_commit(storage, cache):
+
+    cache.flush(storage)
+    storage.conn.execute("INSERT INTO child VALUES (1)")
+
+    return None
+
+
+def test_rows_stay_dirty_when_the_job_fails(tmp_path):
+
+    storage, cache = setup(tmp_path)
+    writer = BatchWriter(storage, max_flush_latency_s=0.01)
+    writer.start()
+    writer.submit(flush_then_fail, cache)
+    writer.stop()
+
+    assert stored_rows(storage) == 0
+    assert cache.dirty == {("kitchen", "temp_c")}
+
+
+def test_rows_stay_dirty_when_the_commit_fails(tmp_path):
+
+    storage, cache = setup(tmp_path)
+    writer = BatchWriter(storage, max_flush_latency_s=0.01)
+    writer.start()
+    writer.submit(flush_then_break_the_commit, cache)
+    writer.stop()
+
+    assert stored_rows(storage) == 0
+    assert cache.dirty == {("kitchen", "temp_c")}
+
+    # Written by the next flush that commits
+    with storage.transaction():
+        cache.flush(storage)
+
+    assert stored_rows(storage) == 1
+    assert not cache.dirty
@@ -0,0 +1,169 @@
+import configparser
+
+import pytest
+
+import schemas_and_tables as S
+from topic_router import BATCH_RECORD, Route, TopicRouter, router_from_config
+
+""" Finding a topic's route, and the routes in the config """
+
+
+@pytest.fixture(autouse=True)
+def env_tables(monkeypatch):
+    """ Measures added by the routes are only kept for the test """
+
+    monkeypatch.setattr(S, "env_tables", dict(S.env_tables))
+
+    return None
+
+
+def config_for(sections):
+
+    config = configparser.ConfigParser()
+    config.read_dict(sections)
+
+    return config
+
+
+def test_wildcards():
+
+    exact = Route("env/temp/kitchen", "env", measure="temp", station_level=2)
+    plus = Route("env/temp/+", "env", measure="temp")
+    hash_ = Route("env/#", "env", measure="humidity", station_level=1)
+    deep = Route("home/+/sensors/+/temp", "env", measure="temp", station_level=1)
+    router = TopicRouter([exact, plus, hash_, deep])
+
+    assert router.match("env/temp/kitchen") == (exact, "kitchen")
+    assert router.match("env/temp/hall") == (plus, "hall")
+    assert router.match("env/pressure/hall") == (hash_, "pressure")
+    assert router.match("home/hall/sensors/3/temp") == (deep, "hall")
+    assert router.match("home/hall/sensors/3") is None
+    assert router.match("other/temp/hall") is None
+    # The station level has to be in the topic
+    assert router.match("env") is None
+    # Wildcards don't match $SYS topics
+    assert TopicRouter([Route("#", "env", measure="temp", station_level=0)]).match("$SYS/x") is None
+
+
+def test_results_are_cached():
+
+    router = TopicRouter([Route("env/temp/+", "env", measure="temp")], max_cached_topics=2)
+
+    first = router.match("env/temp/a")
+    assert router.match("env/temp/a") is first
+    router.match("env/temp/b")
+    router.match("env/temp/c")
+    assert len(router._cache) <= 2
+    assert router.match("env/temp/a") == first
+
+
+def test_two_routes_for_a_pattern():
+
+    with pytest.raises(ValueError, match="Two routes"):
+        TopicRouter([Route("env/temp/+", "env", measure="temp"),
+                     Route("env/temp/+", "gas")])
+
+
+def test_routes_from_config():
+
+    config = config_for({"client": {"qos": "1"},
+                         "route:env/temp/+": {"measure": "temp"},
+                         "route:env/pressure/+": {"measure": "pressure", "unit": "hpa",
+                                                  "policy": "deadband abs=1", "qos": "0"},
+                         "route:utility/gas/+": {"decoder": "gas"},
+                         "route:env/batch/+": {"decoder": "batch", "format": "struct",
+                                               "measures": "temp, pressure"}})
+    router = router_from_config(config)
+
+    temp, pressure, gas, batch = router.routes
+    assert (temp.measure_type, temp.qos) == ("temp_c", 1)
+    assert (pressure.measure_type, pressure.qos) == ("pressure_hpa", 0)
+    assert S.env_tables["pressure"]["table"].tablename == "pressure"
+    assert router.policies() == {"pressure": "deadband abs=1"}
+    assert gas.parse is int
+    assert batch.measures == ["temp", "pressure"]
+    assert router.subscriptions(None) == [("env/temp/+", None, 1), ("env/pressure/+", None, 0),
+                                          ("utility/gas/+", None, 1), ("env/batch/+", None, 1)]
+
+
+def test_default_routes():
+
+    router = router_from_config(config_for({}))
+
+    assert [_.pattern for _ in router.routes] == ["env/temp/+", "env/humidity/+",
+                                                  "utility/gas/+", "env/batch/+"]
+
+
+@pytest.mark.parametrize("section, message", [({"measure": "bad-name"}, "measure"),
+                                              ({"measure": "co2", "table": "gasUse"}, "gasUse"),
+                                              ({"measure": "co2", "table": "lastupdates"},
+                                               "lastupdates"),
+                                              ({"measure": "co2", "table": "stations"},
+                                               "stations"),
+                                              ({"measure": "co2", "table": "envRollupDaily"},
+                                               "envRollupDaily"),
+                                              ({"measure": "co2", "table": "temperature"},
+                                               "temperature"),
+                                              ({"decoder": "light"}, "kind")])
+def test_bad_routes(section, message):
+
+    with pytest.raises(ValueError, match=message):
+        router_from_config(config_for({"route:env/co2/+": section}))
+
+
+def batch_route(batch_format="jsonl"):
+
+    return Route("env/batch/+", "batch", batch_format=batch_format, measures=["temp", "humidity"])
+
+
+def readings_of(decoded):
+
+    return [(_["measure"], _["timestamp_utc"], _["measure_value"]) for _ in decoded]
+
+
+def test_jsonl_batch():
+
+    payload = b'["temp", 1700000000, 21.5]\n\n["humidity", 1700000060, 55]\n'
+
+    assert readings_of(batch_route().decode("kitchen", payload, 0)) == \
+        [("temp", 1700000000, 21.5), ("humidity", 1700000060, 55)]
+
+
+def test_jsonl_batch_skips_bad_lines():
+
+    payload = (b'["temp", 1700000000, 21.5]\n'
+               b'["temp", 17000\n'
+               b'["temp", 1700000060]\n'
+               b'["pressure", 1700000060, 1013]\n'
+               b'["temp", 1700000120, 22.0]\n')
+
+    assert readings_of(batch_route().decode("kitchen", payload, 0)) == \
+        [("temp", 1700000000, 21.5), ("temp", 1700000120, 22.0)]
+
+
+def test_struct_batch():
+
+    payload = BATCH_RECORD.pack(0, 1700000000, 21.5) + BATCH_RECORD.pack(1, 1700000060, 55.0)
+
+    assert readings_of(batch_route("struct").decode("kitchen", payload, 0)) == \
+        [("temp", 1700000000, 21.5), ("humidity", 1700000060, 55.0)]
+
+
+def test_struct_batch_skips_bad_records():
+
+    payload = (BATCH_RECORD.pack(0, 1700000000, 21.5)
+               + BATCH_RECORD.pack(7, 1700000030, 1.0)
+               + BATCH_RECORD.pack(0, 1700000060, 22.0)
+               # truncated
+               + BATCH_RECORD.pack(1, 1700000120, 55.0)[:5])
+
+    assert readings_of(batch_route("struct").decode("kitchen", payload, 0)) == \
+        [("temp", 1700000000, 21.5), ("temp", 1700000060, 22.0)]
+
+
+@pytest.mark.parametrize("batch_format, payload", [("jsonl", b"not json\n[1, 2]\n"),
+                                                   ("struct", b"\x00\x01\x02")])
+def test_batch_with_no_good_readings(batch_format, payload):
+
+    with pytest.raises(ValueError):
+        batch_route(batch_format).decode("kitchen", payload, 0)
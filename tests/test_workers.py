@@ -0,0 +1,135 @@
+import queue
+import signal
+import threading
+import time
+
+from workers import Relay, WorkerPool
+
+""" Relaying readings from the workers, in batches """
+
+
+def reading(index):
+
+    return ("env", {"station_id": "kitchen", "timestamp_utc": index})
+
+
+def test_relay_sends_full_batches():
+
+    out = queue.Queue()
+    relay = Relay(out, batch_size=3, max_latency_s=60)
+
+    for index in range(7):
+        relay.put(*reading(index))
+
+    assert out.get_nowait() == [reading(_) for _ in range(3)]
+    assert out.get_nowait() == [reading(_) for _ in range(3, 6)]
+    # The 7th waits for the batch to fill, or a flush
+    assert out.empty()
+
+    relay.flush()
+    assert out.get_nowait() == [reading(6)]
+    relay.flush()
+    assert out.empty()
+
+
+def test_relay_flushes_after_max_latency():
+
+    out = queue.Queue()
+    relay = Relay(out, batch_size=100, max_latency_s=0.05)
+    stop = threading.Event()
+    flusher = threading.Thread(target=relay.run_flusher, args=(stop,), daemon=True)
+    flusher.start()
+
+    try:
+        relay.put(*reading(0))
+        relay.put(*reading(1))
+        assert out.get(timeout=2) == [reading(0), reading(1)]
+    finally:
+        stop.set()
+        flusher.join()
+
+    assert out.empty()
+
+
+def stub_worker(index, settings, subscriptions, out_queue, router):
+    """ Relays a few readings, then holds on to the rest,
+    only flushing them when terminated, as run_worker does.
+    """
+
+    def on_sigterm(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    relay = Relay(out_queue, batch_size=2, max_latency_s=60)
+    for offset in range(3):
+        relay.put(*reading(index * 100 + offset))
+
+    try:
+        while True:
+            time.sleep(0.1)
+    except SystemExit:
+        pass
+    finally:
+        relay.flush()
+
+    return None
+
+
+def test_pool_stop_drains_the_workers():
+
+    pool = WorkerPool(2, {}, [], None, target=stub_worker)
+    pool.start()
+
+    received = []
+    readings = pool.readings(check_interval_s=0.1)
+    # The first batch from each worker
+    while len(received) < 4:
+        received.append(next(readings))
+
+    received.extend(pool.stop(timeout=10))
+
+    assert sorted(_[1]["timestamp_utc"] for _ in received) == [0, 1, 2, 100, 101, 102]
+    assert not any(_.is_alive() for _ in pool.processes)
+
+
+def busy_worker(index, settings, subscriptions, out_queue, router):
+    """ Relays a reading every few ms until terminated, except
+    worker 0, which dies after a few. Exiting, rather than being
+    killed, can't leave the queue's lock held.
+    """
+
+    def on_sigterm(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    try:
+        count = 0
+        while index or count < 10:
+            out_queue.put([reading(index * 1000000 + count)])
+            count += 1
+            time.sleep(0.002)
+    except SystemExit:
+        pass
+
+    return None
+
+
+def test_pool_restarts_a_dead_worker_while_busy():
+
+    pool = WorkerPool(2, {}, [], None, target=busy_worker)
+    pool.start()
+    first_pid = pool.processes[0].pid
+
+    # Worker 1 keeps the queue from ever being empty
+    readings = pool.readings(check_interval_s=0.1)
+    deadline = time.monotonic() + 10
+    while pool.processes[0].pid == first_pid and time.monotonic() < deadline:
+        next(readings)
+
+    restarted = pool.processes[0].pid != first_pid
+    for _ in pool.stop(timeout=10):
+        pass
+
+    assert restarted
@@ -0,0 +1,372 @@
+import json
+import logging
+import re
+import struct
+import schemas_and_tables as S
+from metrics import metrics
+
+""" Routes MQTT topics to the way their messages are decoded and
+    stored, from `[route:<topic pattern>]` sections in the config file.
+    The patterns are kept in a trie, one level per node, so finding the
+    route for a topic only walks the topic's levels once, and the result
+    is remembered per topic, so after the first message from a station
+    dispatch is a single dict lookup.
+"""
+
+logger = logging.getLogger(__name__)
+
+ROUTE_PREFIX = "route:"
+
+KINDS = ["env", "gas", "batch"]
+
+PAYLOAD_TYPES = {"float": float,
+                 "int": int}
+
+BATCH_FORMATS = ["jsonl", "struct"]
+
+# Each reading in a struct batch: the index of its measure in the
+# route's measures list, a timestamp in seconds, and the value.
+BATCH_RECORD = struct.Struct("<BIf")
+
+# Names from the config that end up in SQL
+IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def check_identifier(name, what):
+
+    if not IDENTIFIER.match(name):
+        raise ValueError(f"{what} {name!r} must be letters, digits and underscores")
+
+    return name
+
+
+class Route:
+    """ How to decode and store the messages on one topic pattern.
+    kind is `env`, for readings of a measure that go through
+    lastUpdates and its archive policy into an archive table,
+    or `gas`, for volumes of gas used that are always archived,
+    or `batch`, for many env readings with their own timestamps,
+    in the format batch_format, see _decode_batch().
+    The station_id is taken from the topic level station_level,
+    by default the last `+` in the pattern.
+    """
+
+    def __init__(self, pattern, kind, measure=None, measure_type=None, payload="float",
+                 scale=1.0, policy=None, qos=0, station_level=None,
+                 batch_format="jsonl", measures=None):
+
+        if kind not in KINDS:
+            raise ValueError(f"Route {pattern} kind must be one of {KINDS}, not {kind}")
+
+        if batch_format not in BATCH_FORMATS:
+            raise ValueError(f"Route {pattern} format must be one of {BATCH_FORMATS}")
+
+        if payload not in PAYLOAD_TYPES:
+            raise ValueError(f"Route {pattern} payload must be one of {list(PAYLOAD_TYPES)}")
+
+        self.pattern = pattern
+        self.levels = pattern.split("/")
+        self.kind = kind
+        self.measure = measure
+        self.measure_type = measure_type
+        self.parse = PAYLOAD_TYPES[payload]
+        self.scale = scale
+        self.policy = policy
+        self.qos = qos
+        self.batch_format = batch_format
+        # For struct batches, the measure of each index
+        self.measures = measures or list(S.env_tables)
+
+        if station_level is None:
+            wildcards = [i for i, _ in enumerate(self.levels) if _ == "+"]
+            if not wildcards:
+                raise ValueError(f"Route {pattern} has no + level for the station_id, "
+                                 "set station_level")
+            station_level = wildcards[-1]
+        self.station_level = station_level
+
+        if kind == "env":
+            self.decode = self._decode_env
+        elif kind == "gas":
+            self.decode = self._decode_gas
+        else:
+            self.decode = self._decode_batch
+
+    def _value(self, payload):
+
+        value = self.parse(payload)
+        if self.scale != 1.0:
+            value = value * self.scale
+
+        return value
+
+    def _decode_env(self, station_id, payload, timestamp_utc):
+        """ Decode an environment reading to a dict for insertion into
+        the DB, from the station_id, payload bytes of the value, and
+        the time it was received.
+        """
+
+        return {"station_id": station_id,
+                "timestamp_utc": timestamp_utc,
+                "measure_type": self.measure_type,
+                "measure_value": self._value(payload),
+                "measure": self.measure}
+
+    def _decode_gas(self, station_id, payload, timestamp_utc):
+        """ Decode a volume of gas used, in litres """
+
+        return {"timestamp_utc": timestamp_utc,
+                "station_id": station_id,
+                "volume_l": self._value(payload),
+                "is_meter_reading": False} # always false, other only manually added.
+
+    def _batch_records(self, payload):
+        """ Return the records of a batch payload, and how many bytes
+        or lines couldn't be read. jsonl is a JSON array per line, e.g.
+        `["temp", 1700000000, 21.5]`, struct is packed BATCH_RECORDs,
+        each as (measure, timestamp_utc, value).
+        """
+
+        if self.batch_format == "jsonl":
+            lines = [_ for _ in payload.splitlines() if _.strip()]
+            try:
+                # Parse all the lines at once, as one array
+                return json.loads(b"[" + b",".join(lines) + b"]"), 0
+            except ValueError:
+                pass
+
+            # Then one at a time, to find the bad ones
+            records = []
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning(f"Bad JSON in a batch: {line[:100]!r}, skipped.")
+            return records, len(lines) - len(records)
+
+        # A truncated last record is dropped, the others are whole
+        bad = 0
+        truncated = len(payload) % BATCH_RECORD.size
+        if truncated:
+            logger.warning(f"Struct batch has {truncated} bytes of a truncated record, "
+                           "skipped.")
+            bad += 1
+
+        records = []
+        for index, timestamp_utc, value in BATCH_RECORD.iter_unpack(
+                memoryview(payload)[:len(payload) - truncated]):
+            if index >= len(self.measures):
+                logger.warning(f"Struct batch measure index {index} isn't in the route's "
+                               "measures, skipped.")
+                bad += 1
+                continue
+            records.append((self.measures[index], timestamp_utc, value))
+
+        return records, bad
+
+    def _decode_batch(self, station_id, payload, timestamp_utc):
+        """ Decode a batch of environment readings, which each have
+        their own timestamp, to a list of dicts like _decode_env().
+        Bad readings, and those of unknown measures, are skipped,
+        and the rest stored. Raises ValueError if none are good.
+        """
+
+        env_tables = S.env_tables
+        decoded = []
+
+        records, bad = self._batch_records(payload)
+
+        for record in records:
+            try:
+                measure, reading_time, value = record
+                if measure not in env_tables:
+                    logger.warning(f"Env type {measure} from {station_id} not recognised, "
+                                   "and not stored.")
+                    continue
+                decoded.append({"station_id": station_id,
+                                "timestamp_utc": float(reading_time),
+                                "measure_type": env_tables[measure]["measure"],
+                                "measure_value": float(value) * self.scale,
+                                "measure": measure})
+            except (TypeError, ValueError):
+                # e.g. a JSON line that isn't an array of three
+                logger.warning(f"Bad batch reading from {station_id}: {record!r}, skipped.")
+                bad += 1
+
+        if bad:
+            metrics.inc("batch_readings_dropped_total", amount=bad)
+            if not decoded:
+                raise ValueError(f"No good readings in the batch from {station_id}")
+
+        return decoded
+
+    def __repr__(self):
+
+        return f"Route({self.pattern!r}, {self.kind}, measure={self.measure})"
+
+
+class TopicRouter:
+    """ Finds the Route for a topic. Exact levels take precedence
+    over `+`, and `+` over `#`. Up to max_cached_topics topics
+    are remembered, including ones with no route.
+    """
+
+    def __init__(self, routes=(), max_cached_topics=100000):
+
+        self.routes = []
+        self._trie = {}
+        self._cache = {}
+        self.max_cached_topics = max_cached_topics
+
+        for route in routes:
+            self.add(route)
+
+    def add(self, route):
+
+        node = self._trie
+        for level in route.levels:
+            node = node.setdefault(level, {})
+
+        if None in node:
+            raise ValueError(f"Two routes for {route.pattern}")
+
+        # The route is kept in its last node, under None,
+        # which can't be a topic level.
+        node[None] = route
+        self.routes.append(route)
+        self._cache = {}
+
+        return None
+
+    def _find(self, node, levels, depth):
+
+        if depth == len(levels):
+            route = node.get(None)
+            if route is None and "#" in node:
+                # `a/#` also matches `a`
+                route = node["#"].get(None)
+            return route
+
+        for key in (levels[depth], "+"):
+            child = node.get(key)
+            if child is not None:
+                route = self._find(child, levels, depth + 1)
+                if route is not None:
+                    return route
+
+        child = node.get("#")
+        if child is not None:
+            return child.get(None)
+
+        return None
+
+    def match(self, topic):
+        """ Return (route, station_id) for a topic, or None """
+
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+
+        levels = topic.split("/")
+        # Wildcards don't match topics starting with $, like $SYS
+        route = None if topic.startswith("$") else self._find(self._trie, levels, 0)
+
+        if route is None or route.station_level >= len(levels):
+            result = None
+        else:
+            result = (route, levels[route.station_level])
+
+        if len(self._cache) >= self.max_cached_topics:
+            self._cache = {}
+        self._cache[topic] = result
+
+        return result
+
+    def subscriptions(self, callback):
+        """ Return the (topic, callback, qos) subscription list """
+
+        return [(_.pattern, callback, _.qos) for _ in self.routes]
+
+    def policies(self):
+        """ Return the policy specs set by routes, by measure """
+
+        return {_.measure: _.policy for _ in self.routes if _.kind == "env" and _.policy}
+
+
+def default_routes(qos=0):
+    """ The routes used if the config has none, storing
+    `env/<measure>/<station_id>` for each of the built in
+    env tables, `utility/gas/<station_id>`, and batches of
+    JSON lines on `env/batch/<station_id>`, all at qos.
+    """
+
+    routes = [Route(f"env/{measure}/+", "env", measure=measure,
+                    measure_type=S.env_tables[measure]["measure"], qos=qos)
+              for measure in S.env_tables]
+    routes.append(Route("utility/gas/+", "gas", payload="int", qos=qos))
+    routes.append(Route("env/batch/+", "batch", qos=qos))
+
+    return routes
+
+
+def route_from_section(pattern, section, default_qos=0):
+    """ Create a Route from a `[route:<pattern>]` config section,
+    adding the env table it needs if it doesn't exist.
+    """
+
+    kind = section.get("decoder", "env")
+    station_level = section.get("station_level")
+    options = {"payload": section.get("payload", "float" if kind == "env" else "int"),
+               "scale": float(section.get("scale", 1.0)),
+               "policy": section.get("policy"),
+               "qos": int(section.get("qos", default_qos)),
+               "station_level": int(station_level) if station_level else None}
+
+    if kind == "batch":
+        measures = section.get("measures")
+        return Route(pattern, kind,
+                     batch_format=section.get("format", "jsonl"),
+                     measures=[_.strip() for _ in measures.split(",")] if measures else None,
+                     **options)
+
+    if kind != "env":
+        return Route(pattern, kind, **options)
+
+    measure = check_identifier(section.get("measure", ""), "measure")
+
+    if measure in S.env_tables:
+        measure_type = S.env_tables[measure]["measure"]
+    else:
+        unit = section.get("unit")
+        measure_type = check_identifier(section.get("column",
+                                                    f"{measure}_{unit}" if unit else measure),
+                                        "column")
+        tablename = check_identifier(section.get("table", measure), "table")
+        S.add_env_table(measure, tablename, measure_type)
+        logger.info(f"Added measure {measure}, stored in {tablename}.{measure_type}")
+
+    return Route(pattern, kind, measure=measure, measure_type=measure_type, **options)
+
+
+def router_from_config(config):
+    """ Create the TopicRouter from the `[route:<topic pattern>]`
+    sections of a ConfigParser, or the default routes if there
+    are none. Must be called before the DB is set up, as new
+    measures add their tables to S.env_tables.
+    """
+
+    patterns = [_ for _ in config.sections() if _.startswith(ROUTE_PREFIX)]
+    # For routes without their own qos
+    default_qos = config.getint("client", "qos", fallback=0)
+
+    if not patterns:
+        return TopicRouter(default_routes(default_qos))
+
+    routes = [route_from_section(_[len(ROUTE_PREFIX):], config[_], default_qos)
+              for _ in patterns]
+
+    for route in routes:
+        logger.info(f"Routing {route.pattern} as {route.kind} {route.measure or ''}")
+
+    return TopicRouter(routes)
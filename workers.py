@@ -0,0 +1,315 @@
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from duplicates import DuplicateFilter
+
+""" Multi-process ingest. Several worker processes each run their own
+    MQTT v5 client on shared subscriptions (`$share/<group>/<topic>`),
+    so the broker spreads the messages between them, and decode the
+    messages with the usual callbacks. Rather than each opening the DB,
+    and fighting over SQLite's single write lock, they send the decoded
+    readings over a queue to the main process, which does all the
+    writing.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def shared_topic(topic, group):
+    """ Return the shared subscription for a topic filter """
+
+    return f"$share/{group}/{topic}"
+
+
+class Relay:
+    """ Used in place of storage by a worker's callbacks. Collects
+    (kind, decoded) readings and puts them on out_queue as a list,
+    once batch_size have been collected, or every max_latency_s
+    seconds while run_flusher() is running, so the cost of pickling
+    and the pipe is shared between many readings.
+    out_queue can be any object with a put() method, such as a
+    queue.Queue, to run the callbacks in a single process.
+    """
+
+    def __init__(self, out_queue, batch_size=100, max_latency_s=0.05):
+
+        self.queue = out_queue
+        self.batch_size = max(1, batch_size)
+        self.max_latency_s = max_latency_s
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def put(self, kind, decoded):
+
+        with self._lock:
+            self._pending.append((kind, decoded))
+            if len(self._pending) >= self.batch_size:
+                self._send()
+
+        return None
+
+    def _send(self):
+
+        self.queue.put(self._pending)
+        self._pending = []
+
+        return None
+
+    def flush(self):
+
+        with self._lock:
+            if self._pending:
+                self._send()
+
+        return None
+
+    def run_flusher(self, stop_event):
+        """ Flush every max_latency_s until stop_event is set """
+
+        while not stop_event.wait(self.max_latency_s):
+            self.flush()
+
+        return None
+
+
+def on_worker_connect(client, userdata, flags, rc, properties=None):
+    """ Subscribe to the shared version of every subscription,
+    whenever a worker (re)connects.
+    """
+
+    logger.warning(f"Worker connected to {client._host}:{client._port} with result: {rc}")
+
+    client.subscribe([(shared_topic(_[0], userdata["share_group"]), _[2])
+                      for _ in userdata["subscriptions"]])
+
+    return None
+
+
+def _exit_on_sigterm(signum, frame):
+
+    raise SystemExit(0)
+
+
+def run_worker(index, settings, subscriptions, out_queue, router):
+    """ Body of a worker process: run an MQTT client with the
+    subscriptions' callbacks until terminated, relaying the
+    decoded readings to out_queue.
+    settings is a dict of the MQTT client settings, plus
+    share_group, relay_batch, relay_latency_s and duplicate_slots.
+    """
+
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    # Restarted workers are forked with the main process's diagnostics
+    # handlers, and systemctl kill signals every process. Ignored, as
+    # the default for these is to stop.
+    for signum in (signal.SIGUSR1, signal.SIGUSR2, signal.SIGQUIT):
+        signal.signal(signum, signal.SIG_IGN)
+
+    relay = Relay(out_queue, settings["relay_batch"], settings["relay_latency_s"])
+
+    userdata = {"router": router,
+                "relay": relay,
+                "spool": None,
+                "duplicates": (DuplicateFilter(settings["duplicate_slots"])
+                               if settings["duplicate_slots"] else None),
+                "subscriptions": subscriptions,
+                "share_group": settings["share_group"]}
+
+    # Each worker needs its own client id
+    client_id = f"{settings['client_id']}-{index}" if settings["client_id"] else ""
+    client = mqtt.Client(client_id=client_id,
+                         userdata=userdata,
+                         protocol=mqtt.MQTTv5)
+    client.username_pw_set(settings["username"], password=settings["password"])
+    client.on_connect = on_worker_connect
+
+    # Messages arrive with their real topic, not the $share one,
+    # so are routed as usual, by the one callback they all share.
+    client.on_message = subscriptions[0][1]
+
+    stop = threading.Event()
+    flusher = threading.Thread(target=relay.run_flusher, args=(stop,),
+                               name="relay-flusher", daemon=True)
+    flusher.start()
+
+    # MQTT v5 keeps a session after disconnecting only for
+    # its expiry interval, which defaults to 0.
+    properties = None
+    if not settings["clean_session"]:
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = settings["session_expiry_s"]
+
+    client.connect(settings["host"], settings["port"], settings["timeout"],
+                   clean_start=settings["clean_session"], properties=properties)
+
+    try:
+        client.loop_forever()
+    except (SystemExit, KeyboardInterrupt):
+        pass
+    finally:
+        client.disconnect()
+        stop.set()
+        relay.flush()
+        logger.info(f"Worker {index} stopped.")
+
+    return None
+
+
+class WorkerPool:
+    """ Start count worker processes, running target (run_worker by
+    default) with the same arguments, and collect what they relay.
+    Workers that die unexpectedly are restarted.
+    Workers are forked, so the callbacks in subscriptions don't
+    need to be importable.
+    """
+
+    def __init__(self, count, settings, subscriptions, router,
+                 queue_size=1000, target=run_worker, context=None):
+
+        self.count = count
+        self.settings = settings
+        self.subscriptions = subscriptions
+        self.router = router
+        self.target = target
+        self.context = context or multiprocessing.get_context("fork")
+        # Each entry is a list of readings, so this bounds
+        # the backlog to queue_size x relay_batch readings.
+        self.queue = self.context.Queue(queue_size)
+        self.processes = [None] * count
+        self.stopping = False
+
+    def _start(self, index):
+
+        process = self.context.Process(target=self.target,
+                                       name=f"mqtt-worker-{index}",
+                                       args=(index,
+                                             self.settings,
+                                             self.subscriptions,
+                                             self.queue,
+                                             self.router),
+                                       daemon=True)
+        process.start()
+        self.processes[index] = process
+
+        logger.info(f"Started worker {index}, pid {process.pid}")
+
+        return None
+
+    def start(self):
+
+        for index in range(self.count):
+            self._start(index)
+
+        return None
+
+    def _check_workers(self):
+
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                logger.error(f"Worker {index} exited with {process.exitcode}, restarting.")
+                self._start(index)
+
+        return None
+
+    def readings(self, check_interval_s=1.0):
+        """ Yield (kind, decoded) readings from the workers until
+        stop() is called, checking on the workers every
+        check_interval_s, busy or not.
+        """
+
+        last_check = time.monotonic()
+
+        while not self.stopping:
+            # The others keep the queue busy if one dies
+            if time.monotonic() - last_check >= check_interval_s:
+                self._check_workers()
+                last_check = time.monotonic()
+
+            try:
+                batch = self.queue.get(timeout=check_interval_s)
+            except queue.Empty:
+                continue
+
+            yield from batch
+
+        return None
+
+    def stop(self, timeout=10):
+        """ Terminate the workers, and yield whatever readings they
+        relay before they exit, so none are lost.
+        """
+
+        self.stopping = True
+
+        for process in self.processes:
+            if process and process.is_alive():
+                process.terminate()
+
+        # A worker can't exit until its queued data has
+        # been read, so keep reading while joining.
+        deadline = time.monotonic() + timeout
+        while any(_ and _.is_alive() for _ in self.processes):
+            if time.monotonic() > deadline:
+                logger.error(f"Workers didn't stop within {timeout}s, killing them.")
+                for process in self.processes:
+                    if process and process.is_alive():
+                        process.kill()
+            try:
+                yield from self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        while True:
+            try:
+                yield from self.queue.get(timeout=0.1)
+            except queue.Empty:
+                break
+
+        for process in self.processes:
+            if process:
+                process.join()
+
+        logger.info("All workers stopped.")
+
+        return None
+
+
+def workers_from_config(config, subscriptions, router):
+    """ Create a WorkerPool from the `[workers]` section of a
+    ConfigParser, and the usual MQTT settings, or return None
+    if count isn't set above 0.
+    """
+
+    count = config.getint("workers", "count", fallback=0)
+    if count <= 0:
+        return None
+
+    settings = {"host": config.get("mqtt-server", "host", fallback="127.0.0.1"),
+                "port": config.getint("mqtt-server", "port", fallback=1883),
+                "timeout": config.getint("mqtt-server", "timeout", fallback=60),
+                "client_id": config.get("client", "client_id", fallback=None),
+                "username": config.get("client", "username", fallback=None),
+                "password": config.get("client", "password", fallback=None),
+                "clean_session": config.getboolean("client", "clean_session", fallback=True),
+                "session_expiry_s": config.getint("client", "session_expiry_s", fallback=86400),
+                "duplicate_slots": (config.getint("duplicates", "slots", fallback=4096)
+                                    if config.getboolean("duplicates", "enabled", fallback=True)
+                                    else 0),
+                "share_group": config.get("workers", "share_group", fallback="store-mqtt-data"),
+                "relay_batch": config.getint("workers", "relay_batch", fallback=100),
+                "relay_latency_s": config.getfloat("workers", "relay_latency_s", fallback=0.05)}
+
+    logger.info(f"Running {count} workers on shared subscriptions "
+                f"in group {settings['share_group']}")
+
+    return WorkerPool(count,
+                      settings,
+                      subscriptions,
+                      router,
+                      queue_size=config.getint("workers", "queue_size", fallback=1000))